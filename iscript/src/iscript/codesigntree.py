@@ -73,9 +73,12 @@ For example,
 Note:
 
   1) Each "map" array entry represents one invocation of the codesign
-     command which is executed preserving the order of the input file
-     and includes all files matching all the glob patterns from the
-     "globs" entry.
+     command which includes all files matching all the glob patterns
+     from the "globs" entry. Entries are executed preserving the order
+     of the input file for any entries that sign the same files, or
+     files inside each other, e.g. a bundle and its contents. Other
+     entries can run concurrently, and entries that can run at the
+     same time with the same options are combined into one invocation.
 
   2) The sign, keychain, requirements, and entitlements array must either
      be empty [] or contain a single string ["foo"].
@@ -96,11 +99,11 @@ Note:
 """
 
 import argparse
+import asyncio
 import glob
 import json
 import logging
 import os
-import subprocess
 import sys
 import tempfile
 import zipfile
@@ -111,6 +114,15 @@ REQUIRED_MAP_FILE_KEYS = ["force", "sign", "deep", "runtime", "entitlements",
 ALLOWED_OVERRIDE_KEYS = ["force", "sign", "runtime", "entitlements",
         "keychain", "requirements"]
 
+async def _main(map_file, root_dir, ent_dir, overrides, args, log):
+    # Before python 3.10, the semaphore binds to the event loop it's
+    # created in, so create it in the loop that runs codesigntree
+    semaphore = asyncio.Semaphore(args.jobs)
+    return await codesigntree(map_file, root_dir, ent_dir, overrides,
+                              args.simulate, args.verbose, log,
+                              semaphore=semaphore)
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -121,6 +133,9 @@ def main():
     parser.add_argument("-n", "--simulate", action="store_true",
             help="don't do anything, just print codesign commands")
 
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="the number of codesign commands to run at once")
+
     parser.add_argument("-m", "--map-file", type=str, required=True,
             help="the JSON codesigning map file path")
 
@@ -265,20 +280,134 @@ def main():
             overrides[key] = override_arg_key
 
     exit_code = 0
-    if not codesigntree(map_file, root_dir, ent_dir, overrides,
-            args.simulate, args.verbose, logger):
+    if not asyncio.run(_main(map_file, root_dir, ent_dir, overrides, args,
+                             logger)):
         exit_code = -1
 
     sys.exit(exit_code)
 
-def codesigntree(map_file,
-        root_dir,
-        ent_dir,
-        overrides,
-        simulate,
-        verbose,
-        log,
-        cs_path="/usr/bin/codesign"):
+
+def expand_globs(root_dir, cs_map):
+    """Expand every glob pattern in the map once
+
+    Returns a dict of pattern to the sorted list of matching paths.
+
+    Parameters:
+    root_dir (string) -- path to the root directory
+    cs_map (dict)     -- the parsed JSON map file
+    """
+    expanded = {}
+    for cs_entry in cs_map["map"]:
+        for path_glob in cs_entry.get("globs", []):
+            if path_glob not in expanded:
+                expanded[path_glob] = sorted(
+                    glob.glob(root_dir + path_glob, recursive=True))
+    return expanded
+
+
+def get_codesign_flags(cs_entry, ent_dir):
+    """Return the codesign arguments for a map entry, minus the paths"""
+    flags = ["-v"]
+
+    if "deep" in cs_entry and cs_entry["deep"] is True:
+        flags.append("--deep")
+
+    if "force" in cs_entry and cs_entry["force"] is True:
+        flags.append("--force")
+
+    for string_option in ["sign", "requirements", "keychain"]:
+        if string_option in cs_entry and len(cs_entry[string_option]) > 0:
+            flags.append("--%s" % string_option)
+            flags.append(cs_entry[string_option][0])
+
+    if "runtime" in cs_entry and cs_entry["runtime"] is True:
+        flags.append("--options")
+        flags.append("runtime")
+
+    if len(cs_entry["entitlements"]) > 0:
+        ent_fullpath = ent_dir + "/" + cs_entry["entitlements"][0]
+        flags.append("--entitlements")
+        flags.append(ent_fullpath)
+
+    return flags
+
+
+def _get_ancestors(paths):
+    ancestors = set()
+    for path in paths:
+        parent = os.path.dirname(path)
+        while parent not in ancestors and parent != os.path.dirname(parent):
+            ancestors.add(parent)
+            parent = os.path.dirname(parent)
+    return ancestors
+
+
+def plan_codesign(cs_entries, ent_dir, expanded, cs_path="/usr/bin/codesign"):
+    """Plan the codesign commands for the map entries
+
+    Map entries are signed in order, except that an entry only has to
+    wait for the earlier entries that sign the same paths, paths inside
+    its own, or paths containing its own, e.g. a bundle and its contents.
+    Entries are grouped into levels: everything in a level only depends
+    on earlier levels, and can be signed concurrently. Within a level,
+    entries with identical codesign flags are signed with one command.
+
+    Returns a list of levels, each a list of codesign commands.
+
+    Parameters:
+    cs_entries (list) -- the map entries, with any overrides applied
+    ent_dir (string)  -- path to the directory containing any
+                         entitlement files used in the map file
+    expanded (dict)   -- the glob patterns to their matching paths,
+                         from expand_globs()
+    cs_path (string)  -- path to the codesign command
+                         (default "/usr/bin/codesign")
+    """
+    levels = []
+    signed = []
+    for cs_entry in cs_entries:
+        paths = []
+        for path_glob in cs_entry["globs"]:
+            paths.extend(expanded[path_glob])
+        if len(paths) == 0:
+            continue
+        path_set = set(os.path.normpath(path) for path in paths)
+        ancestors = _get_ancestors(path_set)
+        level = 0
+        for earlier_level, earlier_paths, earlier_ancestors in signed:
+            if (path_set & earlier_paths or path_set & earlier_ancestors or
+                    ancestors & earlier_paths):
+                level = max(level, earlier_level + 1)
+        signed.append((level, path_set, ancestors))
+        if level == len(levels):
+            levels.append({})
+        flags = tuple(get_codesign_flags(cs_entry, ent_dir))
+        levels[level].setdefault(flags, []).extend(paths)
+
+    return [[[cs_path] + list(flags) + paths
+            for flags, paths in commands.items()] for commands in levels]
+
+
+async def _run_codesign(cs_cmd, semaphore, log):
+    async with semaphore:
+        proc = await asyncio.create_subprocess_exec(*cs_cmd)
+        exit_code = await proc.wait()
+    if exit_code != 0:
+        log.error("ERROR: codesign exited %d: %s" %
+                  (exit_code, " ".join(cs_cmd)))
+        return False
+    return True
+
+
+async def codesigntree(map_file,
+                       root_dir,
+                       ent_dir,
+                       overrides,
+                       simulate,
+                       verbose,
+                       log,
+                       cs_path="/usr/bin/codesign",
+                       semaphore=None):
 
     """Codesign a tree of files
 
@@ -307,6 +436,9 @@ def codesigntree(map_file,
     log (logger)      -- a logger to use for logging errors, warnings
     cs_path (string)  -- path to the codesign command
                          (default "/usr/bin/codesign")
+    semaphore (asyncio.Semaphore) -- limits the concurrent codesign
+                         commands, e.g. across trees (default: one
+                         at a time)
     """
 
     MIN_PYTHON = (3, 5) # due to the use of glob recursive option
@@ -332,6 +464,9 @@ def codesigntree(map_file,
     cs_map_string = open(map_file).read()
     cs_map = json.loads(cs_map_string)
 
+    # Expand each glob pattern once, for both the checks and signing
+    expanded = expand_globs(root_dir, cs_map)
+
     # Walk the map and make sure all referenced entitlement files are
     # present and readable. Log a warning if filename glob patterns
     # don't match any files.
@@ -352,7 +487,7 @@ def codesigntree(map_file,
         ent_filename = None
         if "entitlements" in overrides:
             ent_filename = overrides["entitlements"]
-        elif len(cs_entry["entitlements"]) is 1:
+        elif len(cs_entry["entitlements"]) == 1:
             ent_filename = cs_entry["entitlements"][0]
         if ent_filename is not None:
             ent_fullpath = ent_dir + "/" + ent_filename;
@@ -367,56 +502,40 @@ def codesigntree(map_file,
                 log.error("ERROR: file pattern \"%s\" must start with \"/\""
                         % path_glob)
                 return False
-            binary_paths = glob.glob(root_dir + path_glob, recursive=True)
-            if len(binary_paths) is 0:
+            if len(expanded[path_glob]) == 0:
                 log.warning("file pattern \"%s\" matches no files" % path_glob)
 
-        if len(cs_entry["sign"]) is 0 and "sign" not in overrides:
+        if len(cs_entry["sign"]) == 0 and "sign" not in overrides:
             log.error("ERROR: map file missing \"sign\" entry and no signing " +
                     "override provided")
             return False
 
-    # walk the map and run codesign for each entry
+    # replace entries in each cs_entry with their overrides. String
+    # overrides replace the one element map file arrays.
     for cs_entry in cs_map["map"]:
-
-        # replace entries in cs_entry with their overrides
         for override in overrides:
-            cs_entry[override] = overrides[override]
-
-        # build the codesign command in |cs_cmd|
-        cs_cmd = [cs_path, "-v"]
-
-        if "deep" in cs_entry and cs_entry["deep"] is True:
-            cs_cmd.append("--deep")
-
-        if "force" in cs_entry and cs_entry["force"] is True:
-            cs_cmd.append("--force")
-
-        for string_option in ["sign", "requirements", "keychain"]:
-            if string_option in cs_entry and len(cs_entry[string_option]) > 0:
-                cs_cmd.append("--%s" % string_option)
-                cs_cmd.append(cs_entry[string_option][0])
-
-        if "runtime" in cs_entry and cs_entry["runtime"] is True:
-            cs_cmd.append("--options")
-            cs_cmd.append("runtime")
-
-        if len(cs_entry["entitlements"]) > 0:
-            ent_fullpath = ent_dir + "/" + cs_entry["entitlements"][0]
-            cs_cmd.append("--entitlements")
-            cs_cmd.append(ent_fullpath)
-
-        for path_glob in cs_entry["globs"]:
-            path_glob = root_dir + path_glob
-            binary_paths = glob.glob(path_glob, recursive=True)
-            for binary_path in binary_paths:
-                cs_cmd.append(binary_path)
-
-        if verbose or simulate:
-            log.info(" ".join(cs_cmd))
-
-        if not simulate:
-            subprocess.run(cs_cmd)
+            if isinstance(overrides[override], str):
+                cs_entry[override] = [overrides[override]]
+            else:
+                cs_entry[override] = overrides[override]
+
+    plan = plan_codesign(cs_map["map"], ent_dir, expanded, cs_path)
+
+    if verbose or simulate:
+        for level, cs_cmds in enumerate(plan):
+            for cs_cmd in cs_cmds:
+                log.info("[%d] %s" % (level, " ".join(cs_cmd)))
+
+    if simulate:
+        return True
+
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(1)
+    for cs_cmds in plan:
+        results = await asyncio.gather(
+            *[_run_codesign(cs_cmd, semaphore, log) for cs_cmd in cs_cmds])
+        if not all(results):
+            return False
 
     return True
 
@@ -7,7 +7,9 @@ import os
 import plistlib
 import re
 import shlex
+import time
 from copy import deepcopy
+from functools import partial
 from glob import glob
 from itertools import filterfalse
 from shutil import copy2
@@ -40,6 +42,14 @@ MAC_DESIGNATED_REQUIREMENTS = (
 
 KNOWN_ARTIFACT_PREFIXES = ("public/", "releng/partner/")
 
+NOTARIZATION_STATUS_REGEX = re.compile(r"Status: (?P<status>success|invalid)")
+NOTARIZATION_HISTORY_REGEX = re.compile(
+    r"(?P<uuid>[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})\s+(?P<status>success|invalid|in progress)"
+)
+
+# The default for the ``codesign_concurrency_limit`` key config.
+DEFAULT_CODESIGN_CONCURRENCY_LIMIT = os.cpu_count() or 1
+
 
 # App {{{1
 @attr.s
@@ -200,48 +210,82 @@ async def sign_geckodriver(config, key_config, all_paths):
 
 
 # sign_app {{{1
-async def sign_app(key_config, app_path, entitlements_path):
-    """Sign the .app.
+SIGN_DIRS = ("MacOS", "Library")
 
-    Largely taken from build-tools' ``dmg_signfile``.
 
-    Args:
-        key_config (dict): the running config
-        app_path (str): the path to the app to be signed (extracted)
-        entitlements_path (str): the path to the entitlements file for signing
+@attr.s
+class CodesignBundle(object):
+    """The codesign plan for a .app bundle.
 
-    Raises:
-        IScriptError: on error.
+    ``files`` and ``bundles`` don't depend on each other, so they can be
+    signed concurrently, but all of them have to be signed before
+    ``libclearkey_path``, and that before the bundle itself.
+
+    Attributes:
+        app_path (str): the path to the .app directory.
+        files (list): the paths of the files to sign in the bundle, not
+            counting nested bundles.
+        bundles (list): the ``CodesignBundle`` plans of the nested .app bundles.
+        libclearkey_path (str): the path to ``libclearkey.dylib``, if this is
+            a top level bundle that has one.
 
     """
-    SIGN_DIRS = ("MacOS", "Library")
-    parent_dir = os.path.dirname(app_path)
-    app_name = os.path.basename(app_path)
-    await run_command(["xattr", "-cr", app_name], cwd=parent_dir, exception=IScriptError)
-    identity = key_config["identity"]
-    keychain = key_config["signing_keychain"]
-    sign_command = _get_sign_command(identity, keychain)
 
-    if key_config.get("sign_with_entitlements", False):
-        sign_command.extend(["-o", "runtime", "--entitlements", entitlements_path])
+    app_path = attr.ib()
+    files = attr.ib(factory=list)
+    bundles = attr.ib(factory=list)
+    libclearkey_path = attr.ib(default="")
+
+    def get_ordered_paths(self):
+        """Return every path to sign, in an order that respects the dependencies.
+
+        Returns:
+            list: the paths to sign
+
+        """
+        paths = list(self.files)
+        for bundle in self.bundles:
+            paths.extend(bundle.get_ordered_paths())
+        if self.libclearkey_path:
+            paths.append(self.libclearkey_path)
+        paths.append(self.app_path)
+        return paths
+
+
+def plan_app_signing(app_path):
+    """Plan the codesign calls needed to sign the .app, without signing anything.
+
+    Only files under ``SIGN_DIRS`` are signed, not counting the main
+    executable, which is signed with the bundle. Nested .app bundles get
+    their own plan, rather than having their files signed as part of the
+    outer bundle.
+
+    Args:
+        app_path (str): the path to the app to be signed (extracted)
 
+    Returns:
+        CodesignBundle: the plan
+
+    """
+    plan = CodesignBundle(app_path=app_path)
     app_executable = get_bundle_executable(app_path)
     app_path_len = len(app_path)
     contents_dir = os.path.join(app_path, "Contents")
     for top_dir, dirs, files in os.walk(contents_dir):
-        for dir_ in dirs:
+        for dir_ in sorted(dirs):
             abs_dir = os.path.join(top_dir, dir_)
             if top_dir == contents_dir and dir_ not in SIGN_DIRS:
                 log.debug("Skipping %s because it's not in SIGN_DIRS.", abs_dir)
                 dirs.remove(dir_)
                 continue
             if dir_.endswith(".app"):
-                await sign_app(key_config, abs_dir, entitlements_path)
+                plan.bundles.append(plan_app_signing(abs_dir))
+                dirs.remove(dir_)
         if top_dir == contents_dir:
             log.debug("Skipping file iteration in %s because it's the root directory.", top_dir)
             continue
 
-        for file_ in files:
+        for file_ in sorted(files):
             abs_file = os.path.join(top_dir, file_)
             # Deal with inner .app's above, not here.
             if top_dir[app_path_len:].count(".app") > 0:
@@ -251,27 +295,72 @@ async def sign_app(key_config, app_path, entitlements_path):
             if file_ == app_executable:
                 log.debug("Skipping %s because it's the main executable.", abs_file)
                 continue
-            dir_ = os.path.dirname(abs_file)
-            await retry_async(
-                run_command,
-                args=[sign_command + [file_]],
-                kwargs={"cwd": dir_, "exception": IScriptError, "output_log_on_exception": True},
-                retry_exceptions=(IScriptError,),
-            )
+            plan.files.append(abs_file)
+
+    plan.libclearkey_path = get_libclearkey_path(contents_dir, app_path)
+    return plan
 
-    await sign_libclearkey(contents_dir, sign_command, app_path)
 
+async def _codesign(sign_command, path, semaphore):
+    """Sign ``path`` with ``sign_command``, once ``semaphore`` lets us."""
+    async with semaphore:
+        await retry_async(
+            run_command,
+            args=[sign_command + [os.path.basename(path)]],
+            kwargs={"cwd": os.path.dirname(path), "exception": IScriptError, "output_log_on_exception": True},
+            retry_exceptions=(IScriptError,),
+        )
+
+
+async def _sign_bundle(plan, sign_command, semaphore):
+    """Sign everything in ``plan``, as concurrently as its dependencies allow."""
+    futures = [asyncio.ensure_future(_codesign(sign_command, path, semaphore)) for path in plan.files]
+    futures.extend([asyncio.ensure_future(_sign_bundle(bundle, sign_command, semaphore)) for bundle in plan.bundles])
+    await raise_future_exceptions(futures)
+    if plan.libclearkey_path:
+        await _codesign(sign_command, plan.libclearkey_path, semaphore)
     # sign bundle
-    await retry_async(
-        run_command,
-        args=[sign_command + [app_name]],
-        kwargs={"cwd": parent_dir, "exception": IScriptError, "output_log_on_exception": True},
-        retry_exceptions=(IScriptError,),
-    )
+    await _codesign(sign_command, plan.app_path, semaphore)
+
 
+async def sign_app(key_config, app_path, entitlements_path, semaphore=None):
+    """Sign the .app.
 
-async def sign_libclearkey(contents_dir, sign_command, app_path):
-    """Sign libclearkey if it exists.
+    Largely taken from build-tools' ``dmg_signfile``. The files in the app
+    are signed concurrently, leaves first, then the nested bundles, then
+    ``libclearkey`` and the app itself.
+
+    Args:
+        key_config (dict): the running config
+        app_path (str): the path to the app to be signed (extracted)
+        entitlements_path (str): the path to the entitlements file for signing
+        semaphore (asyncio.Semaphore, optional): limits the concurrent
+            codesign calls, e.g. across apps. Defaults to a new semaphore
+            allowing ``codesign_concurrency_limit`` calls.
+
+    Raises:
+        IScriptError: on error.
+
+    """
+    parent_dir = os.path.dirname(app_path)
+    app_name = os.path.basename(app_path)
+    await run_command(["xattr", "-cr", app_name], cwd=parent_dir, exception=IScriptError)
+    identity = key_config["identity"]
+    keychain = key_config["signing_keychain"]
+    sign_command = _get_sign_command(identity, keychain)
+
+    if key_config.get("sign_with_entitlements", False):
+        sign_command.extend(["-o", "runtime", "--entitlements", entitlements_path])
+
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(key_config.get("codesign_concurrency_limit", DEFAULT_CODESIGN_CONCURRENCY_LIMIT))
+    plan = plan_app_signing(app_path)
+    log.info("Signing %s with %d codesign calls", app_path, len(plan.get_ordered_paths()))
+    await _sign_bundle(plan, sign_command, semaphore)
+
+
+def get_libclearkey_path(contents_dir, app_path):
+    """Return the path to libclearkey, if it needs signing.
 
     Special case Contents/Resources/gmp-clearkey/0.1/libclearkey.dylib
     which is living in the wrong place (bug 1100450), but isn't trivial to move.
@@ -279,23 +368,17 @@ async def sign_libclearkey(contents_dir, sign_command, app_path):
 
     Args:
         contents_dir (str): the ``Contents/`` directory path
-        sign_command (list): the command to sign with
         app_path (str): the path to the .app dir
 
-    Raises:
-        IScriptError: on failure
+    Returns:
+        str: the path to libclearkey, or ``""`` if there's nothing to sign
 
     """
     if "Contents/" not in app_path:
-        dir_ = os.path.join(contents_dir, "Resources/gmp-clearkey/0.1/")
-        file_ = "libclearkey.dylib"
-        if os.path.exists(os.path.join(dir_, file_)):
-            await retry_async(
-                run_command,
-                args=[sign_command + [file_]],
-                kwargs={"cwd": dir_, "exception": IScriptError, "output_log_on_exception": True},
-                retry_exceptions=(IScriptError,),
-            )
+        path = os.path.join(contents_dir, "Resources/gmp-clearkey/0.1/libclearkey.dylib")
+        if os.path.exists(path):
+            return path
+    return ""
 
 
 # verify_app_signature {{{1
@@ -435,11 +518,42 @@ def filter_apps(all_paths, fmt, inverted=False):
 
 
 # extract_all_apps {{{1
+async def extract_app(config, app, counter):
+    """Extract an app into its own directory.
+
+    Args:
+        config (dict): the running config
+        app (App): the app to extract, with its ``orig_path`` set
+        counter (int): the index of the app, used to name its ``parent_dir``
+
+    Raises:
+        IScriptError: on failure
+
+    """
+    work_dir = config["work_dir"]
+    app.check_required_attrs(["orig_path"])
+    app.parent_dir = os.path.join(work_dir, str(counter))
+    rm(app.parent_dir)
+    makedirs(app.parent_dir)
+    if app.orig_path.endswith((".tar.bz2", ".tar.gz", ".tgz")):
+        await run_command(["tar", "xf", app.orig_path], cwd=app.parent_dir, exception=IScriptError)
+    elif app.orig_path.endswith(".dmg"):
+        unpack_dmg = os.path.join(os.path.dirname(__file__), "data", "unpack-diskimage")
+        unpack_mountpoint = os.path.join("/tmp", f"{config.get('dmg_prefix', 'dmg')}-{counter}-unpack")
+        await run_command(
+            [unpack_dmg, app.orig_path, unpack_mountpoint, app.parent_dir], cwd=app.parent_dir, exception=IScriptError, log_level=logging.DEBUG
+        )
+        # nuke the softlink to /Applications
+        rm(os.path.join(app.parent_dir, " "))
+    else:
+        raise IScriptError(f"unknown file type {app.orig_path}")
+
+
 async def extract_all_apps(config, all_paths):
     """Extract all the apps into their own directories.
 
     Args:
-        work_dir (str): the ``work_dir`` path
+        config (dict): the running config
         all_paths (list): a list of ``App`` objects with their ``orig_path`` set
 
     Raises:
@@ -448,33 +562,11 @@ async def extract_all_apps(config, all_paths):
     """
     log.info("Extracting all apps")
     futures = []
-    work_dir = config["work_dir"]
-    unpack_dmg = os.path.join(os.path.dirname(__file__), "data", "unpack-diskimage")
     for counter, app in enumerate(all_paths):
         if "macapp_entitlements" in app.formats:
-            continue;
-        app.check_required_attrs(["orig_path"])
-        app.parent_dir = os.path.join(work_dir, str(counter))
-        rm(app.parent_dir)
-        makedirs(app.parent_dir)
-        if app.orig_path.endswith((".tar.bz2", ".tar.gz", ".tgz")):
-            futures.append(asyncio.ensure_future(run_command(["tar", "xf", app.orig_path], cwd=app.parent_dir, exception=IScriptError)))
-        elif app.orig_path.endswith(".dmg"):
-            unpack_mountpoint = os.path.join("/tmp", f"{config.get('dmg_prefix', 'dmg')}-{counter}-unpack")
-            futures.append(
-                asyncio.ensure_future(
-                    run_command(
-                        [unpack_dmg, app.orig_path, unpack_mountpoint, app.parent_dir], cwd=app.parent_dir, exception=IScriptError, log_level=logging.DEBUG
-                    )
-                )
-            )
-        else:
-            raise IScriptError(f"unknown file type {app.orig_path}")
+            continue
+        futures.append(asyncio.ensure_future(extract_app(config, app, counter)))
     await raise_future_exceptions(futures)
-    if app.orig_path.endswith(".dmg"):
-        # nuke the softlink to /Applications
-        for counter, app in enumerate(all_paths):
-            rm(os.path.join(app.parent_dir, " "))
 
 
 # create_all_notarization_zipfiles {{{1
@@ -490,17 +582,29 @@ async def create_all_notarization_zipfiles(all_paths, path_attrs):
 
     """
     futures = []
-    required_attrs = ["parent_dir"] + path_attrs
-    # zip up apps
     for app in all_paths:
-        app.check_required_attrs(required_attrs)
-        parent_base_name = os.path.basename(app.parent_dir)
-        app.zip_path = f"{app.parent_dir}-upload{parent_base_name}.zip"
-        paths = [os.path.relpath(getattr(app, this_attr), app.parent_dir) for this_attr in path_attrs]
-        futures.append(asyncio.ensure_future(run_command(["zip", "-r", app.zip_path] + paths, cwd=app.parent_dir, exception=IScriptError)))
+        futures.append(asyncio.ensure_future(create_notarization_zipfile(app, path_attrs)))
     await raise_future_exceptions(futures)
 
 
+async def create_notarization_zipfile(app, path_attrs):
+    """Create the notarization zipfile for one app, and set its ``zip_path``.
+
+    Args:
+        app (App): the app to zip
+        path_attrs (list): list of path attributes to zip
+
+    Raises:
+        IScriptError: on failure
+
+    """
+    app.check_required_attrs(["parent_dir"] + path_attrs)
+    parent_base_name = os.path.basename(app.parent_dir)
+    app.zip_path = f"{app.parent_dir}-upload{parent_base_name}.zip"
+    paths = [os.path.relpath(getattr(app, this_attr), app.parent_dir) for this_attr in path_attrs]
+    await run_command(["zip", "-r", app.zip_path] + paths, cwd=app.parent_dir, exception=IScriptError)
+
+
 # create_one_notarization_zipfile {{{1
 async def create_one_notarization_zipfile(work_dir, all_paths, path_attrs=("app_path", "pkg_path")):
     """Create a single notarization zipfile for all the apps.
@@ -529,6 +633,30 @@ async def create_one_notarization_zipfile(work_dir, all_paths, path_attrs=("app_
     return zip_path
 
 
+# keychain_unlocker {{{1
+def keychain_unlocker(key_config):
+    """Return a coroutine function that unlocks the signing keychain.
+
+    Apps reach codesigning at different times, so each one unlocks the
+    keychain again first. The lock keeps the unlock commands from running
+    concurrently.
+
+    Args:
+        key_config (dict): the config for this signing key
+
+    Returns:
+        callable: the coroutine function to await before codesigning
+
+    """
+    lock = asyncio.Lock()
+
+    async def unlock():
+        async with lock:
+            await unlock_keychain(key_config["signing_keychain"], key_config["keychain_password"])
+
+    return unlock
+
+
 # sign_all_apps {{{1
 async def sign_all_apps(config, key_config, entitlements_path, all_paths):
     """Sign all the apps.
@@ -545,33 +673,47 @@ async def sign_all_apps(config, key_config, entitlements_path, all_paths):
 
     """
     log.info("Signing all apps")
-    for app in all_paths:
-        set_app_path_and_name(app)
-    # sign omni.ja
-    futures = []
-    for app in all_paths:
-        if {"autograph_omnija", "omnija"} & set(app.formats):
-            futures.append(asyncio.ensure_future(sign_omnija_with_autograph(config, key_config, app.app_path)))
-    await raise_future_exceptions(futures)
-    # sign widevine
+    unlock = keychain_unlocker(key_config)
+    # sign apps concurrently, sharing the codesign concurrency limit
+    semaphore = asyncio.Semaphore(key_config.get("codesign_concurrency_limit", DEFAULT_CODESIGN_CONCURRENCY_LIMIT))
+    codesign = partial(sign_app, key_config, entitlements_path=entitlements_path, semaphore=semaphore)
     futures = []
     for app in all_paths:
-        if {"autograph_widevine", "widevine"} & set(app.formats):
-            futures.append(asyncio.ensure_future(sign_widevine_dir(config, key_config, app.app_path)))
-    await raise_future_exceptions(futures)
-    await unlock_keychain(key_config["signing_keychain"], key_config["keychain_password"])
-    futures = []
-    # sign apps concurrently
-    for app in all_paths:
-        futures.append(asyncio.ensure_future(sign_app(key_config, app.app_path, entitlements_path)))
-    await raise_future_exceptions(futures)
-    # verify signatures
-    futures = []
-    for app in all_paths:
-        futures.append(asyncio.ensure_future(verify_app_signature(key_config, app)))
+        futures.append(asyncio.ensure_future(sign_one_app(config, key_config, app, codesign, unlock)))
     await raise_future_exceptions(futures)
 
 
+# sign_one_app {{{1
+async def sign_one_app(config, key_config, app, codesign, unlock):
+    """Sign an app's omni.ja and widevine files, then the app itself.
+
+    Each app goes on to codesigning as soon as its own autograph signing is
+    done, rather than waiting for every other app's. The keychain is unlocked
+    right before codesigning, since the autograph calls may take long enough
+    for it to lock again.
+
+    Args:
+        config (dict): the running config
+        key_config (dict): the config for this signing key
+        app (App): the extracted app to sign
+        codesign (callable): the coroutine function that codesigns an app path
+        unlock (callable): the coroutine function that unlocks the signing
+            keychain
+
+    Raises:
+        IScriptError: on failure
+
+    """
+    set_app_path_and_name(app)
+    if {"autograph_omnija", "omnija"} & set(app.formats):
+        await sign_omnija_with_autograph(config, key_config, app.app_path)
+    if {"autograph_widevine", "widevine"} & set(app.formats):
+        await sign_widevine_dir(config, key_config, app.app_path)
+    await unlock()
+    await codesign(app.app_path)
+    await verify_app_signature(key_config, app)
+
+
 # sign_all_apps_with_map {{{1
 async def sign_all_apps_with_map(config, key_config, map_file_inner_path, all_paths):
     """Sign all the apps using a map file.
@@ -588,19 +730,48 @@ async def sign_all_apps_with_map(config, key_config, map_file_inner_path, all_pa
 
     """
     log.info("Signing all apps using map file {}".format(map_file_inner_path))
+    # keep temp_dir referenced until we're done signing; it's deleted when
+    # it's garbage collected
+    temp_dir, map_path = extract_entitlements_artifact(map_file_inner_path, all_paths)
+    # remove the entitlements app entry from the all_paths list
+    signable_paths = filter_apps(all_paths, fmt="macapp_entitlements", inverted=True)
+    unlock = keychain_unlocker(key_config)
+    # sign apps concurrently, sharing the codesign concurrency limit
+    semaphore = asyncio.Semaphore(key_config.get("codesign_concurrency_limit", DEFAULT_CODESIGN_CONCURRENCY_LIMIT))
+    codesign = partial(sign_app_with_map, key_config, artifact_dir=temp_dir.name, map_file=map_path, semaphore=semaphore)
+    futures = []
+    for app in signable_paths:
+        futures.append(asyncio.ensure_future(sign_one_app(config, key_config, app, codesign, unlock)))
+    await raise_future_exceptions(futures)
 
+
+# extract_entitlements_artifact {{{1
+def extract_entitlements_artifact(map_file_inner_path, all_paths):
+    """Unzip the ``macapp_entitlements`` artifact that holds the map file.
+
+    Args:
+        map_file_inner_path (str): the path of the map file within the build artifact
+            zip file. That is, relative to the root of the unzipped zip file.
+        all_paths (list): the list of ``App`` objects, including the
+            ``macapp_entitlements`` one
+
+    Raises:
+        IScriptError: on failure
+
+    Returns:
+        tuple: the ``tempfile.TemporaryDirectory`` the artifact is unzipped
+            to, and the path to the map file inside it
+
+    """
     # get the entitlements zip path
     entitlement_zip_path = None
     for app in all_paths:
         if is_macapp_entitlements(app):
             entitlement_zip_path = app.orig_path
-            break;
+            break
     if entitlement_zip_path is None:
         raise IScriptError("Entitlements artifact App missing from all_paths")
 
-    # remove the entitlements app entry from the all_paths list
-    signable_paths = filter_apps(all_paths, fmt="macapp_entitlements", inverted=True)
-
     log.debug("Entitlements artifact path: {}".format(entitlement_zip_path))
     if not os.path.exists(entitlement_zip_path):
         raise IScriptError("Entitlements artifact {} does not exist".format(entitlement_zip_path))
@@ -628,37 +799,11 @@ async def sign_all_apps_with_map(config, key_config, map_file_inner_path, all_pa
     map_path = "{}/{}".format(temp_dir.name, map_file_inner_path)
     if not os.path.exists(map_path):
         raise IScriptError("Map file {} does not exist".format(map_path))
-
-    for app in signable_paths:
-        set_app_path_and_name(app)
-
-    # sign omni.ja
-    futures = []
-    for app in signable_paths:
-        if {"autograph_omnija", "omnija"} & set(app.formats):
-            futures.append(asyncio.ensure_future(sign_omnija_with_autograph(config, key_config, app.app_path)))
-    await raise_future_exceptions(futures)
-    # sign widevine
-    futures = []
-    for app in signable_paths:
-        if {"autograph_widevine", "widevine"} & set(app.formats):
-            futures.append(asyncio.ensure_future(sign_widevine_dir(config, key_config, app.app_path)))
-    await raise_future_exceptions(futures)
-    await unlock_keychain(key_config["signing_keychain"], key_config["keychain_password"])
-    futures = []
-    # sign apps concurrently
-    for app in signable_paths:
-        futures.append(asyncio.ensure_future(sign_app_with_map(key_config, app.app_path, temp_dir.name, map_path)))
-    await raise_future_exceptions(futures)
-    # verify signatures
-    futures = []
-    for app in signable_paths:
-        futures.append(asyncio.ensure_future(verify_app_signature(key_config, app)))
-    await raise_future_exceptions(futures)
+    return temp_dir, map_path
 
 
 # sign_app_with_map {{{1
-async def sign_app_with_map(key_config, app_path, artifact_dir, map_file):
+async def sign_app_with_map(key_config, app_path, artifact_dir, map_file, semaphore=None):
     """Sign the .app as specified in the map_file argument.
 
     Args:
@@ -666,6 +811,9 @@ async def sign_app_with_map(key_config, app_path, artifact_dir, map_file):
         app_path (str): the path to the app to be signed (extracted)
         artifact_dir (str): the path to the unzipped codesign artifact directory
         map_file (str): the name of the map file within the codesign artifact
+        semaphore (asyncio.Semaphore, optional): limits the concurrent
+            codesign calls, e.g. across apps. Defaults to a new semaphore
+            allowing ``codesign_concurrency_limit`` calls.
 
     Raises:
         IScriptError: on error.
@@ -675,7 +823,9 @@ async def sign_app_with_map(key_config, app_path, artifact_dir, map_file):
             "sign" : key_config["identity"],
             "keychain" : key_config["signing_keychain"]
             }
-    if not codesigntree(map_file, app_path, artifact_dir, params, False, True, log):
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(key_config.get("codesign_concurrency_limit", DEFAULT_CODESIGN_CONCURRENCY_LIMIT))
+    if not await codesigntree(map_file, app_path, artifact_dir, params, False, True, log, semaphore=semaphore):
         raise IScriptError("Codesign of {} failed. Map file: {}, artifact_dir: {}".format(app_path,
             map_file, artifact_dir))
 
@@ -735,35 +885,204 @@ def get_uuid_from_log(log_path):
     raise IScriptError("Can't find UUID in {}!".format(log_path))
 
 
-# get_notarization_status_from_log {{{1
-def get_notarization_status_from_log(log_path):
-    """Get the status from the notarization log.
+# get_notarization_status {{{1
+def get_notarization_status(contents):
+    """Get the status from ``altool --notarization-info`` output.
 
     Args:
-        log_path (str): the path to the log file to parse
+        contents (str): the output to parse
 
     Returns:
         str: either ``success`` or ``invalid``, depending on status
         None: if we have neither success nor invalid status
 
     """
-    regex = re.compile(r"Status: (?P<status>success|invalid)")
+    m = NOTARIZATION_STATUS_REGEX.search(contents)
+    if m is not None:
+        return m["status"]
+
+
+# get_notarization_history_statuses {{{1
+def get_notarization_history_statuses(contents):
+    """Get the status of each submission from ``altool --notarization-history`` output.
+
+    Args:
+        contents (str): the output to parse
+
+    Returns:
+        dict: uuid to ``success``, ``invalid``, or None if it's still in progress
+
+    """
+    statuses = {}
+    for m in NOTARIZATION_HISTORY_REGEX.finditer(contents):
+        statuses[m["uuid"]] = m["status"] if m["status"] in ("success", "invalid") else None
+    return statuses
+
+
+# get_altool_output {{{1
+async def get_altool_output(cmd, log_cmd):
+    """Run an ``altool`` command and return its output, without a log file.
+
+    Args:
+        cmd (list): the command to run
+        log_cmd (list): the command to log, without the password
+
+    Raises:
+        IScriptError: on a non-zero exit code
+
+    Returns:
+        str: the combined stdout and stderr. It's only logged at info level
+            if the command fails.
+
+    """
+    log.info("Running %s ...", log_cmd)
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
     try:
-        with open(log_path, "r") as fh:
-            contents = fh.read()
-        m = regex.search(contents)
-        if m is not None:
-            return m["status"]
-    except OSError:
-        pass
+        stdout, _ = await proc.communicate()
+    except asyncio.CancelledError:
+        # Don't leave the query running when the poller is stopped
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    output = stdout.decode("utf-8", "replace")
+    if proc.returncode != 0:
+        log.info(output)
+        raise IScriptError(f"{log_cmd} exited {proc.returncode}:\n{output}")
+    log.debug(output)
+    return output
 
 
 # wrap_notarization_with_sudo {{{1
+async def _notarize_with_sudo(key_config, account, app, counter, path_attr):
+    """Create a notarization request for a single app, as ``account``.
+
+    The response is written to ``app.notarization_log_path``.
+
+    Args:
+        key_config (dict): the config for this signing key
+        account (str): the local account to sudo to
+        app (App): the app to notarize
+        counter (int): the index of the app, to make its bundle id unique
+        path_attr (str): the attribute that the zip path is under
+
+    Raises:
+        IScriptError: on failure
+
+    """
+    app.notarization_log_path = f"{app.parent_dir}-notarization.log"
+    bundle_id = get_bundle_id(key_config["base_bundle_id"], counter=str(counter))
+    zip_path = getattr(app, path_attr)
+    base_cmdln = " ".join(
+        [
+            "xcrun",
+            "altool",
+            "--notarize-app",
+            "-f",
+            zip_path,
+            "--primary-bundle-id",
+            '"{}"'.format(bundle_id),
+            "-u",
+            key_config["apple_notarization_account"],
+            "--asc-provider",
+            key_config["apple_asc_provider"],
+            "--password",
+        ]
+    )
+    cmd = ["sudo", "su", account, "-c", base_cmdln + " {}".format(shlex.quote(key_config["apple_notarization_password"]))]
+    log_cmd = ["sudo", "su", account, "-c", base_cmdln + " ********"]
+    await retry_async(
+        run_command,
+        args=[cmd],
+        kwargs={"log_path": app.notarization_log_path, "log_cmd": log_cmd, "exception": IScriptError},
+        retry_exceptions=(IScriptError,),
+        attempts=10,
+    )
+
+
+class NotarizationAccounts(object):
+    """The local accounts that notarization requests are sudoed to.
+
+    Apple creates a lockfile per user for notarization, so each account
+    uploads one app at a time, and takes the next app as soon as it's free.
+    Once an upload fails, no more are started.
+
+    Attributes:
+        free (asyncio.Queue): the accounts that aren't uploading
+        stats (dict): account to its ``zips``, ``bytes`` and ``seconds`` uploaded
+        stopped (bool): whether to stop starting uploads
+
+    """
+
+    def __init__(self, accounts):
+        """Initialize NotarizationAccounts."""
+        self.free = asyncio.Queue()
+        for account in accounts:
+            self.free.put_nowait(account)
+        self.stats = {account: {"zips": 0, "bytes": 0, "seconds": 0.0} for account in accounts}
+        self.stopped = False
+
+    def stop(self):
+        """Don't start any more uploads. The ones in progress carry on."""
+        self.stopped = True
+
+    async def notarize(self, key_config, app, counter, path_attr):
+        """Create a notarization request for ``app`` as the next free account.
+
+        Args:
+            key_config (dict): the config for this signing key
+            app (App): the app to notarize
+            counter (int): the index of the app, to make its bundle id unique
+            path_attr (str): the attribute that the zip path is under
+
+        Raises:
+            IScriptError: on failure, or if we've stopped
+
+        """
+        account = await self.free.get()
+        try:
+            if self.stopped:
+                raise IScriptError("Not notarizing {}: the task is going to fail".format(getattr(app, path_attr)))
+            start = time.monotonic()
+            try:
+                await _notarize_with_sudo(key_config, account, app, counter, path_attr)
+            except Exception:
+                # Don't start any more uploads; the task is going to fail.
+                self.stop()
+                raise
+        finally:
+            self.free.put_nowait(account)
+        seconds = time.monotonic() - start
+        log.info("Notarization account %s uploaded %s in %.1fs", account, getattr(app, path_attr), seconds)
+        stats = self.stats[account]
+        stats["zips"] += 1
+        stats["seconds"] += seconds
+        try:
+            stats["bytes"] += os.path.getsize(getattr(app, path_attr))
+        except OSError:
+            pass
+
+    def log_stats(self):
+        """Log how much each account uploaded, and how fast."""
+        for account, stats in self.stats.items():
+            megabytes = stats["bytes"] / 1024 / 1024
+            log.info(
+                "Notarization account %s uploaded %d zips, %.1f MB in %.1fs (%.2f MB/s)",
+                account,
+                stats["zips"],
+                megabytes,
+                stats["seconds"],
+                megabytes / stats["seconds"] if stats["seconds"] else 0,
+            )
+
+
 async def wrap_notarization_with_sudo(config, key_config, all_paths, path_attr="zip_path"):
     """Wrap the notarization requests with sudo.
 
     Apple creates a lockfile per user for notarization. To notarize concurrently,
     we use sudo against a set of accounts (``config['local_notarization_accounts']``).
+    Each account takes the next app as soon as its previous upload is done,
+    so one slow upload doesn't hold up the others.
 
     Args:
         config (dict): the running config
@@ -779,62 +1098,42 @@ async def wrap_notarization_with_sudo(config, key_config, all_paths, path_attr="
         dict: uuid to log path
 
     """
-    futures = []
-    accounts = config["local_notarization_accounts"]
-    counter = 0
-    uuids = {}
+    accounts = NotarizationAccounts(config["local_notarization_accounts"])
 
     for app in all_paths:
         app.check_required_attrs([path_attr, "parent_dir"])
 
-    while counter < len(all_paths):
-        futures = []
-        for account in accounts:
-            app = all_paths[counter]
-            app.notarization_log_path = f"{app.parent_dir}-notarization.log"
-            bundle_id = get_bundle_id(key_config["base_bundle_id"], counter=str(counter))
-            zip_path = getattr(app, path_attr)
-            # XXX potentially run the notarization + get_uuid_from_log in a
-            #     helper function per app, so we can retry them individually on
-            #     error. That would also let us record the path per UUID,
-            #     should we need that complexity later.
-            #     Not doing that now, so notarization errors are more visible.
-            base_cmdln = " ".join(
-                [
-                    "xcrun",
-                    "altool",
-                    "--notarize-app",
-                    "-f",
-                    zip_path,
-                    "--primary-bundle-id",
-                    '"{}"'.format(bundle_id),
-                    "-u",
-                    key_config["apple_notarization_account"],
-                    "--asc-provider",
-                    key_config["apple_asc_provider"],
-                    "--password",
-                ]
-            )
-            cmd = ["sudo", "su", account, "-c", base_cmdln + " {}".format(shlex.quote(key_config["apple_notarization_password"]))]
-            log_cmd = ["sudo", "su", account, "-c", base_cmdln + " ********"]
-            futures.append(
-                asyncio.ensure_future(
-                    retry_async(
-                        run_command,
-                        args=[cmd],
-                        kwargs={"log_path": app.notarization_log_path, "log_cmd": log_cmd, "exception": IScriptError},
-                        retry_exceptions=(IScriptError,),
-                        attempts=10,
-                    )
-                )
-            )
-            counter += 1
-            if counter >= len(all_paths):
-                break
-        await raise_future_exceptions(futures)
-    for app in all_paths:
-        uuids[get_uuid_from_log(app.notarization_log_path)] = app.notarization_log_path
-    return uuids
+    futures = []
+    for counter, app in enumerate(all_paths):
+        futures.append(asyncio.ensure_future(notarize_app_with_sudo(key_config, accounts, app, counter, path_attr)))
+    try:
+        uuids = await raise_future_exceptions(futures)
+    finally:
+        accounts.log_stats()
+    return {uuid: app.notarization_log_path for uuid, app in zip(uuids, all_paths)}
+
+
+async def notarize_app_with_sudo(key_config, accounts, app, counter, path_attr="zip_path"):
+    """Submit one app for notarization as the next free local account.
+
+    Args:
+        key_config (dict): the config for this signing key
+        accounts (NotarizationAccounts): the ``local_notarization_accounts``
+        app (App): the app to notarize
+        counter (int): the index of the app, to make its bundle id unique
+        path_attr (str, optional): the attribute that the zip path is under.
+            Defaults to ``zip_path``
+
+    Raises:
+        IScriptError: on failure
+
+    Returns:
+        str: the notarization uuid
+
+    """
+    app.check_required_attrs([path_attr, "parent_dir"])
+    await accounts.notarize(key_config, app, counter, path_attr)
+    return get_uuid_from_log(app.notarization_log_path)
 
 
 # notarize_no_sudo {{{1
@@ -874,43 +1173,167 @@ async def notarize_no_sudo(work_dir, key_config, zip_path):
     return uuids
 
 
-# poll_notarization_uuid {{{1
-async def poll_notarization_uuid(uuid, username, password, timeout, log_path, sleep_time=15):
-    """Poll to see if the notarization for ``uuid`` is complete.
+# NotarizationPoller {{{1
+class NotarizationPoller(object):
+    """Poll Apple for the notarization status of every outstanding UUID.
 
-    Args:
-        uuid (str): the uuid to poll for
+    One poller owns all of a task's UUIDs. Each UUID is polled rarely while
+    Apple is unlikely to be done with it, often around the typical
+    turnaround, and less often again once it's running late. At most
+    ``notarization_poll_concurrency`` status queries run at once. When more
+    than one UUID is due, a single ``--notarization-history`` query reports
+    the recent submissions first; only the UUIDs it doesn't cover are
+    queried one at a time.
+
+    Attributes:
         username (str): the apple user to poll with
         password (str): the apple password to poll with
-        timeout (int): the maximum wait time
-        sleep_time (int): the time to sleep between polling
-
-    Raises:
-        TimeoutError: on timeout
-        InvalidNotarization: if the notarization fails with ``invalid``
-        IScriptError: on unexpected failure
+        timeout (int): the maximum wait time per UUID, from its submission
+        turnaround (int): the typical time Apple takes to notarize, in seconds
+        semaphore (asyncio.Semaphore): limits the concurrent status queries
+        pending (dict): uuid to its future, submission and next poll times
 
     """
-    start = arrow.utcnow().timestamp
-    timeout_time = start + timeout
-    base_cmd = ["xcrun", "altool", "--notarization-info", uuid, "-u", username, "--password"]
-    log_cmd = base_cmd + ["********"]
-    while 1:
-        await retry_async(
-            run_command,
-            args=[base_cmd + [password]],
-            kwargs={"log_path": log_path, "log_cmd": log_cmd, "exception": IScriptError},
-            retry_exceptions=(IScriptError,),
-            attempts=10,
-        )
-        status = get_notarization_status_from_log(log_path)
-        if status == "success":
-            break
+
+    # The bounds on the time between polls of a UUID, in seconds
+    MIN_POLL_INTERVAL = 15
+    MAX_POLL_INTERVAL = 120
+
+    def __init__(self, key_config):
+        """Initialize NotarizationPoller."""
+        self.username = key_config["apple_notarization_account"]
+        self.password = key_config["apple_notarization_password"]
+        self.timeout = key_config["notarization_poll_timeout"]
+        self.turnaround = key_config.get("notarization_typical_turnaround", 300)
+        self.semaphore = asyncio.Semaphore(key_config.get("notarization_poll_concurrency", 4))
+        self.pending = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def get_poll_interval(self, elapsed):
+        """Return how long to wait before polling a UUID that was submitted ``elapsed`` seconds ago.
+
+        The first poll is at half the typical turnaround, even if that's
+        longer than ``MAX_POLL_INTERVAL``.
+
+        """
+        if elapsed < self.turnaround / 2:
+            return max(self.MIN_POLL_INTERVAL, self.turnaround / 2 - elapsed)
+        if elapsed < self.turnaround * 2:
+            interval = self.MIN_POLL_INTERVAL
+        else:
+            interval = self.MIN_POLL_INTERVAL * elapsed / max(self.turnaround, 1)
+        return max(self.MIN_POLL_INTERVAL, min(self.MAX_POLL_INTERVAL, interval))
+
+    def add(self, uuid, submitted=None):
+        """Start polling for ``uuid``.
+
+        Args:
+            uuid (str): the uuid to poll for
+            submitted (float, optional): the ``time.monotonic()`` when ``uuid``
+                was submitted. Defaults to now.
+
+        Returns:
+            asyncio.Future: resolves when ``uuid`` is notarized, or raises
+                ``InvalidNotarization``, ``TimeoutError`` or ``IScriptError``
+
+        """
+        now = time.monotonic()
+        submitted = now if submitted is None else submitted
+        future = asyncio.get_event_loop().create_future()
+        self.pending[uuid] = {"future": future, "submitted": submitted, "next_poll": submitted}
+        self._schedule(uuid, now)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        self._wakeup.set()
+        return future
+
+    async def stop(self):
+        """Stop polling, and cancel the futures of any outstanding uuids.
+
+        This waits for any status query in progress to be cancelled.
+
+        """
+        for uuid in list(self.pending):
+            self.pending.pop(uuid)["future"].cancel()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def _schedule(self, uuid, now):
+        info = self.pending[uuid]
+        deadline = info["submitted"] + self.timeout
+        info["next_poll"] = min(now + self.get_poll_interval(now - info["submitted"]), max(deadline, now))
+
+    def _finish(self, uuid, exception=None):
+        future = self.pending.pop(uuid)["future"]
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(None)
+
+    async def _run(self):
+        try:
+            while self.pending:
+                now = time.monotonic()
+                due = sorted(uuid for uuid, info in self.pending.items() if info["next_poll"] <= now)
+                if due:
+                    await self._poll(due)
+                    continue
+                self._wakeup.clear()
+                next_poll = min(info["next_poll"] for info in self.pending.values())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), next_poll - now)
+                except asyncio.TimeoutError:
+                    pass
+        except Exception as exc:
+            # Nothing awaits this task; fail the futures instead.
+            for uuid in list(self.pending):
+                self._finish(uuid, exception=exc)
+
+    async def _query(self, base_cmd):
+        log_cmd = base_cmd + ["********"]
+        async with self.semaphore:
+            return await retry_async(
+                get_altool_output, args=[base_cmd + [self.password], log_cmd], retry_exceptions=(IScriptError,), attempts=10
+            )
+
+    async def _query_info(self, uuid):
+        output = await self._query(["xcrun", "altool", "--notarization-info", uuid, "-u", self.username, "--password"])
+        status = get_notarization_status(output)
         if status == "invalid":
-            raise InvalidNotarization("Invalid notarization for uuid {}!".format(uuid))
-        await asyncio.sleep(sleep_time)
-        if arrow.utcnow().timestamp > timeout_time:
-            raise TimeoutError("Timed out polling for uuid {}!".format(uuid))
+            # This includes the LogFileURL explaining why
+            log.info("Notarization info for UUID %s:\n%s", uuid, output)
+        return status
+
+    async def _poll(self, due):
+        statuses = {}
+        if len(due) > 1:
+            try:
+                output = await self._query(["xcrun", "altool", "--notarization-history", "0", "-u", self.username, "--password"])
+                statuses = get_notarization_history_statuses(output)
+            except IScriptError as exc:
+                log.warning("Can't get the notarization history; polling each UUID instead: %s", exc)
+        # The history doesn't say why a UUID is invalid, so query those too
+        unknown = [uuid for uuid in due if uuid not in statuses or statuses[uuid] == "invalid"]
+        results = await asyncio.gather(*[self._query_info(uuid) for uuid in unknown], return_exceptions=True)
+        statuses.update(zip(unknown, results))
+        now = time.monotonic()
+        for uuid in due:
+            status = statuses[uuid]
+            if isinstance(status, Exception):
+                self._finish(uuid, exception=status)
+            elif status == "success":
+                log.info("UUID %s is notarized after %.0fs", uuid, now - self.pending[uuid]["submitted"])
+                self._finish(uuid)
+            elif status == "invalid":
+                self._finish(uuid, exception=InvalidNotarization("Invalid notarization for uuid {}!".format(uuid)))
+            elif now >= self.pending[uuid]["submitted"] + self.timeout:
+                self._finish(uuid, exception=TimeoutError("Timed out polling for uuid {}!".format(uuid)))
+            else:
+                self._schedule(uuid, now)
 
 
 # poll_all_notarization_status {{{1
@@ -926,22 +1349,8 @@ async def poll_all_notarization_status(key_config, poll_uuids):
 
     """
     log.info("Polling for notarization status")
-    futures = []
-    # We're going to overwrite the original notification log here.
-    # If we want to preserve the logs, we should change this path
-    for uuid, log_path in poll_uuids.items():
-        futures.append(
-            asyncio.ensure_future(
-                poll_notarization_uuid(
-                    uuid,
-                    key_config["apple_notarization_account"],
-                    key_config["apple_notarization_password"],
-                    key_config["notarization_poll_timeout"],
-                    log_path,
-                    sleep_time=15,
-                )
-            )
-        )
+    poller = NotarizationPoller(key_config)
+    futures = [poller.add(uuid) for uuid in poll_uuids]
     await raise_future_exceptions(futures)
 
 
@@ -961,23 +1370,34 @@ async def staple_notarization(all_paths, path_attr="app_path"):
     log.info("Stapling apps")
     futures = []
     for app in all_paths:
-        app.check_required_attrs([path_attr])
-        cwd = os.path.dirname(getattr(app, path_attr))
-        path = os.path.basename(getattr(app, path_attr))
-        futures.append(
-            asyncio.ensure_future(
-                retry_async(
-                    run_command,
-                    args=[["xcrun", "stapler", "staple", path]],
-                    kwargs={"cwd": cwd, "exception": IScriptError, "log_level": logging.DEBUG},
-                    retry_exceptions=(IScriptError,),
-                    attempts=10,
-                )
-            )
-        )
+        futures.append(asyncio.ensure_future(staple_app_notarization(app, path_attr=path_attr)))
     await raise_future_exceptions(futures)
 
 
+async def staple_app_notarization(app, path_attr="app_path"):
+    """Staple the notarization result to one app.
+
+    Args:
+        app (App): the app to staple
+        path_attr (str, optional): the path attribute to staple. Defaults to
+            ``app_path``
+
+    Raises:
+        IScriptError: on failure
+
+    """
+    app.check_required_attrs([path_attr])
+    cwd = os.path.dirname(getattr(app, path_attr))
+    path = os.path.basename(getattr(app, path_attr))
+    await retry_async(
+        run_command,
+        args=[["xcrun", "stapler", "staple", path]],
+        kwargs={"cwd": cwd, "exception": IScriptError, "log_level": logging.DEBUG},
+        retry_exceptions=(IScriptError,),
+        attempts=10,
+    )
+
+
 # tar_apps {{{1
 async def tar_apps(config, all_paths):
     """Create tar artifacts from the app directories.
@@ -995,31 +1415,40 @@ async def tar_apps(config, all_paths):
     log.info("Tarring up artifacts")
     futures = []
     for app in all_paths:
-        app.check_required_attrs(["orig_path", "parent_dir", "app_path", "artifact_prefix"])
-        # If we downloaded public/build/locale/target.tar.gz, then write to
-        # artifact_dir/public/build/locale/target.tar.gz
-        app.target_tar_path = "{}/{}{}".format(config["artifact_dir"], app.artifact_prefix, app.orig_path.split(app.artifact_prefix)[1]).replace(
-            ".dmg", ".tar.gz"
-        )
-        makedirs(os.path.dirname(app.target_tar_path))
-        cwd = os.path.dirname(app.app_path)
-        env = deepcopy(os.environ)
-        # https://superuser.com/questions/61185/why-do-i-get-files-like-foo-in-my-tarball-on-os-x
-        env["COPYFILE_DISABLE"] = "1"
-        futures.append(
-            asyncio.ensure_future(
-                run_command(
-                    ["tar", _get_tar_create_options(app.target_tar_path), app.target_tar_path]
-                    + [f for f in os.listdir(cwd) if f != "[]" and not f.endswith(".pkg")],
-                    cwd=cwd,
-                    env=env,
-                    exception=IScriptError,
-                )
-            )
-        )
+        futures.append(asyncio.ensure_future(tar_app(config, app)))
     await raise_future_exceptions(futures)
 
 
+async def tar_app(config, app):
+    """Create the tar artifact for one app, and set its ``target_tar_path``.
+
+    Args:
+        config (dict): the running config
+        app (App): the App to tar up
+
+    Raises:
+        IScriptError: on failure
+
+    """
+    app.check_required_attrs(["orig_path", "parent_dir", "app_path", "artifact_prefix"])
+    # If we downloaded public/build/locale/target.tar.gz, then write to
+    # artifact_dir/public/build/locale/target.tar.gz
+    tar_path = "{}/{}{}".format(config["artifact_dir"], app.artifact_prefix, app.orig_path.split(app.artifact_prefix)[1])
+    app.target_tar_path = tar_path.replace(".dmg", ".tar.gz")
+    makedirs(os.path.dirname(app.target_tar_path))
+    cwd = os.path.dirname(app.app_path)
+    env = deepcopy(os.environ)
+    # https://superuser.com/questions/61185/why-do-i-get-files-like-foo-in-my-tarball-on-os-x
+    env["COPYFILE_DISABLE"] = "1"
+    files = [f for f in os.listdir(cwd) if f != "[]" and not f.endswith(".pkg")]
+    await run_command(
+        ["tar", _get_tar_create_options(app.target_tar_path), app.target_tar_path] + files,
+        cwd=cwd,
+        env=env,
+        exception=IScriptError,
+    )
+
+
 # create_pkg_files {{{1
 async def create_pkg_files(config, key_config, all_paths):
     """Create .pkg installers from the .app files.
@@ -1036,38 +1465,37 @@ async def create_pkg_files(config, key_config, all_paths):
     futures = []
     semaphore = asyncio.Semaphore(config.get("concurrency_limit", 2))
     for app in all_paths:
-        # call set_app_path_and_name because we may not have called sign_app() earlier
-        set_app_path_and_name(app)
-        app.pkg_path = app.app_path.replace(".app", ".pkg")
-        app.pkg_name = os.path.basename(app.pkg_path)
-        pkg_opts = []
-        if key_config.get("pkg_cert_id"):
-            pkg_opts = ["--sign", key_config["pkg_cert_id"]]
-        futures.append(
-            asyncio.ensure_future(
-                semaphore_wrapper(
-                    semaphore,
-                    run_command(
-                        [
-                            "pkgbuild",
-                            "--keychain",
-                            key_config["signing_keychain"],
-                            "--install-location",
-                            "/Applications",
-                            "--component",
-                            app.app_path,
-                            app.pkg_path,
-                        ]
-                        + pkg_opts,
-                        cwd=app.parent_dir,
-                        exception=IScriptError,
-                    ),
-                )
-            )
-        )
+        futures.append(asyncio.ensure_future(semaphore_wrapper(semaphore, create_pkg_file(key_config, app))))
     await raise_future_exceptions(futures)
 
 
+async def create_pkg_file(key_config, app):
+    """Create the .pkg installer for one app, and set its ``pkg_path``.
+
+    Args:
+        key_config (dict): the running config for this key
+        app (App): the App to pkg
+
+    Raises:
+        IScriptError: on failure
+
+    """
+    # call set_app_path_and_name because we may not have called sign_app() earlier
+    set_app_path_and_name(app)
+    app.pkg_path = app.app_path.replace(".app", ".pkg")
+    app.pkg_name = os.path.basename(app.pkg_path)
+    pkg_opts = []
+    if key_config.get("pkg_cert_id"):
+        pkg_opts = ["--sign", key_config["pkg_cert_id"]]
+    await run_command(
+        ["pkgbuild", "--keychain", key_config["signing_keychain"], "--install-location", "/Applications"]
+        + ["--component", app.app_path, app.pkg_path]
+        + pkg_opts,
+        cwd=app.parent_dir,
+        exception=IScriptError,
+    )
+
+
 # copy_pkgs_to_artifact_dir {{{1
 async def copy_pkgs_to_artifact_dir(config, all_paths):
     """Copy the pkg files to the artifact directory.
@@ -1079,13 +1507,24 @@ async def copy_pkgs_to_artifact_dir(config, all_paths):
     """
     log.info("Copying pkgs to the artifact dir")
     for app in all_paths:
-        app.check_required_attrs(["orig_path", "pkg_path", "artifact_prefix"])
-        app.target_pkg_path = _get_pkg_name_from_tarball(
-            "{}/{}{}".format(config["artifact_dir"], app.artifact_prefix, app.orig_path.split(app.artifact_prefix)[1])
-        )
-        makedirs(os.path.dirname(app.target_pkg_path))
-        log.debug("Copying %s to %s", app.pkg_path, app.target_pkg_path)
-        copy2(app.pkg_path, app.target_pkg_path)
+        await copy_pkg_to_artifact_dir(config, app)
+
+
+async def copy_pkg_to_artifact_dir(config, app):
+    """Copy one app's pkg file to the artifact directory.
+
+    Args:
+        config (dict): the running config
+        app (App): the App whose pkg to copy
+
+    """
+    app.check_required_attrs(["orig_path", "pkg_path", "artifact_prefix"])
+    app.target_pkg_path = _get_pkg_name_from_tarball(
+        "{}/{}{}".format(config["artifact_dir"], app.artifact_prefix, app.orig_path.split(app.artifact_prefix)[1])
+    )
+    makedirs(os.path.dirname(app.target_pkg_path))
+    log.debug("Copying %s to %s", app.pkg_path, app.target_pkg_path)
+    copy2(app.pkg_path, app.target_pkg_path)
 
 
 # copy_xpis_to_artifact_dir {{{1
@@ -1156,6 +1595,158 @@ def get_map_artifact_relative_path(config, key_config, task):
     return
 
 
+# AppPipeline {{{1
+class AppPipeline(object):
+    """Move each ``App`` through signing, packaging and notarization on its own.
+
+    Rather than running each step for every app before starting the next
+    step, each app starts its next step as soon as its own previous step is
+    done. The limits are per step: ``codesign_concurrency_limit`` codesign
+    calls, ``concurrency_limit`` pkgbuild, zip, staple and tar calls each, one
+    notarization upload per local notarization account, and
+    ``notarization_poll_concurrency`` status queries.
+
+    Once an app fails, the other apps finish the steps they're running, but
+    don't start any new ones. Cancelling a running step wouldn't stop its
+    subprocess.
+
+    Attributes:
+        config (dict): the running config
+        key_config (dict): the config for this signing key
+        codesign (callable): the coroutine function that codesigns an app path
+        semaphores (dict): step name to the ``asyncio.Semaphore`` limiting it
+        accounts (NotarizationAccounts): the ``local_notarization_accounts``
+        poller (NotarizationPoller): polls for notarization status, if we
+            notarize
+        start (float): the ``time.monotonic()`` the pipeline was created
+        stopped (bool): whether an app has failed, so no more steps start
+
+    """
+
+    def __init__(self, config, key_config, codesign, notarize=False):
+        """Initialize AppPipeline."""
+        self.config = config
+        self.key_config = key_config
+        self.codesign = codesign
+        self.semaphores = {step: asyncio.Semaphore(config.get("concurrency_limit", 2)) for step in ("pkg", "zip", "staple", "tar")}
+        self.accounts = NotarizationAccounts(config.get("local_notarization_accounts", []))
+        self.poller = NotarizationPoller(key_config) if notarize else None
+        self.start = time.monotonic()
+        self.stopped = False
+        self._keychain_lock = asyncio.Lock()
+
+    def _log_step(self, app, step):
+        log.info("%s: %s after %.0fs", app.orig_path, step, time.monotonic() - self.start)
+
+    async def _step(self, step, func, *args, **kwargs):
+        semaphore = self.semaphores.get(step)
+        if semaphore is None:
+            return await self._start_step(func, *args, **kwargs)
+        async with semaphore:
+            return await self._start_step(func, *args, **kwargs)
+
+    async def _start_step(self, func, *args, **kwargs):
+        if self.stopped:
+            # Another app failed, so the task is going to fail. Cancel this
+            # app's chain rather than start anything new.
+            raise asyncio.CancelledError()
+        return await func(*args, **kwargs)
+
+    async def _stop(self):
+        self.stopped = True
+        self.accounts.stop()
+        # Apps waiting for Apple to notarize them aren't running a step; stop
+        # polling now, rather than waiting for Apple.
+        if self.poller is not None:
+            await self.poller.stop()
+
+    async def _unlock_keychain(self):
+        # Unlock the keychain again before each codesign and pkgbuild: apps
+        # reach these steps at different times, and the keychain may have
+        # locked again since the last app got there. The lock keeps the unlock
+        # commands from running concurrently.
+        async with self._keychain_lock:
+            await unlock_keychain(self.key_config["signing_keychain"], self.key_config["keychain_password"])
+            await update_keychain_search_path(self.config, self.key_config["signing_keychain"])
+
+    async def sign(self, app, counter):
+        """Extract and sign one app."""
+        await self._step("extract", extract_app, self.config, app, counter)
+        await self._step("sign", sign_one_app, self.config, self.key_config, app, self.codesign, self._unlock_keychain)
+        self._log_step(app, "signed")
+
+    async def pkg(self, app, counter):
+        """Extract, sign and pkg one app."""
+        await self.sign(app, counter)
+        await self._step("unlock", self._unlock_keychain)
+        await self._step("pkg", create_pkg_file, self.key_config, app)
+
+    async def notarize(self, app, counter):
+        """Zip one signed app and its pkg, and wait for Apple to notarize them."""
+        await self._step("zip", create_notarization_zipfile, app, ["app_path", "pkg_path"])
+        uuid = await self._step("submit", notarize_app_with_sudo, self.key_config, self.accounts, app, counter)
+        self._log_step(app, "submitted for notarization as {}".format(uuid))
+        await self._step("poll", self.poller.add, uuid)
+        self._log_step(app, "notarized")
+
+    async def staple_and_tar(self, app, counter):
+        """Staple one notarized app and its pkg, and copy them to the artifact dir."""
+
+        async def app_artifact():
+            await self._step("staple", staple_app_notarization, app, path_attr="app_path")
+            await self._step("tar", tar_app, self.config, app)
+
+        async def pkg_artifact():
+            await self._step("staple", staple_app_notarization, app, path_attr="pkg_path")
+            await self._step("copy", copy_pkg_to_artifact_dir, self.config, app)
+
+        await raise_future_exceptions([asyncio.ensure_future(app_artifact()), asyncio.ensure_future(pkg_artifact())])
+        self._log_step(app, "done")
+
+    async def notarize_app(self, app, counter):
+        """Sign, pkg, notarize and staple one app."""
+        await self.pkg(app, counter)
+        await self.notarize(app, counter)
+        await self.staple_and_tar(app, counter)
+
+    async def sign_and_pkg_app(self, app, counter):
+        """Sign, tar and pkg one app."""
+        await self.sign(app, counter)
+        await self._step("tar", tar_app, self.config, app)
+        await self._step("unlock", self._unlock_keychain)
+        await self._step("pkg", create_pkg_file, self.key_config, app)
+        await self._step("copy", copy_pkg_to_artifact_dir, self.config, app)
+        self._log_step(app, "done")
+
+    async def run(self, chain, all_paths):
+        """Run ``chain`` for every app concurrently.
+
+        Args:
+            chain (callable): the coroutine method to run, e.g. ``self.notarize_app``
+            all_paths (list): the list of ``App`` objects
+
+        Raises:
+            Exception: the first exception any app hits, once the other apps
+                have finished the steps they were running.
+
+        """
+        futures = [asyncio.ensure_future(chain(app, counter)) for counter, app in enumerate(all_paths)]
+        if not futures:
+            return
+        try:
+            done, pending = await asyncio.wait(futures, return_when=asyncio.FIRST_EXCEPTION)
+            if pending:
+                await self._stop()
+                await asyncio.wait(pending)
+        finally:
+            if self.poller is not None:
+                await self.poller.stop()
+                self.accounts.log_stats()
+        exceptions = [future.exception() for future in done if not future.cancelled() and future.exception() is not None]
+        if exceptions:
+            raise exceptions[0]
+
+
 # notarize_behavior {{{1
 async def notarize_behavior(config, task):
     """Sign and notarize all mac apps for this task.
@@ -1185,46 +1776,34 @@ async def notarize_behavior(config, task):
         await sign_langpacks(config, key_config, langpack_apps)
         all_paths = filter_apps(all_paths, fmt="autograph_langpack", inverted=True)
 
-    # app
-    await extract_all_apps(config, all_paths)
     await unlock_keychain(key_config["signing_keychain"], key_config["keychain_password"])
     await update_keychain_search_path(config, key_config["signing_keychain"])
 
+    semaphore = asyncio.Semaphore(key_config.get("codesign_concurrency_limit", DEFAULT_CODESIGN_CONCURRENCY_LIMIT))
     if map_file_inner_path is not None:
         # Sign using the map file in combination with the entitlements artifact
         # identified as a "macapp_entitlements" format upstream artifact.
-        await sign_all_apps_with_map(config, key_config, map_file_inner_path, all_paths)
+        temp_dir, map_path = extract_entitlements_artifact(map_file_inner_path, all_paths)
+        codesign = partial(sign_app_with_map, key_config, artifact_dir=temp_dir.name, map_file=map_path, semaphore=semaphore)
     else:
         # Sign using the downloaded entitlements file
-        apps = filter_apps(all_paths, fmt="macapp_entitlements", inverted=True)
-        await sign_all_apps(config, key_config, entitlements_path, apps)
+        codesign = partial(sign_app, key_config, entitlements_path=entitlements_path, semaphore=semaphore)
 
     # Remove the entitlements artifact from all_paths
     signable_paths = filter_apps(all_paths, fmt="macapp_entitlements", inverted=True)
 
-    # pkg
-    # Unlock keychain again in case it's locked since previous unlock
-    await unlock_keychain(key_config["signing_keychain"], key_config["keychain_password"])
-    await update_keychain_search_path(config, key_config["signing_keychain"])
-    await create_pkg_files(config, key_config, signable_paths)
-
-    log.info("Notarizing")
     if key_config["notarize_type"] == "multi_account":
-        await create_all_notarization_zipfiles(signable_paths, path_attrs=["app_path", "pkg_path"])
-        poll_uuids = await wrap_notarization_with_sudo(config, key_config, signable_paths, path_attr="zip_path")
+        # Each app is notarized and stapled as soon as it's signed
+        pipeline = AppPipeline(config, key_config, codesign, notarize=True)
+        await pipeline.run(pipeline.notarize_app, signable_paths)
     else:
+        pipeline = AppPipeline(config, key_config, codesign)
+        await pipeline.run(pipeline.pkg, signable_paths)
+        log.info("Notarizing")
         zip_path = await create_one_notarization_zipfile(work_dir, signable_paths)
         poll_uuids = await notarize_no_sudo(work_dir, key_config, zip_path)
-
-    await poll_all_notarization_status(key_config, poll_uuids)
-
-    # app
-    await staple_notarization(signable_paths, path_attr="app_path")
-    await tar_apps(config, signable_paths)
-
-    # pkg
-    await staple_notarization(signable_paths, path_attr="pkg_path")
-    await copy_pkgs_to_artifact_dir(config, signable_paths)
+        await poll_all_notarization_status(key_config, poll_uuids)
+        await pipeline.run(pipeline.staple_and_tar, signable_paths)
 
     log.info("Done signing and notarizing apps.")
 
@@ -1395,22 +1974,19 @@ async def sign_and_pkg_behavior(config, task):
     if langpack_apps:
         await sign_langpacks(config, key_config, langpack_apps)
         all_paths = filter_apps(all_paths, fmt="autograph_langpack", inverted=True)
-    await extract_all_apps(config, all_paths)
     await unlock_keychain(key_config["signing_keychain"], key_config["keychain_password"])
     await update_keychain_search_path(config, key_config["signing_keychain"])
 
+    semaphore = asyncio.Semaphore(key_config.get("codesign_concurrency_limit", DEFAULT_CODESIGN_CONCURRENCY_LIMIT))
     if map_file_inner_path is not None:
-        await sign_all_apps_with_map(config, key_config, map_file_inner_path, all_paths)
+        temp_dir, map_path = extract_entitlements_artifact(map_file_inner_path, all_paths)
+        codesign = partial(sign_app_with_map, key_config, artifact_dir=temp_dir.name, map_file=map_path, semaphore=semaphore)
     else:
-        await sign_all_apps(config, key_config, entitlements_path, all_paths)
-
-    await tar_apps(config, all_paths)
+        codesign = partial(sign_app, key_config, entitlements_path=entitlements_path, semaphore=semaphore)
 
-    # pkg
-    await unlock_keychain(key_config["signing_keychain"], key_config["keychain_password"])
-    await update_keychain_search_path(config, key_config["signing_keychain"])
-    await create_pkg_files(config, key_config, all_paths)
-    await copy_pkgs_to_artifact_dir(config, all_paths)
+    # Each app is tarred and pkged as soon as it's signed
+    pipeline = AppPipeline(config, key_config, codesign)
+    await pipeline.run(pipeline.sign_and_pkg_app, filter_apps(all_paths, fmt="macapp_entitlements", inverted=True))
 
     log.info("Done signing apps and creating pkgs.")
 
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Test iscript.codesigntree
+"""
+import asyncio
+import json
+import logging
+import os
+import stat
+
+import pytest
+
+import iscript.codesigntree as codesigntree
+from scriptworker_client.utils import makedirs
+
+log = logging.getLogger(__name__)
+
+
+# helpers {{{1
+def touch(path):
+    makedirs(os.path.dirname(path))
+    with open(path, "w"):
+        pass
+
+
+def _entry(globs, entitlements=(), **kwargs):
+    entry = {
+        "deep": False,
+        "runtime": True,
+        "force": True,
+        "sign": [],
+        "keychain": [],
+        "requirements": [],
+        "entitlements": list(entitlements),
+        "globs": globs,
+    }
+    entry.update(kwargs)
+    return entry
+
+
+@pytest.fixture
+def tree(tmpdir):
+    """Create a synthetic app tree, entitlements dir and map file."""
+    root_dir = os.path.join(str(tmpdir), "foo.app")
+    ent_dir = os.path.join(str(tmpdir), "ent")
+    for path in (
+        "Contents/MacOS/XUL",
+        "Contents/MacOS/liba.dylib",
+        "Contents/MacOS/libb.dylib",
+        "Contents/MacOS/plugin-container.app/Contents/MacOS/plugin-container",
+    ):
+        touch(os.path.join(root_dir, path))
+    touch(os.path.join(ent_dir, "browser.xml"))
+    touch(os.path.join(ent_dir, "plugin.xml"))
+    cs_map = {
+        "map": [
+            _entry(["/Contents/MacOS/*.dylib"], ["browser.xml"]),
+            _entry(["/Contents/MacOS/plugin-container.app/Contents/MacOS/plugin-container"], ["plugin.xml"]),
+            _entry(["/Contents/MacOS/XUL", "/Contents/MacOS/missing"], ["browser.xml"]),
+            _entry(["/Contents/MacOS/plugin-container.app"], ["plugin.xml"]),
+            _entry(["/"], ["browser.xml"]),
+        ]
+    }
+    map_file = os.path.join(str(tmpdir), "map.json")
+    with open(map_file, "w") as fh:
+        json.dump(cs_map, fh)
+    return root_dir, ent_dir, map_file
+
+
+def _expected_plan(root_dir, ent_dir, cs_path):
+    def cmd(ent, *paths):
+        return [cs_path, "-v", "--force", "--sign", "identity", "--options", "runtime", "--entitlements", f"{ent_dir}/{ent}"] + [
+            os.path.join(root_dir, p) for p in paths
+        ]
+
+    return [
+        [
+            cmd("browser.xml", "Contents/MacOS/liba.dylib", "Contents/MacOS/libb.dylib", "Contents/MacOS/XUL"),
+            cmd("plugin.xml", "Contents/MacOS/plugin-container.app/Contents/MacOS/plugin-container"),
+        ],
+        [cmd("plugin.xml", "Contents/MacOS/plugin-container.app")],
+        [cmd("browser.xml", "")],
+    ]
+
+
+# plan_codesign {{{1
+def test_plan_codesign(tree):
+    """Entries only wait for the entries they depend on, and entries with
+    the same flags at the same level are combined.
+
+    """
+    root_dir, ent_dir, map_file = tree
+    with open(map_file) as fh:
+        cs_map = json.load(fh)
+    for cs_entry in cs_map["map"]:
+        cs_entry["sign"] = ["identity"]
+    expanded = codesigntree.expand_globs(root_dir, cs_map)
+    assert expanded["/Contents/MacOS/missing"] == []
+    assert codesigntree.plan_codesign(cs_map["map"], ent_dir, expanded, "codesign") == _expected_plan(root_dir, ent_dir, "codesign")
+
+
+# codesigntree {{{1
+@pytest.mark.asyncio
+async def test_codesigntree_simulate(tree, mocker, caplog):
+    """``simulate`` logs the plan without running anything, expanding each
+    glob once.
+
+    """
+    root_dir, ent_dir, map_file = tree
+    glob = mocker.patch.object(codesigntree.glob, "glob", wraps=codesigntree.glob.glob)
+    caplog.set_level(logging.INFO)
+    assert await codesigntree.codesigntree(map_file, root_dir, ent_dir, {"sign": "identity"}, True, False, log, cs_path="codesign")
+    assert glob.call_count == 6
+    expected = [f"[{level}] {' '.join(cmd)}" for level, cmds in enumerate(_expected_plan(root_dir, ent_dir, "codesign")) for cmd in cmds]
+    assert [r.getMessage() for r in caplog.records if r.levelno == logging.INFO] == expected
+
+
+@pytest.mark.parametrize("exit_code, expected", ((0, True), (1, False)))
+@pytest.mark.asyncio
+async def test_codesigntree(tree, tmpdir, exit_code, expected):
+    """``codesigntree`` runs the plan a level at a time, and fails if
+    codesign does.
+
+    """
+    root_dir, ent_dir, map_file = tree
+    cs_path = os.path.join(str(tmpdir), "codesign")
+    calls_path = os.path.join(str(tmpdir), "calls")
+    with open(cs_path, "w") as fh:
+        fh.write(f'#!/bin/sh\necho "$@" >> {calls_path}\nexit {exit_code}\n')
+    os.chmod(cs_path, os.stat(cs_path).st_mode | stat.S_IEXEC)
+    semaphore = asyncio.Semaphore(2)
+    overrides = {"sign": "identity"}
+    result = await codesigntree.codesigntree(map_file, root_dir, ent_dir, overrides, False, True, log, cs_path=cs_path, semaphore=semaphore)
+    assert result == expected
+    with open(calls_path) as fh:
+        calls = fh.read().splitlines()
+    plan = _expected_plan(root_dir, ent_dir, cs_path)
+    if expected:
+        assert sorted(calls[:2]) == sorted([" ".join(cmd[1:]) for cmd in plan[0]])
+        assert calls[2:] == [" ".join(plan[1][0][1:]), " ".join(plan[2][0][1:])]
+    else:
+        assert len(calls) == 2
+
+
+@pytest.mark.parametrize("jobs", (1, 2))
+def test_main(tree, mocker, jobs):
+    """``main`` runs the plan with at most ``--jobs`` codesign commands at
+    once, including levels with more commands than that.
+
+    """
+    root_dir, ent_dir, map_file = tree
+    calls = []
+    running = []
+
+    async def fake_exec(*cmd):
+        running.append(cmd)
+        calls.append(len(running))
+
+        async def wait():
+            # Let the other commands try to start
+            await asyncio.sleep(0.01)
+            running.remove(cmd)
+            return 0
+
+        return mocker.Mock(wait=wait)
+
+    mocker.patch.object(codesigntree.asyncio, "create_subprocess_exec", new=fake_exec)
+    argv = ["codesigntree", "-j", str(jobs), "-m", map_file, "-d", ent_dir, "-r", root_dir, "-s", "identity"]
+    mocker.patch.object(codesigntree.sys, "argv", argv)
+    with pytest.raises(SystemExit) as excinfo:
+        codesigntree.main()
+    assert excinfo.value.code == 0
+    assert len(calls) == sum(len(cmds) for cmds in _expected_plan(root_dir, ent_dir, "codesign"))
+    assert max(calls) == jobs
+
+
+@pytest.mark.parametrize(
+    "overrides, cs_map",
+    (
+        ({"invalid": True}, {"map": [_entry(["/"])]}),
+        ({}, {"map": [{"globs": ["/"]}]}),
+        ({}, {"map": [_entry(["/"], ["a.xml", "b.xml"])]}),
+        ({}, {"map": [_entry(["/"], ["missing.xml"])]}),
+        ({"sign": "identity"}, {"map": [_entry(["Contents"])]}),
+        ({}, {"map": [_entry(["/"])]}),
+    ),
+)
+@pytest.mark.asyncio
+async def test_codesigntree_invalid(tree, overrides, cs_map):
+    """``codesigntree`` returns False on an invalid map or overrides."""
+    root_dir, ent_dir, map_file = tree
+    with open(map_file, "w") as fh:
+        json.dump(cs_map, fh)
+    assert not await codesigntree.codesigntree(map_file, root_dir, ent_dir, overrides, True, False, log)
@@ -3,6 +3,7 @@
 """Test iscript.mac
 """
 import asyncio
+import logging
 import os
 import plistlib
 from functools import partial
@@ -14,7 +15,7 @@ import pytest
 
 import iscript.mac as mac
 from iscript.exceptions import InvalidNotarization, IScriptError, ThrottledNotarization, TimeoutError, UnknownAppDir, UnknownNotarizationError
-from scriptworker_client.utils import makedirs
+from scriptworker_client.utils import makedirs, run_command
 
 
 # helpers {{{1
@@ -131,34 +132,102 @@ async def test_sign_geckodriver(exists, mocker, tmpdir):
 
 
 # sign_app {{{1
-@pytest.mark.parametrize("sign_with_entitlements,has_clearkey", ((True, True), (False, False)))
-@pytest.mark.asyncio
-async def test_sign_app(mocker, tmpdir, sign_with_entitlements, has_clearkey):
-    """Render ``sign_app`` noop and verify we have complete code coverage.
+def _make_app_tree(tmpdir, has_clearkey=False):
+    """Create a synthetic .app tree to plan and sign.
+
+    Returns:
+        tuple: the app path, and the paths to sign in a valid order
 
     """
-    key_config = {"identity": "id", "signing_keychain": "keychain", "sign_with_entitlements": sign_with_entitlements}
-    entitlements_path = os.path.join(tmpdir, "entitlements")
     app_path = os.path.join(tmpdir, "foo.app")
-
     contents_dir = os.path.join(app_path, "Contents")
     dir1 = os.path.join(contents_dir, "MacOS")
-    dir2 = os.path.join(dir1, "foo.app", "Contents", "MacOS")
+    inner_app = os.path.join(dir1, "foo.app")
+    dir2 = os.path.join(inner_app, "Contents", "MacOS")
     ignore_dir = os.path.join(contents_dir, "ignoreme")
     for dir_ in (dir1, dir2, ignore_dir):
         makedirs(dir_)
-    for dir_ in (dir1, dir2):
+    for dir_ in (dir1, dir2, ignore_dir):
         touch(os.path.join(dir_, "other"))
         touch(os.path.join(dir_, "main"))
     touch(os.path.join(contents_dir, "dont_sign"))
+    touch(os.path.join(contents_dir, "Library", "plugin", "lib.dylib"))
+    expected = [
+        os.path.join(dir1, "other"),
+        os.path.join(contents_dir, "Library", "plugin", "lib.dylib"),
+        os.path.join(dir2, "other"),
+        inner_app,
+    ]
     if has_clearkey:
         dir_ = os.path.join(contents_dir, "Resources/gmp-clearkey/0.1")
         file_ = "libclearkey.dylib"
         makedirs(dir_)
         touch(os.path.join(dir_, file_))
-    mocker.patch.object(mac, "run_command", new=noop_async)
+        expected.append(os.path.join(dir_, file_))
+    expected.append(app_path)
+    return app_path, expected
+
+
+@pytest.mark.parametrize("has_clearkey", (True, False))
+def test_plan_app_signing(mocker, tmpdir, has_clearkey):
+    """``plan_app_signing`` skips the main executables and the dirs outside
+    ``SIGN_DIRS``, and plans nested bundles separately.
+
+    """
+    app_path, expected = _make_app_tree(str(tmpdir), has_clearkey=has_clearkey)
+    mocker.patch.object(mac, "get_bundle_executable", return_value="main")
+    plan = mac.plan_app_signing(app_path)
+    assert sorted(plan.files) == sorted(expected[:2])
+    assert [bundle.app_path for bundle in plan.bundles] == [expected[3]]
+    assert plan.bundles[0].files == [expected[2]]
+    assert plan.bundles[0].libclearkey_path == ""
+    assert bool(plan.libclearkey_path) == has_clearkey
+    assert sorted(plan.get_ordered_paths()[:2]) == sorted(expected[:2])
+    assert plan.get_ordered_paths()[2:] == expected[2:]
+
+
+@pytest.mark.parametrize("sign_with_entitlements,has_clearkey", ((True, True), (False, False)))
+@pytest.mark.asyncio
+async def test_sign_app(mocker, tmpdir, sign_with_entitlements, has_clearkey):
+    """``sign_app`` signs every path in the plan, concurrently, after
+    everything it depends on, and never runs more than
+    ``codesign_concurrency_limit`` codesign calls at once.
+
+    """
+    key_config = {
+        "identity": "id",
+        "signing_keychain": "keychain",
+        "sign_with_entitlements": sign_with_entitlements,
+        "codesign_concurrency_limit": 2,
+    }
+    entitlements_path = os.path.join(tmpdir, "entitlements")
+    app_path, expected = _make_app_tree(str(tmpdir), has_clearkey=has_clearkey)
+    signed = []
+    running = []
+    max_running = 0
+
+    async def fake_run_command(cmd, cwd=None, **kwargs):
+        nonlocal max_running
+        if cmd[0] != "codesign":
+            return
+        assert ("--entitlements" in cmd) == sign_with_entitlements
+        path = os.path.join(cwd, cmd[-1])
+        running.append(path)
+        max_running = max(max_running, len(running))
+        await asyncio.sleep(0.01)
+        running.remove(path)
+        signed.append(path)
+
+    mocker.patch.object(mac, "run_command", new=fake_run_command)
     mocker.patch.object(mac, "get_bundle_executable", return_value="main")
     await mac.sign_app(key_config, app_path, entitlements_path)
+    assert sorted(signed) == sorted(expected)
+    # Nested bundles are signed after their contents, and the app last
+    assert signed.index(expected[3]) > signed.index(expected[2])
+    assert signed[-1] == app_path
+    if has_clearkey:
+        assert signed[-2] == expected[-2]
+    assert max_running == 2
 
 
 # verify_app_signature {{{1
@@ -400,10 +469,10 @@ async def test_sign_all_apps(mocker, tmpdir, raises):
         app_paths.append(app_path)
         all_paths.append(mac.App(parent_dir=os.path.join(work_dir, str(i)), app_path=app_path))
 
-    async def fake_sign(arg1, arg2, arg3):
+    async def fake_sign(arg1, arg2, entitlements_path=None, semaphore=None):
         assert arg1 == key_config
         assert arg2 in app_paths
-        assert arg3 == entitlements_path
+        assert entitlements_path == "fake_entitlements_path"
         if raises:
             raise IScriptError("foo")
 
@@ -419,6 +488,30 @@ async def test_sign_all_apps(mocker, tmpdir, raises):
         await mac.sign_all_apps(config, key_config, entitlements_path, all_paths)
 
 
+# sign_one_app {{{1
+@pytest.mark.asyncio
+async def test_sign_one_app(mocker):
+    """``sign_one_app`` unlocks the keychain after autograph signing, right
+    before codesigning.
+
+    """
+    calls = []
+
+    def record(name):
+        async def fake(*args, **kwargs):
+            calls.append(name)
+
+        return fake
+
+    app = mac.App(app_path="foo.app", formats=["macapp", "autograph_omnija", "autograph_widevine"])
+    mocker.patch.object(mac, "set_app_path_and_name", return_value=None)
+    mocker.patch.object(mac, "sign_omnija_with_autograph", new=record("omnija"))
+    mocker.patch.object(mac, "sign_widevine_dir", new=record("widevine"))
+    mocker.patch.object(mac, "verify_app_signature", new=record("verify"))
+    await mac.sign_one_app({}, {}, app, record("codesign"), record("unlock"))
+    assert calls == ["omnija", "widevine", "unlock", "codesign", "verify"]
+
+
 # get_bundle_id {{{1
 @pytest.mark.parametrize("counter", (None, 3))
 def test_get_bundle_id(mocker, counter):
@@ -472,34 +565,85 @@ def test_get_uuid_from_log(tmpdir, uuid, raises, extra):
         assert mac.get_uuid_from_log(log_path) == uuid
 
 
-# get_notarization_status_from_log {{{1
-@pytest.mark.parametrize(
-    "has_log, status, expected", ((True, "invalid", "invalid"), (True, "success", "success"), (True, "unknown", None), (False, None, None))
-)
-def test_get_notarization_status_from_log(tmpdir, has_log, status, expected):
-    """``get_notarization_status_from_log`` finds a valid status in the log
-    and returns it. If there is a problem or missing/unknown status, it
-    returns ``None``.
+# get_notarization_status {{{1
+@pytest.mark.parametrize("status, expected", (("invalid", "invalid"), ("success", "success"), ("in progress", None), ("unknown", None)))
+def test_get_notarization_status(status, expected):
+    """``get_notarization_status`` finds a valid status in the output and
+    returns it. If the status is missing or unknown, it returns ``None``.
 
     """
-    log_path = os.path.join(str(tmpdir), "log")
-    if has_log:
-        with open(log_path, "w") as fh:
-            fh.write("foo\nbar\nbaz\n Status: {} \nblah\n".format(status))
-    assert mac.get_notarization_status_from_log(log_path) == expected
+    assert mac.get_notarization_status("foo\nbar\nbaz\n Status: {} \nblah\n".format(status)) == expected
+
+
+# get_notarization_history_statuses {{{1
+NOTARIZATION_HISTORY = """Notarization History - page 0
+
+Date                      RequestUUID                          Status      Status Code Status Message
+------------------------- ------------------------------------ ----------- ----------- ----------------
+2020-01-02 18:20:10 +0000 2b1b6e7c-0d1f-4b9a-9c1e-6f1a2b3c4d5e in progress
+2020-01-02 18:10:10 +0000 3c2c7f8d-1e2a-4cab-ad2f-7a2b3c4d5e6f invalid     2           Package Invalid
+2020-01-02 17:55:47 +0000 4d3d8a9e-2f3b-4dbc-be3a-8b3c4d5e6f7a success     0           Package Approved
+"""
+
+
+def test_get_notarization_history_statuses():
+    """``get_notarization_history_statuses`` finds the status of every
+    submission in the history.
+
+    """
+    assert mac.get_notarization_history_statuses(NOTARIZATION_HISTORY) == {
+        "2b1b6e7c-0d1f-4b9a-9c1e-6f1a2b3c4d5e": None,
+        "3c2c7f8d-1e2a-4cab-ad2f-7a2b3c4d5e6f": "invalid",
+        "4d3d8a9e-2f3b-4dbc-be3a-8b3c4d5e6f7a": "success",
+    }
+
+
+# get_altool_output {{{1
+@pytest.mark.asyncio
+async def test_get_altool_output(caplog):
+    """``get_altool_output`` returns the output, and raises on failure. The
+    output is only logged at info level on failure.
+
+    """
+    caplog.set_level(logging.INFO)
+    assert await mac.get_altool_output(["sh", "-c", "echo out; echo err >&2"], ["sh"]) == "out\nerr\n"
+    assert "out" not in caplog.text
+    with pytest.raises(IScriptError, match="LogFileURL"):
+        await mac.get_altool_output(["sh", "-c", "echo LogFileURL: url; exit 1"], ["sh"])
+    assert "LogFileURL: url" in [r.getMessage().strip() for r in caplog.records if r.levelno == logging.INFO]
+
+
+@pytest.mark.asyncio
+async def test_get_altool_output_cancel(mocker):
+    """``get_altool_output`` kills the command if it's cancelled."""
+    procs = []
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def fake_create_subprocess_exec(*args, **kwargs):
+        procs.append(await create_subprocess_exec(*args, **kwargs))
+        return procs[-1]
+
+    mocker.patch.object(asyncio, "create_subprocess_exec", new=fake_create_subprocess_exec)
+    task = asyncio.ensure_future(mac.get_altool_output(["sleep", "10"], ["sleep"]))
+    await asyncio.sleep(0.1)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert procs[0].returncode is not None
 
 
 # wrap_notarization_with_sudo {{{1
 @pytest.mark.parametrize("raises", (True, False))
 @pytest.mark.asyncio
 async def test_wrap_notarization_with_sudo(mocker, tmpdir, raises):
-    """``wrap_notarization_with_sudo`` chunks its requests into one concurrent
-    request per each of the ``local_notarization_accounts``. It doesn't log
-    the password.
+    """``wrap_notarization_with_sudo`` runs one request at a time per each of
+    the ``local_notarization_accounts``, and each account starts its next
+    request as soon as it's free. It doesn't log the password.
 
     """
-    futures_len = [3, 3, 2]
     pw = "test_apple_password"
+    running = {}
+    submitted = []
 
     async def fake_retry_async(_, args, kwargs, **kw):
         cmd = args[0]
@@ -507,16 +651,18 @@ async def test_wrap_notarization_with_sudo(mocker, tmpdir, raises):
         assert cmd[0] == "sudo"
         log_cmd = kwargs["log_cmd"]
         assert cmd[0:end] == log_cmd[0:end]
-        assert cmd[end] != log_cmd[end]
-        assert cmd[end] == pw
-        assert log_cmd[end].replace("*", "") == ""
-
-    async def fake_raise_future_exceptions(futures, **kwargs):
-        """``raise_future_exceptions`` mocker."""
-
-        await asyncio.wait(futures)
-        assert len(futures) == futures_len.pop(0)
-        if raises:
+        # The password is the last argument of the ``su -c`` command line
+        assert cmd[end].endswith(" " + pw)
+        assert pw not in log_cmd[end]
+        assert log_cmd[end].endswith(" ********")
+        account = cmd[2]
+        assert account not in running
+        running[account] = kwargs["log_path"]
+        # The first request is slow; the other accounts should keep going
+        await asyncio.sleep(0.1 if kwargs["log_path"] == expected_paths[0] else 0.001)
+        del running[account]
+        submitted.append((account, kwargs["log_path"]))
+        if raises and kwargs["log_path"] == expected_paths[1]:
             raise IScriptError("foo")
 
     def fake_get_uuid_from_log(path):
@@ -532,21 +678,87 @@ async def test_wrap_notarization_with_sudo(mocker, tmpdir, raises):
     }
     all_paths = []
     expected = {}
-    # Let's create 8 apps, with 3 sudo accounts, so we expect batches of 3, 3, 2
+    expected_paths = []
     for i in range(8):
         parent_dir = os.path.join(work_dir, str(i))
         notarization_log_path = f"{parent_dir}-notarization.log"
         all_paths.append(mac.App(parent_dir=parent_dir, zip_path=os.path.join(parent_dir, "{}.zip".format(i))))
         expected[notarization_log_path] = notarization_log_path
+        expected_paths.append(notarization_log_path)
 
     mocker.patch.object(mac, "retry_async", new=fake_retry_async)
-    mocker.patch.object(mac, "raise_future_exceptions", new=fake_raise_future_exceptions)
     mocker.patch.object(mac, "get_uuid_from_log", new=fake_get_uuid_from_log)
     if raises:
         with pytest.raises(IScriptError):
             await mac.wrap_notarization_with_sudo(config, key_config, all_paths)
+        # No new requests are started after the failure
+        assert len(submitted) < len(all_paths)
     else:
         assert await mac.wrap_notarization_with_sudo(config, key_config, all_paths) == expected
+        assert sorted(path for _, path in submitted) == sorted(expected_paths)
+        # The other two accounts got through the rest while acct0 was busy
+        assert submitted[-1] == ("acct0", expected_paths[0])
+        assert [account for account, _ in submitted].count("acct0") == 1
+
+
+# notarize_app_with_sudo {{{1
+@pytest.mark.parametrize("raises", (True, False))
+@pytest.mark.asyncio
+async def test_notarize_app_with_sudo(mocker, tmpdir, raises):
+    """``notarize_app_with_sudo`` notarizes as a free account, and frees it
+    again when it's done, even on failure.
+
+    """
+    accounts = mac.NotarizationAccounts(["acct0"])
+    app = mac.App(parent_dir=os.path.join(str(tmpdir), "0"), zip_path=os.path.join(str(tmpdir), "0.zip"))
+
+    async def fake_notarize_with_sudo(key_config, account, app_, counter, path_attr):
+        assert account == "acct0"
+        assert accounts.free.empty()
+        app_.notarization_log_path = "log_path"
+        if raises:
+            raise IScriptError("foo")
+
+    mocker.patch.object(mac, "_notarize_with_sudo", new=fake_notarize_with_sudo)
+    mocker.patch.object(mac, "get_uuid_from_log", return_value="uuid")
+    if raises:
+        with pytest.raises(IScriptError):
+            await mac.notarize_app_with_sudo({}, accounts, app, 0)
+    else:
+        assert await mac.notarize_app_with_sudo({}, accounts, app, 0) == "uuid"
+    assert accounts.free.get_nowait() == "acct0"
+    # A failed upload stops any more from starting
+    assert accounts.stopped == raises
+    assert accounts.stats["acct0"]["zips"] == (0 if raises else 1)
+
+
+# NotarizationAccounts {{{1
+@pytest.mark.asyncio
+async def test_notarization_accounts(mocker, tmpdir, caplog):
+    """``NotarizationAccounts`` adds up what each account uploaded, and
+    doesn't start uploads once it's stopped.
+
+    """
+    caplog.set_level(logging.INFO)
+    zip_path = os.path.join(str(tmpdir), "0.zip")
+    with open(zip_path, "wb") as fh:
+        fh.write(b"0" * 1024 * 1024)
+    app = mac.App(parent_dir=str(tmpdir), zip_path=zip_path)
+    accounts = mac.NotarizationAccounts(["acct0", "acct1"])
+    mocker.patch.object(mac, "_notarize_with_sudo", new=noop_async)
+    for counter in range(3):
+        await accounts.notarize({}, app, counter, "zip_path")
+    assert accounts.stats["acct0"]["zips"] == 2
+    assert accounts.stats["acct0"]["bytes"] == 2 * 1024 * 1024
+    assert accounts.stats["acct1"]["zips"] == 1
+    accounts.log_stats()
+    assert "Notarization account acct0 uploaded 2 zips, 2.0 MB" in caplog.text
+    assert "Notarization account acct1 uploaded 1 zips, 1.0 MB" in caplog.text
+    accounts.stop()
+    with pytest.raises(IScriptError, match="Not notarizing"):
+        await accounts.notarize({}, app, 3, "zip_path")
+    assert accounts.stats["acct1"]["zips"] == 1
+    assert accounts.free.qsize() == 2
 
 
 # notarize_no_sudo {{{1
@@ -594,84 +806,148 @@ async def test_notarize_no_sudo(mocker, tmpdir, raises):
         assert await mac.notarize_no_sudo(work_dir, key_config, zip_path) == expected
 
 
-# poll_notarization_uuid {{{1
+# NotarizationPoller {{{1
 @pytest.mark.parametrize(
-    "statuses, exception",
-    (
-        (["success"], None),
-        ([None, "success"], None),
-        ([None], IScriptError),
-        (["invalid"], InvalidNotarization),
-        ([None, None, None, None, None, None, None, None, None, None, None], TimeoutError),
-    ),
+    "elapsed, expected", ((0, 150), (100, 50), (140, 15), (300, 15), (599, 15), (1000, 50), (10000, 120))
 )
-@pytest.mark.asyncio
-async def test_poll_notarization_uuid(mocker, tmpdir, statuses, exception):
-    """``poll_notarization_uuid``: returns ``None`` on success; raises a
-    ``TimeoutError`` on timeout; raises ``IScriptError`` on failure; and raises
-    ``InvalidNotarization`` on ``invalid`` status from Apple. Also, it doesn't
-    log passwords.
+def test_notarization_poller_get_poll_interval(elapsed, expected):
+    """Poll rarely at first, often around the typical turnaround, and back
+    off once we're past it.
 
     """
-    pw = "test_apple_password"
+    poller = mac.NotarizationPoller(
+        {
+            "apple_notarization_account": "a",
+            "apple_notarization_password": "p",
+            "notarization_poll_timeout": 900,
+            "notarization_typical_turnaround": 300,
+        }
+    )
+    assert poller.get_poll_interval(elapsed) == expected
 
-    async def fake_retry_async(_, args, kwargs, **kw):
-        cmd = args[0]
+
+def _fake_altool(responses, calls, pw, raises=None):
+    """Answer ``altool`` status queries from ``responses``.
+
+    ``responses`` maps ``history`` or a uuid to a list of outputs; the last
+    one is repeated.
+
+    """
+
+    async def fake_get_altool_output(cmd, log_cmd):
         end = len(cmd) - 1
-        assert cmd[0] == "xcrun"
-        log_cmd = kwargs["log_cmd"]
         assert cmd[0:end] == log_cmd[0:end]
-        assert cmd[end] != log_cmd[end]
         assert cmd[end] == pw
         assert log_cmd[end].replace("*", "") == ""
-        if exception is IScriptError:
+        key = "history" if "--notarization-history" in cmd else cmd[3]
+        calls.append(key)
+        if raises is not None and key in raises:
             raise IScriptError("foo")
+        outputs = responses[key]
+        return outputs.pop(0) if len(outputs) > 1 else outputs[0]
 
-    def fake_get_notarization_status_from_log(path):
-        status = statuses.pop(0)
-        return status
-
-    mocker.patch.object(mac, "retry_async", new=fake_retry_async)
-    mocker.patch.object(mac, "get_notarization_status_from_log", new=fake_get_notarization_status_from_log)
-    if exception:
-        with pytest.raises(exception):
-            await mac.poll_notarization_uuid("uuid", "user", pw, 0.5, "/dev/null", sleep_time=0.1)
-    else:
-        assert await mac.poll_notarization_uuid("uuid", "user", pw, 1, "/dev/null", sleep_time=0.1) is None
+    return fake_get_altool_output
 
 
-# poll_all_notarization_status {{{1
 @pytest.mark.parametrize(
-    "poll_uuids, raises", (({"uuid": "log_path"}, True), ({"uuid": "log_path"}, False), ({"uuid1": "log_path1", "uuid2": "log_path2"}, False))
+    "responses, raises, exception, expected_calls",
+    (
+        # one history query covers both uuids; a lone uuid is queried directly
+        ({"history": ["uuid1 in progress\nuuid2 success"], "uuid1": ["Status: success"]}, None, None, ["history", "uuid1"]),
+        # uuids missing from the history are queried one at a time
+        ({"history": ["uuid2 success"], "uuid1": ["Status: in progress", "Status: success"]}, None, None, ["history", "uuid1", "uuid1"]),
+        # history failures fall back to one at a time
+        ({"uuid1": ["Status: success"], "uuid2": ["Status: success"]}, ("history",), None, ["history", "uuid1", "uuid2"]),
+        # invalid uuids are queried for their log url
+        ({"history": ["uuid1 invalid\nuuid2 success"], "uuid1": ["Status: invalid"]}, None, InvalidNotarization, ["history", "uuid1"]),
+        ({"history": ["uuid2 success"], "uuid1": ["Status: in progress"]}, None, TimeoutError, None),
+        ({"history": ["uuid2 success"]}, ("uuid1",), IScriptError, ["history", "uuid1"]),
+    ),
 )
 @pytest.mark.asyncio
-async def test_poll_all_notarization_status(mocker, tmpdir, poll_uuids, raises):
-    """```poll_all_notarization_status`` concurrently runs a number of
-    ``poll_notarization_uuid`` calls, and raises if any of those calls raise.
+async def test_poll_all_notarization_status(mocker, responses, raises, exception, expected_calls):
+    """``poll_all_notarization_status`` polls every uuid with one
+    ``NotarizationPoller``, and raises if any of them fail. It doesn't log
+    passwords.
 
     """
-
-    async def fake_raise_future_exceptions(futures):
-        await asyncio.wait(futures)
-        assert len(futures) == len(poll_uuids)
-        if raises:
-            raise IScriptError("foo")
-
+    pw = "test_apple_password"
+    calls = []
     key_config = {
         "apple_notarization_account": "test_apple_account",
-        "apple_notarization_password": "test_apple_password",
+        "apple_notarization_password": pw,
         "apple_asc_provider": "apple_asc_provider",
-        "notarization_poll_timeout": 1,
+        "notarization_poll_timeout": 0.2,
+        "notarization_typical_turnaround": 0,
     }
+    # The history regex only matches real uuids
+    uuid1, uuid2 = "11111111-1111-1111-1111-111111111111", "22222222-2222-2222-2222-222222222222"
+    for key, outputs in responses.items():
+        responses[key] = [o.replace("uuid1", uuid1).replace("uuid2", uuid2) for o in outputs]
+    responses = {{"uuid1": uuid1, "uuid2": uuid2}.get(key, key): outputs for key, outputs in responses.items()}
+    raises = raises and [{"uuid1": uuid1, "uuid2": uuid2}.get(key, key) for key in raises]
 
-    mocker.patch.object(mac, "raise_future_exceptions", new=fake_raise_future_exceptions)
-    mocker.patch.object(mac, "poll_notarization_uuid", new=noop_async)
-    if raises:
-        with pytest.raises(IScriptError):
-            await mac.poll_all_notarization_status(key_config, poll_uuids)
+    async def fake_retry_async(func, args, **kwargs):
+        return await func(*args)
 
+    mocker.patch.object(mac.NotarizationPoller, "MIN_POLL_INTERVAL", 0.01)
+    mocker.patch.object(mac, "retry_async", new=fake_retry_async)
+    mocker.patch.object(mac, "get_altool_output", new=_fake_altool(responses, calls, pw, raises=raises))
+    poll_uuids = {uuid1: "log_path1", uuid2: "log_path2"}
+    if exception:
+        with pytest.raises(exception):
+            await mac.poll_all_notarization_status(key_config, poll_uuids)
     else:
         assert await mac.poll_all_notarization_status(key_config, poll_uuids) is None
+    if expected_calls is not None:
+        assert calls == [{"uuid1": uuid1, "uuid2": uuid2}.get(call, call) for call in expected_calls]
+
+
+@pytest.mark.asyncio
+async def test_notarization_poller_invalid_log(mocker, caplog):
+    """The notarization info of an invalid UUID, with its log url, is
+    logged at info level.
+
+    """
+    key_config = {
+        "apple_notarization_account": "test_apple_account",
+        "apple_notarization_password": "pw",
+        "notarization_poll_timeout": 10,
+        "notarization_typical_turnaround": 0,
+    }
+    caplog.set_level(logging.INFO)
+    mocker.patch.object(mac.NotarizationPoller, "MIN_POLL_INTERVAL", 0.01)
+    statuses = {"uuid1": ["Status: invalid\nLogFileURL: https://example.com/log"]}
+    mocker.patch.object(mac, "get_altool_output", new=_fake_altool(statuses, [], "pw"))
+    with pytest.raises(InvalidNotarization):
+        await mac.NotarizationPoller(key_config).add("uuid1")
+    messages = [r.getMessage() for r in caplog.records if r.levelno == logging.INFO]
+    assert "Notarization info for UUID uuid1:\nStatus: invalid\nLogFileURL: https://example.com/log" in messages
+
+
+@pytest.mark.asyncio
+async def test_notarization_poller_add(mocker):
+    """UUIDs can be added while the poller is running, and are polled on
+    their own schedule.
+
+    """
+    calls = []
+    key_config = {
+        "apple_notarization_account": "test_apple_account",
+        "apple_notarization_password": "pw",
+        "notarization_poll_timeout": 10,
+        "notarization_typical_turnaround": 0,
+        "notarization_poll_concurrency": 1,
+    }
+    mocker.patch.object(mac.NotarizationPoller, "MIN_POLL_INTERVAL", 0.01)
+    statuses = {"uuid1": ["Status: success"], "uuid2": ["Status: success"]}
+    mocker.patch.object(mac, "get_altool_output", new=_fake_altool(statuses, calls, "pw"))
+    poller = mac.NotarizationPoller(key_config)
+    await poller.add("uuid1")
+    assert calls == ["uuid1"]
+    await poller.add("uuid2")
+    assert calls == ["uuid1", "uuid2"]
+    assert poller.pending == {}
 
 
 # staple_notarization {{{1
@@ -973,13 +1249,177 @@ async def test_sign_and_pkg_behavior(mocker, tmpdir, use_langpack):
     mocker.patch.object(mac, "unlock_keychain", new=noop_async)
     mocker.patch.object(mac, "get_bundle_executable", return_value="bundle_executable")
     mocker.patch.object(mac, "get_app_dir", return_value=os.path.join(work_dir, "foo/bar.app"))
-    mocker.patch.object(mac, "copy_pkgs_to_artifact_dir", new=noop_async)
+    mocker.patch.object(mac, "copy_pkg_to_artifact_dir", new=noop_async)
     mocker.patch.object(mac, "get_key_config", return_value=config["mac_config"]["dep"])
     mocker.patch.object(mac, "sign_omnija_with_autograph", new=noop_async)
     mocker.patch.object(mac, "sign_widevine_dir", new=noop_async)
     await mac.sign_and_pkg_behavior(config, task)
 
 
+# AppPipeline {{{1
+def _fake_pipeline_steps(mocker, events, slow=(), fail=()):
+    """Mock the ``AppPipeline`` steps to record ``(step, app)`` events.
+
+    Apps in ``slow`` take longer to sign; apps in ``fail`` fail signing.
+
+    """
+
+    def record(step, app_arg=1):
+        async def fake(*args, **kwargs):
+            app = args[app_arg]
+            if step == "sign":
+                await asyncio.sleep(0.1 if app.orig_path in slow else 0)
+                if app.orig_path in fail:
+                    raise IScriptError("foo")
+            events.append((step, app.orig_path))
+            return "uuid-{}".format(app.orig_path)
+
+        return fake
+
+    mocker.patch.object(mac, "extract_app", new=noop_async)
+    mocker.patch.object(mac, "unlock_keychain", new=noop_async)
+    mocker.patch.object(mac, "update_keychain_search_path", new=noop_async)
+    mocker.patch.object(mac, "sign_one_app", new=record("sign", app_arg=2))
+    mocker.patch.object(mac, "create_pkg_file", new=record("pkg"))
+    mocker.patch.object(mac, "create_notarization_zipfile", new=record("zip", app_arg=0))
+    mocker.patch.object(mac, "notarize_app_with_sudo", new=record("submit", app_arg=2))
+    mocker.patch.object(mac, "staple_app_notarization", new=record("staple", app_arg=0))
+    mocker.patch.object(mac, "tar_app", new=record("tar"))
+    mocker.patch.object(mac, "copy_pkg_to_artifact_dir", new=record("copy"))
+
+    async def fake_add(self, uuid):
+        events.append(("notarized", uuid.replace("uuid-", "")))
+
+    mocker.patch.object(mac.NotarizationPoller, "add", new=fake_add)
+
+
+@pytest.mark.asyncio
+async def test_app_pipeline_notarize_app(mocker):
+    """Each app is notarized and stapled as soon as it's signed, without
+    waiting for the slower apps.
+
+    """
+    events = []
+    _fake_pipeline_steps(mocker, events, slow=("slow",))
+    key_config = {
+        "signing_keychain": "keychain",
+        "keychain_password": "pw",
+        "apple_notarization_account": "a",
+        "apple_notarization_password": "p",
+        "notarization_poll_timeout": 1,
+    }
+    pipeline = mac.AppPipeline({"local_notarization_accounts": ["acct0"]}, key_config, noop_async, notarize=True)
+    all_paths = [mac.App(orig_path="slow"), mac.App(orig_path="fast")]
+    await pipeline.run(pipeline.notarize_app, all_paths)
+    steps = ["sign", "pkg", "zip", "submit", "notarized"]
+    # The fast app is done before the slow app is even signed
+    assert events.index(("sign", "slow")) == len([path for _, path in events if path == "fast"])
+    for orig_path in ("slow", "fast"):
+        app_events = [step for step, path in events if path == orig_path]
+        assert app_events[0:5] == steps
+        assert sorted(app_events[5:]) == ["copy", "staple", "staple", "tar"]
+
+
+@pytest.mark.asyncio
+async def test_app_pipeline_sign_and_pkg_app(mocker):
+    """Each app is tarred and pkged as soon as it's signed."""
+    events = []
+    _fake_pipeline_steps(mocker, events, slow=("slow",))
+
+    async def fake_unlock(*args):
+        events.append(("unlock", None))
+
+    mocker.patch.object(mac, "unlock_keychain", new=fake_unlock)
+    pipeline = mac.AppPipeline({}, {"signing_keychain": "keychain", "keychain_password": "pw"}, noop_async)
+    await pipeline.run(pipeline.sign_and_pkg_app, [mac.App(orig_path="slow"), mac.App(orig_path="fast")])
+    # The keychain is unlocked again before each app is pkged
+    steps = ["sign", "tar", "unlock", "pkg", "copy"]
+    assert events == [(step, None if step == "unlock" else "fast") for step in steps] + [
+        (step, None if step == "unlock" else "slow") for step in steps
+    ]
+
+
+@pytest.mark.asyncio
+async def test_app_pipeline_run_failure(mocker, tmpdir):
+    """``run`` raises the first failure once the other apps have finished the
+    steps they're running, and doesn't start any new ones.
+
+    """
+    events = []
+    _fake_pipeline_steps(mocker, events, fail=("fast",))
+    done_path = os.path.join(str(tmpdir), "done")
+
+    async def fake_extract(config, app, counter):
+        if app.orig_path == "slow":
+            # A real subprocess, still running when the fast app fails
+            await run_command(["sh", "-c", "sleep 0.2; touch {}".format(done_path)])
+        events.append(("extract", app.orig_path))
+
+    mocker.patch.object(mac, "extract_app", new=fake_extract)
+    pipeline = mac.AppPipeline({}, {"signing_keychain": "keychain", "keychain_password": "pw"}, noop_async)
+    with pytest.raises(IScriptError):
+        await pipeline.run(pipeline.sign_and_pkg_app, [mac.App(orig_path="slow"), mac.App(orig_path="fast")])
+    assert os.path.exists(done_path)
+    await asyncio.sleep(0.1)
+    assert events == [("extract", "fast"), ("extract", "slow")]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("stuck_in", ("submit", "poll"))
+async def test_app_pipeline_run_failure_cleanup(mocker, caplog, stuck_in):
+    """When one app fails, an upload in progress finishes and gives its
+    notarization account back, but isn't polled for; a status query in
+    progress is cancelled. Nothing is left pending, and the notarization
+    account stats are still logged.
+
+    """
+    caplog.set_level(logging.INFO)
+    notarize_app_with_sudo = mac.notarize_app_with_sudo
+    poller_add = mac.NotarizationPoller.add
+    events = []
+    _fake_pipeline_steps(mocker, events, slow=("bad",), fail=("bad",))
+    mocker.patch.object(mac, "notarize_app_with_sudo", new=notarize_app_with_sudo)
+    mocker.patch.object(mac.NotarizationPoller, "add", new=poller_add)
+    mocker.patch.object(mac, "get_uuid_from_log", return_value="uuid")
+    started = {"submit": asyncio.Event(), "poll": asyncio.Event()}
+
+    async def fake_notarize(*args):
+        started["submit"].set()
+        if stuck_in == "submit":
+            # Still uploading when the bad app fails
+            await asyncio.sleep(0.2)
+
+    async def hang(*args):
+        started["poll"].set()
+        await asyncio.Event().wait()
+
+    mocker.patch.object(mac, "_notarize_with_sudo", new=fake_notarize)
+    mocker.patch.object(mac.NotarizationPoller, "_query", new=hang)
+    key_config = {
+        "signing_keychain": "keychain",
+        "keychain_password": "pw",
+        "apple_notarization_account": "a",
+        "apple_notarization_password": "p",
+        # Poll right away, so a status query is in progress
+        "notarization_poll_timeout": 0,
+    }
+    pipeline = mac.AppPipeline({"local_notarization_accounts": ["acct0"]}, key_config, noop_async, notarize=True)
+    all_paths = [mac.App(orig_path=orig_path, zip_path="app.zip", parent_dir="parent") for orig_path in ("good", "bad")]
+    with pytest.raises(IScriptError):
+        await pipeline.run(pipeline.notarize_app, all_paths)
+    assert started[stuck_in].is_set()
+    assert started["poll"].is_set() == (stuck_in == "poll")
+    assert pipeline.accounts.stats["acct0"]["zips"] == 1
+    # The account is free again
+    assert pipeline.accounts.free.qsize() == 1
+    assert pipeline.accounts.free.get_nowait() == "acct0"
+    assert "Notarization account acct0 uploaded" in caplog.text
+    # No uuids are left to poll for, and the poller has stopped
+    assert pipeline.poller.pending == {}
+    assert pipeline.poller._task is None or pipeline.poller._task.done()
+    assert [task for task in asyncio.all_tasks() if task is not asyncio.current_task()] == []
+
+
 # notarize_behavior {{{1
 @pytest.mark.parametrize("notarize_type,use_langpack", zip(("multi_account", "single_account", "single_zip"), (False, True)))
 @pytest.mark.asyncio
@@ -1025,11 +1465,11 @@ async def test_notarize_behavior(mocker, tmpdir, notarize_type, use_langpack):
     mocker.patch.object(mac, "run_command", new=noop_async)
     mocker.patch.object(mac, "unlock_keychain", new=noop_async)
     mocker.patch.object(mac, "get_bundle_executable", return_value="bundle_executable")
-    mocker.patch.object(mac, "poll_notarization_uuid", new=noop_async)
+    mocker.patch.object(mac, "poll_all_notarization_status", new=noop_async)
+    mocker.patch.object(mac.NotarizationPoller, "add", new=noop_async)
     mocker.patch.object(mac, "get_app_dir", return_value=os.path.join(work_dir, "foo/bar.app"))
-    mocker.patch.object(mac, "get_notarization_status_from_log", return_value=None)
     mocker.patch.object(mac, "get_uuid_from_log", return_value="uuid")
-    mocker.patch.object(mac, "copy_pkgs_to_artifact_dir", new=noop_async)
+    mocker.patch.object(mac, "copy_pkg_to_artifact_dir", new=noop_async)
     mocker.patch.object(mac, "get_key_config", return_value=config["mac_config"]["dep"])
     mocker.patch.object(mac, "sign_widevine_dir", new=noop_async)
     await mac.notarize_behavior(config, task)
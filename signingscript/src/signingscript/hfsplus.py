@@ -0,0 +1,280 @@
+"""Read HFS+ filesystem images, e.g. from `dmg extract`, into tarballs.
+
+This only reads what the dmgs we sign use: folders, files, symlinks and file
+hard links, with the extents overflow file. Anything else, e.g. compressed
+files or directory hard links, raises `SigningScriptError`, so the caller can
+fall back to `hfsplus extractall`. So do truncated or corrupt images.
+
+See Apple's Technical Note TN1150 for the format.
+
+"""
+import stat
+import struct
+import tarfile
+from contextlib import contextmanager
+
+from signingscript.exceptions import SigningScriptError
+
+# Seconds between the HFS+ epoch (1904-01-01) and the unix epoch.
+HFS_EPOCH_OFFSET = 2082844800
+
+VOLUME_HEADER_OFFSET = 1024
+ROOT_FOLDER_ID = 2
+EXTENTS_FILE_ID = 3
+CATALOG_FILE_ID = 4
+
+FOLDER_RECORD = 1
+FILE_RECORD = 2
+LEAF_NODE = -1
+DATA_FORK = 0
+
+# `ownerFlags` bit for files compressed with decmpfs.
+UF_COMPRESSED = 0x20
+
+# Where file hard link targets live, and the name of their directory hard
+# link equivalent. `hfsplus extractall` skips both.
+PRIVATE_DATA_FOLDER = "\0\0\0\0HFS+ Private Data"
+PRIVATE_DIRECTORY_FOLDER = ".HFS+ Private Directory Data\r"
+
+_FORK_DATA = struct.Struct(">QII" + "II" * 8)
+_NODE_DESCRIPTOR = struct.Struct(">IIbBHH")
+_BTREE_HEADER = struct.Struct(">HIIIIHHII")
+
+
+@contextmanager
+def _malformed_image_errors():
+    """Raise `SigningScriptError` for what parsing a truncated or corrupt image raises.
+
+    That's `struct.error` for records that are too short, and `ValueError`
+    (including `UnicodeDecodeError`) for names and link targets that don't
+    decode.
+
+    """
+    try:
+        yield
+    except (struct.error, ValueError) as e:
+        raise SigningScriptError("Malformed HFS+ image: {}".format(e)) from e
+
+
+class HFSPlusFork:
+    """A file-like object reading a fork of a file in an HFS+ image.
+
+    Attributes:
+        fh (file object): the open image
+        block_size (int): the allocation block size of the volume
+        extents (list): the `(start_block, block_count)` of the fork's extents
+        size (int): the logical size of the fork
+
+    """
+
+    def __init__(self, fh, block_size, extents, size):
+        """Initialize HFSPlusFork."""
+        self.fh = fh
+        self.block_size = block_size
+        self.extents = extents
+        self.size = size
+        self._pos = 0
+
+    def read(self, size=-1):
+        """Read up to `size` bytes of the fork, or the rest of it if `size` is negative."""
+        remaining = self.size - self._pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        chunks = []
+        while size > 0:
+            offset = self._pos
+            for start_block, block_count in self.extents:
+                extent_size = block_count * self.block_size
+                if offset < extent_size:
+                    break
+                offset -= extent_size
+            else:
+                raise SigningScriptError("HFS+ fork is shorter than its logical size")
+            length = min(size, extent_size - offset)
+            self.fh.seek(start_block * self.block_size + offset)
+            chunk = self.fh.read(length)
+            if len(chunk) != length:
+                raise SigningScriptError("HFS+ image is truncated")
+            chunks.append(chunk)
+            self._pos += length
+            size -= length
+        return b"".join(chunks)
+
+
+class HFSPlusImage:
+    """A read-only HFS+ (or HFSX) image.
+
+    The catalog is read into memory when the image is opened; file data is
+    only read when asked for.
+
+    Attributes:
+        fh (file object): the open image
+        block_size (int): the allocation block size of the volume
+
+    """
+
+    @_malformed_image_errors()
+    def __init__(self, fh):
+        """Initialize HFSPlusImage, reading the volume header, extents overflow file and catalog."""
+        self.fh = fh
+        fh.seek(VOLUME_HEADER_OFFSET)
+        header = fh.read(512)
+        if len(header) != 512 or header[:2] not in (b"H+", b"HX"):
+            raise SigningScriptError("Not an HFS+ image")
+        (self.block_size,) = struct.unpack_from(">I", header, 40)
+        self._overflow = {}
+        for key, data in self._leaf_records(self._fork(EXTENTS_FILE_ID, DATA_FORK, _unpack_fork_data(header, 192))):
+            fork_type, file_id, start_block = struct.unpack_from(">BxII", key)
+            self._overflow[(file_id, fork_type, start_block)] = _unpack_extents(data, 0)
+        self._children = {}
+        self.hard_link_targets = {}
+        private_id = None
+        for key, data in self._leaf_records(self._fork(CATALOG_FILE_ID, DATA_FORK, _unpack_fork_data(header, 272))):
+            (record_type,) = struct.unpack_from(">h", data)
+            if record_type not in (FOLDER_RECORD, FILE_RECORD):
+                continue
+            parent_id, name_length = struct.unpack_from(">IH", key)
+            name = key[6 : 6 + 2 * name_length].decode("utf-16-be")
+            if parent_id == ROOT_FOLDER_ID and name in (PRIVATE_DATA_FOLDER, PRIVATE_DIRECTORY_FOLDER):
+                if name == PRIVATE_DATA_FOLDER:
+                    (private_id,) = struct.unpack_from(">I", data, 8)
+                continue
+            if parent_id == private_id:
+                if name.startswith("iNode") and record_type == FILE_RECORD:
+                    self.hard_link_targets[int(name[len("iNode") :])] = data
+                continue
+            self._children.setdefault(parent_id, []).append((name, record_type, data))
+
+    def _fork(self, file_id, fork_type, fork_data):
+        """Return an `HFSPlusFork` for `fork_data`, following the extents overflow file."""
+        size, total_blocks, extents = fork_data
+        covered = sum(count for _, count in extents)
+        while covered < total_blocks:
+            more = self._overflow.get((file_id, fork_type, covered))
+            if not more:
+                raise SigningScriptError("Missing HFS+ overflow extents for file {}".format(file_id))
+            extents = extents + more
+            covered += sum(count for _, count in more)
+        return HFSPlusFork(self.fh, self.block_size, extents, size)
+
+    def _leaf_records(self, fork):
+        """Yield the `(key, data)` of each leaf record of the B-tree in `fork`, in order."""
+        with _malformed_image_errors():
+            tree = fork.read()
+            header_record = tree[_NODE_DESCRIPTOR.size : _NODE_DESCRIPTOR.size + _BTREE_HEADER.size]
+            if len(header_record) != _BTREE_HEADER.size:
+                raise SigningScriptError("HFS+ B-tree is missing its header node")
+            _, _, _, first_leaf, _, node_size, _, _, _ = _BTREE_HEADER.unpack(header_record)
+            node_number = first_leaf
+            seen = set()
+            while node_number:
+                if node_number in seen:
+                    raise SigningScriptError("Loop in HFS+ B-tree leaf nodes")
+                seen.add(node_number)
+                node = tree[node_number * node_size : (node_number + 1) * node_size]
+                if len(node) != node_size:
+                    raise SigningScriptError("HFS+ B-tree node {} is out of range".format(node_number))
+                forward_link, _, kind, _, num_records, _ = _NODE_DESCRIPTOR.unpack_from(node)
+                if kind != LEAF_NODE:
+                    raise SigningScriptError("HFS+ B-tree node {} isn't a leaf node".format(node_number))
+                # Record offsets are stored backwards at the end of the node,
+                # followed by the offset of the free space.
+                offsets = struct.unpack_from(">{}H".format(num_records + 1), node, node_size - 2 * (num_records + 1))[::-1]
+                for start, end in zip(offsets, offsets[1:]):
+                    (key_length,) = struct.unpack_from(">H", node, start)
+                    yield node[start + 2 : start + 2 + key_length], node[start + 2 + key_length : end]
+                node_number = forward_link
+
+    def walk(self, folder_id=ROOT_FOLDER_ID, parent_path=""):
+        """Yield the path, record type and record of everything in a folder, parents first.
+
+        Paths are relative to the root of the volume. The hard link
+        bookkeeping folders are skipped, like `hfsplus extractall` does.
+
+        """
+        for name, record_type, data in self._children.get(folder_id, []):
+            path = "{}/{}".format(parent_path, name) if parent_path else name
+            yield path, record_type, data
+            if record_type == FOLDER_RECORD:
+                (child_id,) = struct.unpack_from(">I", data, 8)
+                yield from self.walk(child_id, path)
+
+    def open_data_fork(self, record):
+        """Return an `HFSPlusFork` reading the data fork of a file record."""
+        (file_id,) = struct.unpack_from(">I", record, 8)
+        return self._fork(file_id, DATA_FORK, _unpack_fork_data(record, 88))
+
+
+def _unpack_extents(data, offset):
+    values = struct.unpack_from(">16I", data, offset)
+    return [(values[i], values[i + 1]) for i in range(0, 16, 2) if values[i + 1]]
+
+
+def _unpack_fork_data(data, offset):
+    values = _FORK_DATA.unpack_from(data, offset)
+    return values[0], values[2], _unpack_extents(data, offset + 16)
+
+
+def _tarinfo(path, record):
+    """Return a `TarInfo` for the catalog `record`, owned by root."""
+    tarinfo = tarfile.TarInfo("./{}".format(path) if path else ".")
+    content_mod_date, file_mode = struct.unpack_from(">16xI22xH", record)
+    tarinfo.mtime = max(content_mod_date - HFS_EPOCH_OFFSET, 0)
+    tarinfo.mode = stat.S_IMODE(file_mode)
+    return tarinfo
+
+
+@_malformed_image_errors()
+def hfs_to_tarfile(image_path, tar):
+    """Write the contents of an HFS+ image into an open, writable `tar`.
+
+    The members match what `hfsplus extractall` followed by `tar cf - .`
+    would give, except that they're owned by root and named in catalog
+    order: `./` followed by the path.
+
+    Args:
+        image_path (str): the path to the HFS+ image
+        tar (tarfile.TarFile): the tarfile to add the members to
+
+    Raises:
+        SigningScriptError: on a malformed image, or one using HFS+ features
+            we don't support
+
+    """
+    with open(image_path, "rb") as fh:
+        image = HFSPlusImage(fh)
+        root = _tarinfo("", bytes(88))
+        root.type = tarfile.DIRTYPE
+        root.mode = 0o755
+        tar.addfile(root)
+        for path, record_type, record in image.walk():
+            tarinfo = _tarinfo(path, record)
+            if record_type == FOLDER_RECORD:
+                tarinfo.type = tarfile.DIRTYPE
+                tarinfo.mode = tarinfo.mode or 0o755
+                tar.addfile(tarinfo)
+                continue
+            file_type, creator = struct.unpack_from(">4s4s", record, 48)
+            owner_flags, file_mode, special = struct.unpack_from(">xBHI", record, 40)
+            if (file_type, creator) == (b"fdrp", b"MACS"):
+                raise SigningScriptError("Directory hard links aren't supported: {}".format(path))
+            if (file_type, creator) == (b"hlnk", b"hfs+"):
+                # Like `hfsplus extractall`, write each hard link as a copy of
+                # its target.
+                if special not in image.hard_link_targets:
+                    raise SigningScriptError("Missing hard link target iNode{} for {}".format(special, path))
+                record = image.hard_link_targets[special]
+                owner_flags, file_mode = struct.unpack_from(">xBH", record, 40)
+                tarinfo.mode = stat.S_IMODE(file_mode)
+            if owner_flags & UF_COMPRESSED:
+                raise SigningScriptError("Compressed files aren't supported: {}".format(path))
+            fork = image.open_data_fork(record)
+            if stat.S_ISLNK(file_mode) or (file_type, creator) == (b"slnk", b"rhap"):
+                tarinfo.type = tarfile.SYMTYPE
+                tarinfo.linkname = fork.read().decode("utf-8")
+                tarinfo.mode = tarinfo.mode or 0o755
+                tar.addfile(tarinfo)
+                continue
+            tarinfo.size = fork.size
+            tarinfo.mode = tarinfo.mode or 0o644
+            tar.addfile(tarinfo, fork)
@@ -1,13 +1,24 @@
 #!/usr/bin/env python
 """Signing script."""
+import asyncio
 import logging
 import os
 
 import aiohttp
 import scriptworker.client
+from scriptworker.utils import raise_future_exceptions
 
 from signingscript.task import build_filelist_dict, sign, task_signing_formats
-from signingscript.utils import copy_to_dir, load_autograph_configs
+from signingscript.utils import (
+    AutographServerSelector,
+    AutographSessions,
+    SignatureCache,
+    TraceRecorder,
+    copy_to_dir,
+    load_autograph_configs,
+    set_trace_recorder,
+    trace_span,
+)
 
 log = logging.getLogger(__name__)
 
@@ -33,21 +44,58 @@ async def async_main(context):
                 raise Exception("Widevine format is enabled, but widevine_cert is not defined")
 
         context.session = session
+        context.autograph_sessions = AutographSessions(context.config)
         context.autograph_configs = load_autograph_configs(context.config["autograph_configs"])
-        work_dir = context.config["work_dir"]
+        context.autograph_selector = AutographServerSelector.from_config(context.config)
+        # Files are signed concurrently; these cap the work in flight across
+        # all of them.
+        context.autograph_semaphore = asyncio.Semaphore(context.config["max_concurrent_autograph_requests"])
+        context.archive_semaphore = asyncio.Semaphore(context.config["max_concurrent_archive_jobs"])
+        context.signature_cache = SignatureCache.from_config(context.config)
+        context.trace_recorder = TraceRecorder.from_config(context.config)
+        set_trace_recorder(context.trace_recorder)
         filelist_dict = build_filelist_dict(context)
-        for path, path_dict in filelist_dict.items():
-            copy_to_dir(path_dict["full_path"], context.config["work_dir"], target=path)
-            log.info("signing %s", path)
-            output_files = await sign(context, os.path.join(work_dir, path), path_dict["formats"], authenticode_comment=path_dict.get("comment"))
-            for source in output_files:
-                source = os.path.relpath(source, work_dir)
-                copy_to_dir(os.path.join(work_dir, source), context.config["artifact_dir"], target=source)
-            if "gpg" in path_dict["formats"] or "autograph_gpg" in path_dict["formats"]:
-                copy_to_dir(context.config["gpg_pubkey"], context.config["artifact_dir"], target="public/build/KEY")
+        tasks = [asyncio.ensure_future(sign_path(context, path, path_dict)) for path, path_dict in filelist_dict.items()]
+        try:
+            await raise_future_exceptions(tasks)
+        finally:
+            context.autograph_sessions.log_stats()
+            context.autograph_selector.log_stats()
+            if context.signature_cache is not None:
+                context.signature_cache.log_stats()
+            if context.trace_recorder is not None:
+                context.trace_recorder.write(os.path.join(context.config["artifact_dir"], context.config["signing_trace_path"]))
+            await context.autograph_sessions.close()
     log.info("Done!")
 
 
+# sign_path {{{1
+async def sign_path(context, path, path_dict):
+    """Sign a single upstream artifact, and copy the results to `artifact_dir`.
+
+    The formats are signed in order, one after the other.
+
+    Args:
+        context (Context): the signing context.
+        path (str): the relative path of the artifact.
+        path_dict (dict): the `build_filelist_dict` entry for `path`.
+
+    """
+    work_dir = context.config["work_dir"]
+    # Signing may modify the working copy in place, so this mustn't be a
+    # hardlink to the chain of trust download.
+    copy_to_dir(path_dict["full_path"], work_dir, target=path)
+    log.info("signing %s", path)
+    with trace_span("sign_path", path=path, format="+".join(path_dict["formats"])):
+        output_files = await sign(context, os.path.join(work_dir, path), path_dict["formats"], authenticode_comment=path_dict.get("comment"))
+    for source in output_files:
+        source = os.path.relpath(source, work_dir)
+        # Nothing touches the signed file in `work_dir` after this.
+        copy_to_dir(os.path.join(work_dir, source), context.config["artifact_dir"], target=source, link=True)
+    if "gpg" in path_dict["formats"] or "autograph_gpg" in path_dict["formats"]:
+        copy_to_dir(context.config["gpg_pubkey"], context.config["artifact_dir"], target="public/build/KEY")
+
+
 def get_default_config(base_dir=None):
     """Create the default config to work from.
 
@@ -71,6 +119,38 @@ def get_default_config(base_dir=None):
         "hfsplus": "hfsplus",
         "gpg_pubkey": None,
         "widevine_cert": None,
+        "max_concurrent_autograph_requests": 10,
+        "max_concurrent_archive_jobs": os.cpu_count() or 1,
+        # Concurrent hash signing requests within this many seconds of each
+        # other are sent to autograph together, up to the batch size. A batch
+        # size of 1 disables batching.
+        "autograph_hash_batch_window": 0.05,
+        "autograph_hash_batch_size": 50,
+        # Requests are spread across every autograph server configured for a
+        # format. A server that fails this many times in a row, with a
+        # connection error or 5xx, is skipped for the cooldown, in seconds.
+        "autograph_circuit_breaker_failures": 3,
+        "autograph_circuit_breaker_cooldown": 30,
+        # Compress tarballs in blocks across this many threads. 1 uses
+        # python's single-threaded tarfile compression.
+        "tar_compression_threads": 1,
+        # Reuse signatures of identical inputs, across tasks, for these
+        # formats. Only list formats whose signatures don't embed a timestamp.
+        "signature_cache_dir": None,
+        "signature_cache_formats": [],
+        "signature_cache_max_size": 1024 * 1024 * 1024,
+        "signature_cache_ttl": 7 * 24 * 60 * 60,
+        # `native` verifies mar signatures with mardor in-process; `binary`
+        # runs mardor's `mar` script instead.
+        "mar_verify_mode": "native",
+        # At most `max_concurrent_authenticode_files` files in an authenticode
+        # zip are signed at once. Progress is logged every
+        # `authenticode_progress_interval` files.
+        "max_concurrent_authenticode_files": 20,
+        "authenticode_progress_interval": 50,
+        # Write a Chrome trace of the timed signing functions to this path in
+        # `artifact_dir`. None disables tracing.
+        "signing_trace_path": "public/logs/signing_trace.json",
     }
     return default_config
 
@@ -2,33 +2,41 @@
 """Signingscript task functions."""
 import asyncio
 import base64
+import copy
 import difflib
 import fnmatch
 import glob
 import hashlib
+import inspect
 import json
 import logging
 import os
+import posixpath
 import re
-import resource
+import secrets
 import shutil
+import stat
+import struct
 import subprocess
 import sys
 import tarfile
 import tempfile
 import time
 import zipfile
-from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from functools import partial, wraps
 from io import BytesIO
 
 import mohawk
 import winsign.sign
+from construct import ConstructError
+from mardor.format import extras_header, index_header, mar, mar_header, sigs_header
 from mardor.reader import MarReader
-from mardor.writer import add_signature_block
 from scriptworker.utils import get_single_item_from_sequence, makedirs, raise_future_exceptions, retry_async, rm
 from winsign.crypto import load_pem_certs
 
-from signingscript import task, utils
+from signingscript import hfsplus, task, utils
 from signingscript.createprecomplete import generate_precomplete
 from signingscript.exceptions import SigningScriptError
 
@@ -45,7 +53,23 @@ sys.path.append(os.path.abspath(os.path.join(os.path.realpath(os.path.dirname(__
 
 from mozpack import mozjar  # noqa  # isort:skip
 
-_ZIP_ALIGNMENT = "4"  # Value must always be 4, based on https://developer.android.com/studio/command-line/zipalign.html
+_AUTOGRAPH_CONTENT_TYPE = "application/json"
+# Must be a multiple of 3, so the base64 encoded chunks can be concatenated
+_SIGNING_REQ_CHUNK_SIZE = 3 * 64 * 1024
+_SIGNED_FILE_RESP_CHUNK_SIZE = 64 * 1024
+
+_ZIP_COPY_CHUNK_SIZE = 1024 * 1024
+
+# Unchanged zip members are copied verbatim by writing through `ZipFile`
+# internals, which are only known to match on these python versions. Other
+# versions decompress and recompress the members with the public API.
+_ZIP_RAW_COPY = (3, 7) <= sys.version_info[:2] <= (3, 11)
+
+# PE headers are read from this many bytes at the start of the file
+_PE_HEADER_READ_SIZE = 4096
+
+_ZIP_ALIGNMENT = 4  # Value must always be 4, based on https://developer.android.com/studio/command-line/zipalign.html
+_ZIP64_EXTRA_ID = 0x0001
 
 # Blessed files call the other widevine files.
 _WIDEVINE_BLESSED_FILENAMES = (
@@ -79,43 +103,107 @@ _DEFAULT_MAR_VERIFY_KEYS = {
 LANGPACK_RE = re.compile(r"^langpack-[a-zA-Z]+(?:-[a-zA-Z]+){0,2}@(?:firefox|devedition).mozilla.org$")
 
 
-def get_rss():
-    """Return the maximum resident set size for this process."""
-    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+# The arguments of the timed functions that name the file being worked on,
+# in order of preference, and the signing format(s).
+_TRACE_PATH_ARGS = ("from_", "orig_path", "path", "abs_to", "input_file", "orig", "to")
+_TRACE_FORMAT_ARGS = ("fmt", "fmts")
+
+
+def _get_file_size(path):
+    try:
+        return os.path.getsize(path) if os.path.isfile(path) else None
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+def _get_trace_args(signature, args, kwargs):
+    """Return the path, format and input size of a timed function call, for its trace span."""
+    try:
+        arguments = signature.bind_partial(*args, **kwargs).arguments
+    except TypeError:
+        return {}
+    trace_args = {}
+    for name in _TRACE_PATH_ARGS:
+        if isinstance(arguments.get(name), str):
+            trace_args["path"] = arguments[name]
+            trace_args["bytes_in"] = _get_file_size(arguments[name])
+            break
+    for name in _TRACE_FORMAT_ARGS:
+        value = arguments.get(name)
+        if isinstance(value, str):
+            trace_args["format"] = value
+        elif isinstance(value, (list, tuple)):
+            trace_args["format"] = "+".join(value)
+    return trace_args
+
+
+def _get_output_trace_args(result):
+    """Return the output size of a timed function call, if it returned paths."""
+    if isinstance(result, str):
+        return {"bytes_out": _get_file_size(result)}
+    if isinstance(result, (list, tuple)) and result and all(isinstance(r, str) for r in result):
+        sizes = [_get_file_size(r) for r in result]
+        if None not in sizes:
+            return {"bytes_out": sum(sizes)}
+    return {}
 
 
 def time_async_function(f):
-    """Time an async function."""
+    """Time an async function, as a `utils.trace_span`."""
+    signature = inspect.signature(f)
+
     # comment to keep black/flake8 happy together
     @wraps(f)
     async def wrapped(*args, **kwargs):
-        start = time.time()
-        start_rss = get_rss()
-        try:
-            return await f(*args, **kwargs)
-        finally:
-            rss = get_rss()
-            log.debug("%s took %.2fs; RSS:%s (%+d)", f.__name__, time.time() - start, rss, rss - start_rss)
+        with utils.trace_span(f.__name__, **_get_trace_args(signature, args, kwargs)) as span_args:
+            result = await f(*args, **kwargs)
+            span_args.update(_get_output_trace_args(result))
+            return result
 
     return wrapped
 
 
 def time_function(f):
-    """Time a sync function."""
+    """Time a sync function, as a `utils.trace_span`."""
+    signature = inspect.signature(f)
+
     # comment to keep black/flake8 happy together
     @wraps(f)
     def wrapped(*args, **kwargs):
-        start = time.time()
-        start_rss = get_rss()
-        try:
-            return f(*args, **kwargs)
-        finally:
-            rss = get_rss()
-            log.debug("%s took %.2fs; RSS:%s (%+d)", f.__name__, time.time() - start, rss, rss - start_rss)
+        with utils.trace_span(f.__name__, **_get_trace_args(signature, args, kwargs)) as span_args:
+            result = f(*args, **kwargs)
+            span_args.update(_get_output_trace_args(result))
+            return result
 
     return wrapped
 
 
+@asynccontextmanager
+async def _limit_concurrency(context, name):
+    """Hold the `context` semaphore called `name`, if there is one.
+
+    `async_main` sets these up to cap concurrent work across all the files
+    in a task.
+
+    Args:
+        context (Context): the signing context
+        name (str): the semaphore attribute, e.g. `autograph_semaphore`
+
+    """
+    semaphore = getattr(context, name, None)
+    if semaphore is None:
+        yield
+    else:
+        async with semaphore:
+            yield
+
+
+async def _run_archive_job(context, func, *args, **kwargs):
+    """Run cpu-heavy archive work in a thread, limited by `context.archive_semaphore`."""
+    async with _limit_concurrency(context, "archive_semaphore"):
+        return await utils.run_in_executor(None, partial(func, *args, **kwargs))
+
+
 # get_autograph_config {{{1
 def get_autograph_config(autograph_configs, cert_type, signing_formats, raise_on_empty=False):
     """Get the autograph config for given `signing_formats` and `cert_type`.
@@ -135,13 +223,53 @@ def get_autograph_config(autograph_configs, cert_type, signing_formats, raise_on
         An Autograph object
 
     """
-    for a in autograph_configs.get(cert_type, []):
-        if a and (set(a.formats) & set(signing_formats)):
-            return a
+    servers = get_autograph_configs(autograph_configs, cert_type, signing_formats, raise_on_empty=raise_on_empty)
+    return servers[0] if servers else None
+
+
+def get_autograph_configs(autograph_configs, cert_type, signing_formats, raise_on_empty=False):
+    """Get every autograph config for given `signing_formats` and `cert_type`.
 
-    if raise_on_empty:
+    The servers are interchangeable: `sign_with_autograph` spreads requests
+    across them, and fails over between them.
+
+    Args:
+        autograph_configs (dict of lists of lists): the contents of
+            `autograph_configs`.
+        cert_type (str): the certificate type - essentially signing level,
+            separating release vs nightly vs dep.
+        signing_formats (list): the signing formats the server needs to support
+        raise_on_empty (bool): flag to raise errors. Optional. Defaults to False.
+
+    Raises:
+        SigningScriptError: when no suitable signing server is found
+
+    Returns:
+        list: the matching Autograph objects, in config order
+
+    """
+    servers = [a for a in autograph_configs.get(cert_type, []) if a and (set(a.formats) & set(signing_formats))]
+    if not servers and raise_on_empty:
         raise SigningScriptError(f"No autograph config found with cert type {cert_type} and formats {signing_formats}")
-    return None
+    return servers
+
+
+def get_autograph_signers(servers, keyid=None):
+    """Get every server and key a signature from `servers` may come from.
+
+    `sign_with_autograph` fails over between `servers`, so a cached signature
+    is only valid for the same set of servers and keys.
+
+    Args:
+        servers (list): the Autograph objects to sign with
+        keyid (str, optional): the key to use on autograph, instead of each
+            server's configured key
+
+    Returns:
+        list: sorted [url, client_id, keyid] lists
+
+    """
+    return sorted([s.url, s.client_id, keyid or s.key_id or ""] for s in servers)
 
 
 # sign_file {{{1
@@ -259,244 +387,239 @@ async def sign_xpi(context, orig_path, fmt, **kwargs):
 # sign_widevine {{{1
 @time_async_function
 async def sign_widevine(context, orig_path, fmt, **kwargs):
-    """Call the appropriate helper function to do widevine signing.
+    """Sign the widevine files inside a zip, tarball or dmg.
 
     Args:
         context (Context): the signing context
         orig_path (str): the source file to sign
-        fmt (str): the format to sign with
+        fmt (str): the format to sign with. It must be a widevine format in
+            `_ARCHIVE_MEMBER_KINDS`.
 
     Raises:
-        SigningScriptError: on unknown suffix.
+        SigningScriptError: on unknown suffix or format.
 
     Returns:
         str: the path to the signed archive
 
     """
-    file_base, file_extension = os.path.splitext(orig_path)
-    # Convert dmg to tarball
-    if file_extension == ".dmg":
-        await _convert_dmg_to_tar_gz(context, orig_path)
-        orig_path = "{}.tar.gz".format(file_base)
-    ext_to_fn = {".zip": sign_widevine_zip, ".tar.bz2": sign_widevine_tar, ".tar.gz": sign_widevine_tar}
-    for ext, signing_func in ext_to_fn.items():
-        if orig_path.endswith(ext):
-            return await signing_func(context, orig_path, fmt)
-    raise SigningScriptError("Unknown widevine file format for {}".format(orig_path))
+    return await sign_archive_members(context, orig_path, [fmt])
 
 
-# sign_widevine_zip {{{1
+# sign_omnija {{{1
 @time_async_function
-async def sign_widevine_zip(context, orig_path, fmt):
-    """Sign the internals of a zipfile with the widevine key.
-
-    Extract the files to sign (see `_WIDEVINE_BLESSED_FILENAMES` and
-    `_WIDEVINE_UNBLESSED_FILENAMES), skipping already-signed files.
-    The blessed files should be signed with the `widevine_blessed` format.
-    Then append the sigfiles to the zipfile.
+async def sign_omnija(context, orig_path, fmt, **kwargs):
+    """Sign the omni.ja files inside a zip, tarball or dmg.
 
     Args:
         context (Context): the signing context
         orig_path (str): the source file to sign
-        fmt (str): the format to sign with
-
-    Returns:
-        str: the path to the signed archive
-
-    """
-    # This will get cleaned up when we nuke `work_dir`. Clean up at that point
-    # rather than immediately after `sign_widevine`, to optimize task runtime
-    # speed over disk space.
-    tmp_dir = tempfile.mkdtemp(prefix="wvzip", dir=context.config["work_dir"])
-    # Get file list
-    all_files = await _get_zipfile_files(orig_path)
-    files_to_sign = _get_widevine_signing_files(all_files)
-    log.debug("Widevine files to sign: %s", files_to_sign)
-    if files_to_sign:
-        # Extract all files so we can create `precomplete` with the full
-        # file list
-        all_files = await _extract_zipfile(context, orig_path, tmp_dir=tmp_dir)
-        tasks = []
-        # Sign the appropriate inner files
-        for from_, fmt in files_to_sign.items():
-            from_ = os.path.join(tmp_dir, from_)
-            to = f"{from_}.sig"
-            tasks.append(asyncio.ensure_future(sign_widevine_with_autograph(context, from_, "blessed" in fmt, to=to)))
-            all_files.append(to)
-        await raise_future_exceptions(tasks)
-        remove_extra_files(tmp_dir, all_files)
-        # Regenerate the `precomplete` file, which is used for cleanup before
-        # applying a complete mar.
-        _run_generate_precomplete(context, tmp_dir)
-        await _create_zipfile(context, orig_path, all_files, mode="w", tmp_dir=tmp_dir)
-    return orig_path
-
-
-# sign_widevine_tar {{{1
-@time_async_function
-async def sign_widevine_tar(context, orig_path, fmt):
-    """Sign the internals of a tarfile with the widevine key.
-
-    Extract the entire tarball, but only sign a handful of files (see
-    `_WIDEVINE_BLESSED_FILENAMES` and `_WIDEVINE_UNBLESSED_FILENAMES).
-    The blessed files should be signed with the `widevine_blessed` format.
-    Then recreate the tarball.
-
-    Ideally we would be able to append the sigfiles to the original tarball,
-    but that's not possible with compressed tarballs.
+        fmt (str): the format to sign with. It must be an omnija format in
+            `_ARCHIVE_MEMBER_KINDS`.
 
-    Args:
-        context (Context): the signing context
-        orig_path (str): the source file to sign
-        fmt (str): the format to sign with
+    Raises:
+        SigningScriptError: on unknown suffix or format.
 
     Returns:
         str: the path to the signed archive
 
     """
-    _, compression = os.path.splitext(orig_path)
-    # This will get cleaned up when we nuke `work_dir`. Clean up at that point
-    # rather than immediately after `sign_widevine`, to optimize task runtime
-    # speed over disk space.
-    tmp_dir = tempfile.mkdtemp(prefix="wvtar", dir=context.config["work_dir"])
-    # Get file list
-    all_files = await _get_tarfile_files(orig_path, compression)
-    files_to_sign = _get_widevine_signing_files(all_files)
-    log.debug("Widevine files to sign: %s", files_to_sign)
-    if files_to_sign:
-        # Extract all files so we can create `precomplete` with the full
-        # file list
-        all_files = await _extract_tarfile(context, orig_path, compression, tmp_dir=tmp_dir)
-        tasks = []
-        # Sign the appropriate inner files
-        for from_, fmt in files_to_sign.items():
-            from_ = os.path.join(tmp_dir, from_)
-            # Don't try to sign directories
-            if not os.path.isfile(from_):
-                continue
-            # Move the sig location on mac. This should be noop on linux.
-            to = _get_mac_sigpath(from_)
-            log.debug("Adding %s to the sigfile paths...", to)
-            makedirs(os.path.dirname(to))
-            tasks.append(asyncio.ensure_future(sign_widevine_with_autograph(context, from_, "blessed" in fmt, to=to)))
-            all_files.append(to)
-        await raise_future_exceptions(tasks)
-        remove_extra_files(tmp_dir, all_files)
-        # Regenerate the `precomplete` file, which is used for cleanup before
-        # applying a complete mar.
-        _run_generate_precomplete(context, tmp_dir)
-        await _create_tarfile(context, orig_path, all_files, compression, tmp_dir=tmp_dir)
-    return orig_path
+    return await sign_archive_members(context, orig_path, [fmt])
 
 
-# sign_omnija {{{1
+# sign_archive_members {{{1
 @time_async_function
-async def sign_omnija(context, orig_path, fmt, **kwargs):
-    """Call the appropriate helper function to do omnija signing.
+async def sign_archive_members(context, orig_path, fmts, **kwargs):
+    """Sign the members of an archive for several formats, with one unpack and repack.
+
+    dmgs are converted to tarballs first. Then only the members the formats
+    need are extracted, they're signed format by format, and the archive is
+    rewritten once with the results.
 
     Args:
         context (Context): the signing context
         orig_path (str): the source file to sign
-        fmt (str): the format to sign with
+        fmts (list): the formats to sign with. Each must be in
+            `_ARCHIVE_MEMBER_KINDS`.
 
     Raises:
-        SigningScriptError: on unknown suffix.
+        SigningScriptError: on unknown suffix or format.
 
     Returns:
         str: the path to the signed archive
 
     """
+    kinds = []
+    for fmt in fmts:
+        kind = _ARCHIVE_MEMBER_KINDS.get(fmt.split(":")[0])
+        if kind is None:
+            raise SigningScriptError("Can't sign archive members with format {}".format(fmt))
+        if kind not in kinds:
+            kinds.append(kind)
     file_base, file_extension = os.path.splitext(orig_path)
     # Convert dmg to tarball
     if file_extension == ".dmg":
         await _convert_dmg_to_tar_gz(context, orig_path)
         orig_path = "{}.tar.gz".format(file_base)
-    ext_to_fn = {".zip": sign_omnija_zip, ".tar.bz2": sign_omnija_tar, ".tar.gz": sign_omnija_tar}
-    for ext, signing_func in ext_to_fn.items():
-        if orig_path.endswith(ext):
-            return await signing_func(context, orig_path, fmt)
-    raise SigningScriptError("Unknown omnija file format for {}".format(orig_path))
+    if orig_path.endswith(".zip"):
+        await _sign_zip_members(context, orig_path, kinds)
+    elif orig_path.endswith((".tar.bz2", ".tar.gz")):
+        await _sign_tar_members(context, orig_path, kinds)
+    else:
+        raise SigningScriptError("Unknown {} file format for {}".format("/".join(kinds), orig_path))
+    return orig_path
 
 
-# sign_omnija_zip {{{1
-async def sign_omnija_zip(context, orig_path, fmt):
-    """Sign the internals of a zipfile with the omnija key for all omni.ja files.
+async def _sign_zip_members(context, orig_path, kinds):
+    """Sign the members of a zipfile for each of `kinds`, then rewrite it.
 
-    Extract the files to sign, then sign them with autograph, recreating the omni.ja
-    from the original to preserve performance tweeks but adding signing info,
-    Then append the sigfiles to the zipfile.
+    Only the members that are signed, or that change because of signing,
+    are extracted. The others are copied over as-is.
 
-    Args:
-        context (Context): the signing context
-        orig_path (str): the source file to sign
-        fmt (str): the format to sign with
+    """
+    # This will get cleaned up when we nuke `work_dir`. Clean up at that point
+    # rather than immediately after signing, to optimize task runtime speed
+    # over disk space.
+    tmp_dir = tempfile.mkdtemp(prefix="signzip", dir=context.config["work_dir"])
+    all_files = await _get_zipfile_files(orig_path)
+    members = []
+    for kind in kinds:
+        members.extend(f for f in _ARCHIVE_MEMBER_SIGNERS[kind][1](all_files) if f not in members)
+    if not members:
+        return
+    await _extract_zipfile(context, orig_path, files=members, tmp_dir=tmp_dir)
+    replace, add = await _sign_extracted_members(context, tmp_dir, all_files, kinds, "zip")
+    await _rewrite_zipfile(context, orig_path, tmp_dir, replace=replace, add=add)
 
-    Returns:
-        str: the path to the signed archive
+
+async def _sign_tar_members(context, orig_path, kinds):
+    """Sign the members of a tarball for each of `kinds`, then rewrite it.
+
+    The tarball is scanned in one pass, extracting only the members whose
+    basenames `kinds` may need. The other members are streamed over as-is
+    when it's rewritten.
+
+    Ideally we would be able to append new members to the original tarball,
+    but that's not possible with compressed tarballs.
 
     """
+    _, compression = os.path.splitext(orig_path)
     # This will get cleaned up when we nuke `work_dir`. Clean up at that point
-    # rather than immediately after `sign_omnija`, to optimize task runtime
-    # speed over disk space.
-    tmp_dir = tempfile.mkdtemp(prefix="ojzip", dir=context.config["work_dir"])
-    # Get file list
-    all_files = await _get_zipfile_files(orig_path)
-    files_to_sign = _get_omnija_signing_files(all_files)
-    log.debug("Omnija files to sign: %s", files_to_sign)
-    if files_to_sign:
-        all_files = await _extract_zipfile(context, orig_path, tmp_dir=tmp_dir)
-        tasks = []
-        # Sign the appropriate inner files
-        for from_, fmt in files_to_sign.items():
-            from_ = os.path.join(tmp_dir, from_)
-            tasks.append(asyncio.ensure_future(sign_omnija_with_autograph(context, from_)))
-        await raise_future_exceptions(tasks)
-        await _create_zipfile(context, orig_path, all_files, mode="w", tmp_dir=tmp_dir)
-    return orig_path
+    # rather than immediately after signing, to optimize task runtime speed
+    # over disk space.
+    tmp_dir = tempfile.mkdtemp(prefix="signtar", dir=context.config["work_dir"])
+    basenames = tuple(name for kind in kinds for name in _ARCHIVE_MEMBER_SIGNERS[kind][0])
+    all_files = await _scan_tarfile(context, orig_path, compression, basenames, tmp_dir=tmp_dir)
+    replace, add = await _sign_extracted_members(context, tmp_dir, all_files, kinds, "tar")
+    if replace or add:
+        await _rewrite_tarfile(context, orig_path, compression, tmp_dir, replace=replace, add=add)
 
 
-# sign_omnija_tar {{{1
-@time_async_function
-async def sign_omnija_tar(context, orig_path, fmt):
-    """Sign the internals of a tarfile with the omnija key for all omni.ja files.
+async def _sign_extracted_members(context, tmp_dir, all_files, kinds, archive_type):
+    """Sign the extracted members of an archive for each of `kinds`, in order.
 
-    Extract the files to sign, then sign them with autograph, recreating the omni.ja
-    from the original to preserve performance tweeks but adding signing info.
-    Then recreate the tarball.
+    Returns:
+        tuple: the lists of members to replace and to add when rewriting the
+            archive
 
-    Args:
-        context (Context): the signing context
-        orig_path (str): the source file to sign
-        fmt (str): the format to sign with
+    """
+    replace = []
+    add = []
+    for kind in kinds:
+        kind_replace, kind_add = await _ARCHIVE_MEMBER_SIGNERS[kind][2](context, tmp_dir, all_files, archive_type)
+        replace.extend(f for f in kind_replace if f not in replace)
+        add.extend(kind_add)
+    return replace, add
+
+
+async def _sign_widevine_members(context, tmp_dir, all_files, archive_type):
+    """Sign the widevine files of an archive extracted to `tmp_dir`.
+
+    The files to sign are `_WIDEVINE_BLESSED_FILENAMES` and
+    `_WIDEVINE_NONBLESSED_FILENAMES`, skipping already-signed files. The
+    blessed files are signed with the `widevine_blessed` format. The sigfiles
+    are added next to them in zipfiles, and in `Contents/Resources` on mac
+    in tarballs. `precomplete` is regenerated to include them.
 
     Returns:
-        str: the path to the signed archive
+        tuple: the lists of members to replace and to add
+
+    """
+    files_to_sign = _get_widevine_signing_files(all_files)
+    log.debug("Widevine files to sign: %s", files_to_sign)
+    if not files_to_sign:
+        return [], []
+    tasks = []
+    sig_files = []
+    # Sign the appropriate inner files
+    for from_, fmt in files_to_sign.items():
+        if archive_type == "zip":
+            to = f"{from_}.sig"
+        else:
+            # Don't try to sign directories or links
+            if not os.path.isfile(os.path.join(tmp_dir, from_)):
+                continue
+            # Move the sig location on mac. This should be noop on linux.
+            to = _get_mac_sigpath(from_)
+            log.debug("Adding %s to the sigfile paths...", to)
+            makedirs(os.path.dirname(os.path.join(tmp_dir, to)))
+        tasks.append(asyncio.ensure_future(sign_widevine_with_autograph(context, os.path.join(tmp_dir, from_), "blessed" in fmt, to=os.path.join(tmp_dir, to))))
+        sig_files.append(to)
+    await raise_future_exceptions(tasks)
+    # Regenerate the `precomplete` file, which is used for cleanup before
+    # applying a complete mar.
+    precomplete_files = [f for f in all_files if os.path.basename(f) == "precomplete"]
+    _run_generate_precomplete(context, tmp_dir, file_list=all_files + sig_files)
+    return precomplete_files, sig_files
+
+
+def _get_widevine_members(all_files):
+    """Return the zipfile members that `_sign_widevine_members` needs extracted."""
+    files_to_sign = _get_widevine_signing_files(all_files)
+    if not files_to_sign:
+        return []
+    return list(files_to_sign) + [f for f in all_files if os.path.basename(f) == "precomplete"]
+
+
+async def _sign_omnija_members(context, tmp_dir, all_files, archive_type):
+    """Sign the omni.ja files of an archive extracted to `tmp_dir`.
+
+    Each omni.ja is signed with autograph, then recreated from the original
+    to preserve its performance tweaks, with the signing info added.
+
+    Returns:
+        tuple: the lists of members to replace and to add
 
     """
-    _, compression = os.path.splitext(orig_path)
-    # This will get cleaned up when we nuke `work_dir`. Clean up at that point
-    # rather than immediately after `sign_widevine`, to optimize task runtime
-    # speed over disk space.
-    tmp_dir = tempfile.mkdtemp(prefix="ojtar", dir=context.config["work_dir"])
-    # Get file list
-    all_files = await _get_tarfile_files(orig_path, compression)
     files_to_sign = _get_omnija_signing_files(all_files)
     log.debug("Omnija files to sign: %s", files_to_sign)
-    if files_to_sign:
-        # Extract all files so we can create `precomplete` with the full
-        # file list
-        all_files = await _extract_tarfile(context, orig_path, compression, tmp_dir=tmp_dir)
-        tasks = []
-        # Sign the appropriate inner files
-        for from_, fmt in files_to_sign.items():
-            from_ = os.path.join(tmp_dir, from_)
-            # Don't try to sign directories
-            if not os.path.isfile(from_):
-                continue
-            tasks.append(asyncio.ensure_future(sign_omnija_with_autograph(context, from_)))
-        await raise_future_exceptions(tasks)
-        await _create_tarfile(context, orig_path, all_files, compression, tmp_dir=tmp_dir)
-    return orig_path
+    tasks = []
+    signed_files = []
+    # Sign the appropriate inner files
+    for from_ in files_to_sign:
+        # Don't try to sign directories or links
+        if archive_type == "tar" and not os.path.isfile(os.path.join(tmp_dir, from_)):
+            continue
+        tasks.append(asyncio.ensure_future(sign_omnija_with_autograph(context, os.path.join(tmp_dir, from_))))
+        signed_files.append(from_)
+    await raise_future_exceptions(tasks)
+    return signed_files, []
+
+
+def _get_omnija_members(all_files):
+    """Return the zipfile members that `_sign_omnija_members` needs extracted."""
+    return list(_get_omnija_signing_files(all_files))
+
+
+# The kind of archive member signing each format does.
+_ARCHIVE_MEMBER_KINDS = {"widevine": "widevine", "widevine_blessed": "widevine", "autograph_widevine": "widevine", "autograph_omnija": "omnija"}
+
+# For each kind of archive member signing: the basenames of the tarball
+# members it may need, a function returning the zipfile members it needs,
+# and the function that signs them once they're extracted.
+_ARCHIVE_MEMBER_SIGNERS = {
+    "widevine": (_WIDEVINE_BLESSED_FILENAMES + _WIDEVINE_NONBLESSED_FILENAMES + ("precomplete",), _get_widevine_members, _sign_widevine_members),
+    "omnija": (("omni.ja",), _get_omnija_members, _sign_omnija_members),
+}
 
 
 # _should_sign_windows {{{1
@@ -511,6 +634,43 @@ def _should_sign_windows(filename):
     return False
 
 
+# _is_signed_pe_file {{{1
+def _is_signed_pe_file(filename):
+    """Check whether a PE file has a certificate table, from its headers only.
+
+    Only the first `_PE_HEADER_READ_SIZE` bytes of the file are read, and the
+    signatures aren't verified.
+
+    Returns:
+        bool: whether the file is signed, or None if it isn't a PE file whose
+            headers fit in that many bytes
+
+    """
+    with open(filename, "rb") as f:
+        header = f.read(_PE_HEADER_READ_SIZE)
+    if header[:2] != b"MZ" or len(header) < 0x40:
+        return None
+    (pe_offset,) = struct.unpack_from("<I", header, 0x3C)
+    # The optional header follows the 4 byte signature and 20 byte COFF header
+    optional_header = pe_offset + 24
+    if header[pe_offset : pe_offset + 4] != b"PE\x00\x00" or len(header) < optional_header + 2:
+        return None
+    (magic,) = struct.unpack_from("<H", header, optional_header)
+    if magic == 0x10B:
+        nrvasizes_offset, certtable_offset = 92, 128
+    elif magic == 0x20B:
+        nrvasizes_offset, certtable_offset = 108, 144
+    else:
+        return None
+    if len(header) < optional_header + certtable_offset + 8:
+        return None
+    (nrvasizes,) = struct.unpack_from("<I", header, optional_header + nrvasizes_offset)
+    if nrvasizes < 5:
+        return False
+    offset, size = struct.unpack_from("<II", header, optional_header + certtable_offset)
+    return bool(offset and size)
+
+
 def _extension_id(filename, fmt):
     """Return a list of id's for the langpacks.
 
@@ -586,22 +746,92 @@ def _get_omnija_signing_files(file_list):
 
 
 # _run_generate_precomplete {{{1
-def _run_generate_precomplete(context, tmp_dir):
-    """Regenerate `precomplete` file with widevine sig paths for complete mar."""
+def _run_generate_precomplete(context, tmp_dir, file_list=None):
+    """Regenerate `precomplete` file with widevine sig paths for complete mar.
+
+    Args:
+        context (Context): the signing context
+        tmp_dir (str): the directory the archive was extracted to
+        file_list (list, optional): the paths of all the archive members,
+            relative to `tmp_dir`. If set, only `precomplete` itself needs to
+            have been extracted. If None, walk `tmp_dir` for the file list.
+            Defaults to None.
+
+    """
     log.info("Generating `precomplete` file...")
     path = _ensure_one_precomplete(tmp_dir, "before")
     with open(path, "r") as fh:
         before = fh.readlines()
-    generate_precomplete(os.path.dirname(path))
+    if file_list is None:
+        generate_precomplete(os.path.dirname(path))
+    else:
+        _generate_precomplete_from_file_list(path, tmp_dir, file_list)
     path = _ensure_one_precomplete(tmp_dir, "after")
     with open(path, "r") as fh:
         after = fh.readlines()
-    # Create diff file
-    diff_path = os.path.join(context.config["work_dir"], "precomplete.diff")
-    with open(diff_path, "w") as fh:
-        for line in difflib.ndiff(before, after):
-            fh.write(line)
-    utils.copy_to_dir(diff_path, context.config["artifact_dir"], target="public/logs/precomplete.diff")
+    # Create diff file. Files are signed concurrently, so each writes its own
+    # temporary file, and renames it over the artifact when it's complete.
+    diff_path = os.path.join(context.config["artifact_dir"], "public/logs/precomplete.diff")
+    utils.mkdir(os.path.dirname(diff_path))
+    fd, tmp_path = _create_temp_file(os.path.dirname(diff_path), ".precomplete")
+    try:
+        with os.fdopen(fd, "w") as fh:
+            for line in difflib.ndiff(before, after):
+                fh.write(line)
+        os.replace(tmp_path, diff_path)
+    except BaseException:
+        rm(tmp_path)
+        raise
+    log.info("Wrote %s", diff_path)
+
+
+# _generate_precomplete_from_file_list {{{1
+def _generate_precomplete_from_file_list(path, tmp_dir, file_list):
+    """Write the `precomplete` file at `path` from a list of archive members.
+
+    This matches `createprecomplete.generate_precomplete`, but doesn't need
+    the archive to be extracted.
+
+    Args:
+        path (str): the path to the `precomplete` file
+        tmp_dir (str): the directory the archive was extracted to
+        file_list (list): the paths of all the archive members, relative to
+            `tmp_dir`. Directories, including symlinks to directories, end
+            with `/`, so they're `rmdir`ed like `os.walk` lists them.
+
+    """
+    root = os.path.relpath(os.path.dirname(path), tmp_dir)
+    # If inside a Mac bundle use the root of the bundle for the path.
+    if os.path.basename(root) == "Resources":
+        root = os.path.normpath(os.path.join(root, "../.."))
+    prefix = "" if root == "." else root.replace("\\", "/") + "/"
+    files = set()
+    dirs = set()
+    for member in file_list:
+        member = member.replace("\\", "/")
+        # Tarfile members are often relative to `./`
+        while member.startswith("./"):
+            member = member[2:]
+        if not member.startswith(prefix):
+            continue
+        rel_path = member[len(prefix) :]
+        parts = rel_path.rstrip("/").split("/")
+        if not parts[0]:
+            continue
+        # Every parent directory is in the tree, whether or not the archive
+        # has an entry for it
+        for i in range(1, len(parts)):
+            dirs.add("/".join(parts[:i]) + "/")
+        if rel_path.endswith("/"):
+            dirs.add(rel_path)
+        elif not (rel_path.endswith("channel-prefs.js") or rel_path.endswith("update-settings.ini") or rel_path.find("distribution/") != -1):
+            files.add(rel_path)
+    dirs = {d for d in dirs if d.find("distribution/") == -1}
+    with open(path, "wb") as fh:
+        for rel_path in sorted(files, reverse=True):
+            fh.write('remove "{}"\n'.format(rel_path).encode("utf-8"))
+        for rel_path in sorted(dirs, reverse=True):
+            fh.write('rmdir "{}"\n'.format(rel_path).encode("utf-8"))
 
 
 # _ensure_one_precomplete {{{1
@@ -646,32 +876,202 @@ async def zip_align_apk(context, abs_to):
     This is necessary if the APK is uploaded to the Google Play Store.
     https://developer.android.com/studio/command-line/zipalign.html
 
+    This does what `zipalign 4` does, in place: the extra field of each
+    stored member's local header is padded so its data starts on a 4-byte
+    boundary. Compressed data is moved as-is. Zip64 files are aligned with
+    `zipalign` instead.
+
     Args:
         context (Context): the signing context
         abs_to (str): the absolute path to the apk
 
+    Raises:
+        SigningScriptError: on failure
+
     """
-    original_apk_location = abs_to
-    zipalign_executable_location = context.config["zipalign"]
+    try:
+        aligned = await _run_archive_job(context, _zip_align_sync, abs_to, _ZIP_ALIGNMENT)
+    except SigningScriptError:
+        raise
+    except Exception as e:
+        raise SigningScriptError(e)
+    if not aligned:
+        log.info("%s is a zip64 file, aligning it with zipalign", abs_to)
+        await _zip_align_with_zipalign(context, abs_to)
+
+    log.info('"{}" has been zip aligned'.format(abs_to))
+
 
+async def _zip_align_with_zipalign(context, abs_to):
+    """Zip align `abs_to` with the `zipalign` executable."""
     with tempfile.TemporaryDirectory() as temp_dir:
         temp_apk_location = os.path.join(temp_dir, "aligned.apk")
 
-        zipalign_command = [zipalign_executable_location]
+        zipalign_command = [context.config["zipalign"]]
         if context.config["verbose"] is True:
             zipalign_command += ["-v"]
 
-        zipalign_command += [_ZIP_ALIGNMENT, original_apk_location, temp_apk_location]
+        zipalign_command += [str(_ZIP_ALIGNMENT), abs_to, temp_apk_location]
         await utils.execute_subprocess(zipalign_command)
         shutil.move(temp_apk_location, abs_to)
 
-    log.info('"{}" has been zip aligned'.format(abs_to))
+
+def _get_extra_fields(extra):
+    """Split a zip extra field into its records.
+
+    Returns:
+        list: (header id, record) tuples, where each record includes its
+            4 byte header
+
+    """
+    records = []
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack("<HH", extra[offset : offset + 4])
+        records.append((header_id, extra[offset : offset + 4 + size]))
+        offset += 4 + size
+    return records
+
+
+def _strip_zip64_extra(extra):
+    """Return a zip extra field without its zip64 record.
+
+    `zipfile` adds its own zip64 record when it needs one.
+
+    """
+    return b"".join(record for header_id, record in _get_extra_fields(extra) if header_id != _ZIP64_EXTRA_ID)
+
+
+def _is_zip64(fh, infos, start_dir):
+    """Return whether the zipfile in `fh` has zip64 records in its central directory."""
+    endrec = zipfile._EndRecData(fh)
+    if endrec is None or endrec[zipfile._ECD_SIGNATURE] == zipfile.stringEndArchive64 or start_dir >= zipfile.ZIP64_LIMIT:
+        return True
+    return any(
+        max(info.file_size, info.compress_size, info.header_offset) >= zipfile.ZIP64_LIMIT or _ZIP64_EXTRA_ID in dict(_get_extra_fields(info.extra))
+        for info in infos
+    )
+
+
+def _zip_align_sync(path, alignment):
+    """Zip align the file at `path` in place.
+
+    `_update_central_directory` only rewrites the 32 bit central directory
+    records, so zip64 files are left alone.
+
+    Returns:
+        bool: False if `path` is a zip64 file, and wasn't aligned, True otherwise
+
+    """
+    with open(path, "r+b") as fh:
+        with zipfile.ZipFile(fh, mode="r") as z:
+            infos = sorted(z.infolist(), key=lambda info: info.header_offset)
+            start_dir = z.start_dir
+        if _is_zip64(fh, infos, start_dir):
+            return False
+        # Work out where each member moves to, and how much padding it needs
+        plan = []
+        new_offsets = {}
+        shift = 0
+        for i, info in enumerate(infos):
+            header, name_and_extra = _read_local_file_header(fh, info)
+            old_data_start = info.header_offset + zipfile.sizeFileHeader + len(name_and_extra)
+            old_end = infos[i + 1].header_offset if i + 1 < len(infos) else start_dir
+            pad = 0
+            if info.compress_type == zipfile.ZIP_STORED:
+                pad = -(old_data_start + shift) % alignment
+            if header[zipfile._FH_EXTRA_FIELD_LENGTH] + pad > 0xFFFF:
+                raise SigningScriptError("Can't zip align {} in {}: its extra field is too long".format(info.filename, path))
+            plan.append((info, header, name_and_extra, old_data_start, old_end, shift, pad))
+            new_offsets[info.header_offset] = info.header_offset + shift
+            shift += pad
+        if shift:
+            # Everything only moves towards the end of the file, so move the
+            # central directory first, then the members from last to first.
+            fh.seek(0, os.SEEK_END)
+            _move_file_range(fh, start_dir, start_dir + shift, fh.tell() - start_dir)
+            for info, header, name_and_extra, old_data_start, old_end, member_shift, pad in reversed(plan):
+                new_data_start = old_data_start + member_shift + pad
+                _move_file_range(fh, old_data_start, new_data_start, old_end - old_data_start)
+                header = list(header)
+                header[zipfile._FH_EXTRA_FIELD_LENGTH] += pad
+                fh.seek(info.header_offset + member_shift)
+                fh.write(struct.pack(zipfile.structFileHeader, *header) + name_and_extra + b"\0" * pad)
+            _update_central_directory(fh, start_dir + shift, new_offsets)
+    _verify_zip_alignment(path, alignment)
+    return True
+
+
+def _read_local_file_header(fh, info):
+    """Return the fields of the local header of `info`, and its name and extra field."""
+    fh.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, fh.read(zipfile.sizeFileHeader))
+    if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise SigningScriptError("Bad local file header for zip member {}".format(info.filename))
+    name_and_extra = fh.read(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH])
+    return header, name_and_extra
+
+
+def _move_file_range(fh, src, dest, length):
+    """Move `length` bytes in `fh` from `src` to `dest`, which isn't before `src`.
+
+    The bytes are copied from the end, so the ranges can overlap.
+
+    """
+    end = length
+    while end > 0:
+        size = min(end, _ZIP_COPY_CHUNK_SIZE)
+        end -= size
+        fh.seek(src + end)
+        block = fh.read(size)
+        if len(block) != size:
+            raise SigningScriptError("Unexpected end of file at {}".format(src + end))
+        fh.seek(dest + end)
+        fh.write(block)
+
+
+def _update_central_directory(fh, start_dir, new_offsets):
+    """Point the central directory at `start_dir` to the moved local headers."""
+    fh.seek(start_dir)
+    while True:
+        signature = fh.read(4)
+        if signature == zipfile.stringCentralDir:
+            record = list(struct.unpack(zipfile.structCentralDir, signature + fh.read(zipfile.sizeCentralDir - 4)))
+            record[zipfile._CD_LOCAL_HEADER_OFFSET] = new_offsets[record[zipfile._CD_LOCAL_HEADER_OFFSET]]
+            fh.seek(-zipfile.sizeCentralDir, os.SEEK_CUR)
+            fh.write(struct.pack(zipfile.structCentralDir, *record))
+            fh.seek(record[zipfile._CD_FILENAME_LENGTH] + record[zipfile._CD_EXTRA_FIELD_LENGTH] + record[zipfile._CD_COMMENT_LENGTH], os.SEEK_CUR)
+        elif signature == zipfile.stringEndArchive:
+            record = list(struct.unpack(zipfile.structEndArchive, signature + fh.read(zipfile.sizeEndCentDir - 4)))
+            record[zipfile._ECD_OFFSET] = start_dir
+            fh.seek(-zipfile.sizeEndCentDir, os.SEEK_CUR)
+            fh.write(struct.pack(zipfile.structEndArchive, *record))
+            return
+        else:
+            raise SigningScriptError("Bad central directory record at {}".format(fh.tell() - len(signature)))
+
+
+def _verify_zip_alignment(path, alignment):
+    """Check the data of every stored member of the zipfile at `path` is aligned, like `zipalign -c`."""
+    with open(path, "rb") as fh, zipfile.ZipFile(fh, mode="r") as z:
+        for info in z.infolist():
+            _, name_and_extra = _read_local_file_header(fh, info)
+            data_start = info.header_offset + zipfile.sizeFileHeader + len(name_and_extra)
+            if info.compress_type == zipfile.ZIP_STORED and data_start % alignment:
+                raise SigningScriptError("{} in {} isn't aligned to {} bytes".format(info.filename, path, alignment))
 
 
 # _convert_dmg_to_tar_gz {{{1
 @time_async_function
 async def _convert_dmg_to_tar_gz(context, from_):
-    """Explode a dmg and tar up its contents. Return the relative tarball path."""
+    """Explode a dmg and tar up its contents. Return the relative tarball path.
+
+    The HFS+ image inside the dmg is read in-process and streamed straight
+    into the tarball, with `tar_compression_threads` compressing it. If the
+    image uses HFS+ features `signingscript.hfsplus` doesn't support, fall
+    back to `hfsplus extractall` and `tar`.
+
+    """
     work_dir = context.config["work_dir"]
     abs_from = os.path.join(work_dir, from_)
     # replace .dmg suffix with .tar.gz (case insensitive)
@@ -679,26 +1079,94 @@ async def _convert_dmg_to_tar_gz(context, from_):
     abs_to = os.path.join(work_dir, to)
     dmg_executable_location = context.config["dmg"]
     hfsplus_executable_location = context.config["hfsplus"]
-
-    with tempfile.TemporaryDirectory() as temp_dir:
-        app_dir = os.path.join(temp_dir, "app")
-        utils.mkdir(app_dir)
-        undmg_cmd = [dmg_executable_location, "extract", abs_from, "tmp.hfs"]
-        await utils.execute_subprocess(undmg_cmd, cwd=temp_dir, log_level=logging.DEBUG)
-        hfsplus_cmd = [hfsplus_executable_location, "tmp.hfs", "extractall", "/", app_dir]
-        await utils.execute_subprocess(hfsplus_cmd, cwd=temp_dir, log_level=logging.DEBUG)
-        tar_cmd = ["tar", "czf", abs_to, "."]
-        await utils.execute_subprocess(tar_cmd, cwd=app_dir)
+    threads = context.config.get("tar_compression_threads", 1)
+
+    async with _limit_concurrency(context, "archive_semaphore"):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            undmg_cmd = [dmg_executable_location, "extract", abs_from, "tmp.hfs"]
+            await utils.execute_subprocess(undmg_cmd, cwd=temp_dir, log_level=logging.DEBUG)
+            try:
+                # We already hold the archive semaphore, so don't use `_run_archive_job`
+                await utils.run_in_executor(None, _hfs_to_tar_gz_sync, os.path.join(temp_dir, "tmp.hfs"), abs_to, threads)
+                return to
+            except SigningScriptError as e:
+                log.warning("Can't stream %s into a tarball, falling back to hfsplus extractall: %s", from_, e)
+            app_dir = os.path.join(temp_dir, "app")
+            utils.mkdir(app_dir)
+            hfsplus_cmd = [hfsplus_executable_location, "tmp.hfs", "extractall", "/", app_dir]
+            await utils.execute_subprocess(hfsplus_cmd, cwd=temp_dir, log_level=logging.DEBUG)
+            tar_cmd = ["tar", "czf", abs_to, "."]
+            await utils.execute_subprocess(tar_cmd, cwd=app_dir)
 
     return to
 
 
+def _hfs_to_tar_gz_sync(image_path, to, threads):
+    with _open_tarfile_for_writing(to, "gz", threads) as t:
+        hfsplus.hfs_to_tarfile(image_path, t)
+
+
 # _get_zipfile_files {{{1
 @time_async_function
 async def _get_zipfile_files(from_):
+    """Return the member names of a zipfile.
+
+    Directories, including symlinks to directories in the zipfile, end with
+    `/`; see `_mark_symlinked_dirs`.
+
+    """
+    files = []
+    symlinks = {}
     with zipfile.ZipFile(from_, mode="r") as z:
-        files = z.namelist()
-        return files
+        for info in z.infolist():
+            files.append(info.filename)
+            if not info.is_dir() and stat.S_ISLNK(info.external_attr >> 16):
+                symlinks[info.filename] = z.read(info).decode("utf-8")
+    return _mark_symlinked_dirs(files, symlinks)
+
+
+# _mark_symlinked_dirs {{{1
+def _mark_symlinked_dirs(names, symlinks):
+    """Add a trailing `/` to the archive member names that are symlinks to directories.
+
+    `os.walk`, and so `createprecomplete`, lists a symlink to a directory as
+    a directory, and doesn't descend into it. Symlinks whose targets aren't
+    directories in the archive stay files.
+
+    Args:
+        names (list): the archive member names. Directories end with `/`.
+        symlinks (dict): the names of the symlink members, to their targets
+
+    Returns:
+        list: `names`, with symlinks to directories ending with `/`
+
+    """
+    if not symlinks:
+        return names
+
+    def key(name):
+        return posixpath.normpath(name.rstrip("/"))
+
+    dirs = set()
+    for name in names:
+        parts = key(name).split("/")
+        dirs.update("/".join(parts[:i]) for i in range(1, len(parts)))
+        if name.endswith("/"):
+            dirs.add(key(name))
+    links = {key(name): target for name, target in symlinks.items()}
+
+    def is_dir(path):
+        # Follow chains of links, giving up on loops
+        for _ in range(40):
+            if path not in links:
+                return path in dirs
+            target = links[path]
+            if posixpath.isabs(target):
+                return False
+            path = posixpath.normpath(posixpath.join(posixpath.dirname(path), target))
+        return False
+
+    return [name + "/" if name in symlinks and is_dir(key(name)) else name for name in names]
 
 
 # _extract_zipfile {{{1
@@ -708,23 +1176,27 @@ async def _extract_zipfile(context, from_, files=None, tmp_dir=None):
     tmp_dir = tmp_dir or os.path.join(work_dir, "unzipped")
     log.debug("Extracting {} from {} to {}...".format(files or "all files", from_, tmp_dir))
     try:
-        extracted_files = []
-        rm(tmp_dir)
-        utils.mkdir(tmp_dir)
-        with zipfile.ZipFile(from_, mode="r") as z:
-            if files is not None:
-                for name in files:
-                    z.extract(name, path=tmp_dir)
-                    extracted_files.append(os.path.join(tmp_dir, name))
-            else:
-                for name in z.namelist():
-                    extracted_files.append(os.path.join(tmp_dir, name))
-                z.extractall(path=tmp_dir)
-        return extracted_files
+        return await _run_archive_job(context, _extract_zipfile_sync, from_, files, tmp_dir)
     except Exception as e:
         raise SigningScriptError(e)
 
 
+def _extract_zipfile_sync(from_, files, tmp_dir):
+    extracted_files = []
+    rm(tmp_dir)
+    utils.mkdir(tmp_dir)
+    with zipfile.ZipFile(from_, mode="r") as z:
+        if files is not None:
+            for name in files:
+                z.extract(name, path=tmp_dir)
+                extracted_files.append(os.path.join(tmp_dir, name))
+        else:
+            for name in z.namelist():
+                extracted_files.append(os.path.join(tmp_dir, name))
+            z.extractall(path=tmp_dir)
+    return extracted_files
+
+
 # _create_zipfile {{{1
 @time_async_function
 async def _create_zipfile(context, to, files, tmp_dir=None, mode="w"):
@@ -732,15 +1204,136 @@ async def _create_zipfile(context, to, files, tmp_dir=None, mode="w"):
     tmp_dir = tmp_dir or os.path.join(work_dir, "unzipped")
     try:
         log.info("Creating zipfile {}...".format(to))
-        with zipfile.ZipFile(to, mode=mode, compression=zipfile.ZIP_DEFLATED) as z:
-            for f in files:
-                relpath = os.path.relpath(f, tmp_dir)
-                z.write(f, arcname=relpath)
+        await _run_archive_job(context, _create_zipfile_sync, to, files, tmp_dir, mode)
         return to
     except Exception as e:
         raise SigningScriptError(e)
 
 
+def _create_zipfile_sync(to, files, tmp_dir, mode):
+    with zipfile.ZipFile(to, mode=mode, compression=zipfile.ZIP_DEFLATED) as z:
+        for f in files:
+            relpath = os.path.relpath(f, tmp_dir)
+            z.write(f, arcname=relpath)
+
+
+# _rewrite_zipfile {{{1
+@time_async_function
+async def _rewrite_zipfile(context, orig_path, tmp_dir, replace=(), add=()):
+    """Rewrite a zipfile with some members replaced or added.
+
+    Unchanged members are copied over without being decompressed or
+    recompressed. The new zipfile is written next to `orig_path`, then
+    renamed over it.
+
+    Args:
+        context (Context): the signing context
+        orig_path (str): the zipfile to rewrite
+        tmp_dir (str): the directory holding the new versions of the members
+        replace (list, optional): the members to replace with the files of
+            the same relative path in `tmp_dir`. Defaults to ().
+        add (list, optional): the new members to add, from `tmp_dir`.
+            Defaults to ().
+
+    Raises:
+        SigningScriptError: on failure
+
+    Returns:
+        str: `orig_path`
+
+    """
+    try:
+        log.info("Rewriting zipfile {}...".format(orig_path))
+        await _run_archive_job(context, _rewrite_zipfile_sync, orig_path, tmp_dir, set(replace), list(add))
+        return orig_path
+    except Exception as e:
+        raise SigningScriptError(e)
+
+
+def _rewrite_zipfile_sync(orig_path, tmp_dir, replace, add):
+    fd, tmp_path = tempfile.mkstemp(prefix=".rezip", dir=os.path.dirname(os.path.abspath(orig_path)))
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(orig_path, mode="r") as zin, zipfile.ZipFile(tmp_path, mode="w", compression=zipfile.ZIP_DEFLATED) as zout:
+            zout.comment = zin.comment
+            for info in zin.infolist():
+                if info.filename in replace:
+                    _write_zip_member(zout, os.path.join(tmp_dir, info.filename), info)
+                else:
+                    _copy_zip_member(zin, zout, info)
+            for name in add:
+                zout.write(os.path.join(tmp_dir, name), arcname=name)
+        shutil.copymode(orig_path, tmp_path)
+        os.replace(tmp_path, orig_path)
+    except BaseException:
+        rm(tmp_path)
+        raise
+
+
+def _write_zip_member(zout, path, orig_info):
+    """Write `path` to `zout`, keeping the name, time and attributes of `orig_info`."""
+    info = zipfile.ZipInfo(orig_info.filename, date_time=orig_info.date_time)
+    info.external_attr = orig_info.external_attr
+    info.create_system = orig_info.create_system
+    info.compress_type = orig_info.compress_type
+    info.file_size = os.path.getsize(path)
+    with open(path, "rb") as src, zout.open(info, mode="w") as dest:
+        shutil.copyfileobj(src, dest, _ZIP_COPY_CHUNK_SIZE)
+
+
+def _copy_zip_member(zin, zout, info):
+    """Copy the compressed data of `info` from `zin` to `zout` verbatim."""
+    if info.flag_bits & 0x01:
+        raise SigningScriptError("Can't copy encrypted zip member {}".format(info.filename))
+    if not _ZIP_RAW_COPY:
+        _recompress_zip_member(zin, zout, info)
+        return
+    zin.fp.seek(info.header_offset)
+    fheader = struct.unpack(zipfile.structFileHeader, zin.fp.read(zipfile.sizeFileHeader))
+    if fheader[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise SigningScriptError("Bad local file header for zip member {}".format(info.filename))
+    zin.fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+    new_info = copy.copy(info)
+    # We know the sizes up front, so write them in the local header rather
+    # than in a data descriptor after the data.
+    new_info.flag_bits &= ~0x08
+    # FileHeader adds its own zip64 extra if it's needed
+    new_info.extra = _strip_zip64_extra(info.extra)
+    with zout._lock:
+        zout.fp.seek(zout.start_dir)
+        new_info.header_offset = zout.fp.tell()
+        zout._writecheck(new_info)
+        zout._didModify = True
+        zout.fp.write(new_info.FileHeader())
+        remaining = info.compress_size
+        while remaining:
+            block = zin.fp.read(min(remaining, _ZIP_COPY_CHUNK_SIZE))
+            if not block:
+                raise SigningScriptError("Truncated zip member {}".format(info.filename))
+            zout.fp.write(block)
+            remaining -= len(block)
+        zout.filelist.append(new_info)
+        zout.NameToInfo[new_info.filename] = new_info
+        zout.start_dir = zout.fp.tell()
+
+
+def _recompress_zip_member(zin, zout, info):
+    """Copy `info` from `zin` to `zout` with the public `ZipFile` API.
+
+    The data is decompressed and compressed again, with the same method.
+
+    """
+    new_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.external_attr = info.external_attr
+    new_info.create_system = info.create_system
+    new_info.comment = info.comment
+    new_info.extra = _strip_zip64_extra(info.extra)
+    new_info.file_size = info.file_size
+    with zin.open(info) as src, zout.open(new_info, mode="w") as dest:
+        shutil.copyfileobj(src, dest, _ZIP_COPY_CHUNK_SIZE)
+
+
 # _get_tarfile_compression {{{1
 def _get_tarfile_compression(compression):
     compression = compression.lstrip(".")
@@ -765,19 +1358,74 @@ async def _extract_tarfile(context, from_, compression, tmp_dir=None):
     tmp_dir = tmp_dir or os.path.join(work_dir, "untarred")
     compression = _get_tarfile_compression(compression)
     try:
-        files = []
-        rm(tmp_dir)
-        utils.mkdir(tmp_dir)
-        with tarfile.open(from_, mode="r:{}".format(compression)) as t:
-            t.extractall(path=tmp_dir)
-            for name in t.getnames():
-                path = os.path.join(tmp_dir, name)
-                os.path.isfile(path) and files.append(path)
-        return files
+        return await _run_archive_job(context, _extract_tarfile_sync, from_, compression, tmp_dir)
+    except Exception as e:
+        raise SigningScriptError(e)
+
+
+def _extract_tarfile_sync(from_, compression, tmp_dir):
+    files = []
+    rm(tmp_dir)
+    utils.mkdir(tmp_dir)
+    with tarfile.open(from_, mode="r:{}".format(compression)) as t:
+        t.extractall(path=tmp_dir)
+        for name in t.getnames():
+            path = os.path.join(tmp_dir, name)
+            os.path.isfile(path) and files.append(path)
+    return files
+
+
+# _scan_tarfile {{{1
+@time_async_function
+async def _scan_tarfile(context, from_, compression, basenames, tmp_dir=None):
+    """List the members of a tarfile, extracting some of the files as we go.
+
+    This reads the tarfile once, as a stream, and only writes the files
+    we're interested in to disk.
+
+    Args:
+        context (Context): the signing context
+        from_ (str): the tarfile to scan
+        compression (str): the compression of the tarfile
+        basenames (iterable): extract the regular files with these basenames
+        tmp_dir (str, optional): the directory to extract to. Defaults to
+            `work_dir/untarred`.
+
+    Raises:
+        SigningScriptError: on failure
+
+    Returns:
+        list: the names of all the members. Directories, including symlinks
+            to directories in the tarfile, end with `/`.
+
+    """
+    work_dir = context.config["work_dir"]
+    tmp_dir = tmp_dir or os.path.join(work_dir, "untarred")
+    compression = _get_tarfile_compression(compression)
+    try:
+        return await _run_archive_job(context, _scan_tarfile_sync, from_, compression, set(basenames), tmp_dir)
     except Exception as e:
         raise SigningScriptError(e)
 
 
+def _scan_tarfile_sync(from_, compression, basenames, tmp_dir):
+    names = []
+    symlinks = {}
+    rm(tmp_dir)
+    utils.mkdir(tmp_dir)
+    with tarfile.open(from_, mode="r|{}".format(compression)) as t:
+        for member in t:
+            if member.isdir():
+                names.append(member.name.rstrip("/") + "/")
+                continue
+            names.append(member.name)
+            if member.issym():
+                symlinks[member.name] = member.linkname
+            elif member.isfile() and os.path.basename(member.name) in basenames:
+                t.extract(member, path=tmp_dir)
+    return _mark_symlinked_dirs(names, symlinks)
+
+
 # _owner_filter {{{1
 def _owner_filter(tarinfo_obj):
     """Force file ownership to be root, Bug 1473850."""
@@ -794,57 +1442,163 @@ async def _create_tarfile(context, to, files, compression, tmp_dir=None):
     work_dir = context.config["work_dir"]
     tmp_dir = tmp_dir or os.path.join(work_dir, "untarred")
     compression = _get_tarfile_compression(compression)
+    threads = context.config.get("tar_compression_threads", 1)
     try:
         log.info("Creating tarfile {}...".format(to))
-        with tarfile.open(to, mode="w:{}".format(compression)) as t:
-            for f in files:
-                relpath = os.path.relpath(f, tmp_dir)
-                t.add(f, arcname=relpath, filter=_owner_filter)
+        await _run_archive_job(context, _create_tarfile_sync, to, files, compression, tmp_dir, threads)
         return to
     except Exception as e:
         raise SigningScriptError(e)
 
 
-def write_signing_req_to_disk(fp, signing_req):
-    """Write signing_req to fp.
+def _create_tarfile_sync(to, files, compression, tmp_dir, threads=1):
+    with _open_tarfile_for_writing(to, compression, threads) as t:
+        for f in files:
+            relpath = os.path.relpath(f, tmp_dir)
+            t.add(f, arcname=relpath, filter=_owner_filter)
+
+
+@contextmanager
+def _open_tarfile_for_writing(to, compression, threads):
+    if threads > 1:
+        # Stream an uncompressed tarball into the parallel compressor
+        with open(to, "wb") as fh, utils.ParallelCompressor(fh, compression, threads) as compressor:
+            with tarfile.open(fileobj=compressor, mode="w|") as t:
+                yield t
+    else:
+        with tarfile.open(to, mode="w:{}".format(compression)) as t:
+            yield t
+
+
+# _rewrite_tarfile {{{1
+@time_async_function
+async def _rewrite_tarfile(context, orig_path, compression, tmp_dir, replace=(), add=()):
+    """Rewrite a tarfile with some members replaced or added.
+
+    Unchanged members are streamed from the original tarfile into the new
+    one, so the tarfile never has to be extracted. The new tarfile is written
+    next to `orig_path`, then renamed over it.
+
+    Args:
+        context (Context): the signing context
+        orig_path (str): the tarfile to rewrite
+        compression (str): the compression of the tarfile
+        tmp_dir (str): the directory holding the new versions of the members
+        replace (list, optional): the members to replace with the files of
+            the same relative path in `tmp_dir`. Defaults to ().
+        add (list, optional): the new members to add, from `tmp_dir`.
+            Defaults to ().
+
+    Raises:
+        SigningScriptError: on failure
+
+    Returns:
+        str: `orig_path`
 
-    Does proper base64 and json encoding.
-    Tries not to hold onto a lot of memory.
     """
-    fp.write(b"[{")
-    for k, v in signing_req.items():
-        fp.write(json.dumps(k).encode("utf8"))
-        fp.write(b":")
-        if hasattr(v, "read"):
+    compression = _get_tarfile_compression(compression)
+    threads = context.config.get("tar_compression_threads", 1)
+    try:
+        log.info("Rewriting tarfile {}...".format(orig_path))
+        await _run_archive_job(context, _rewrite_tarfile_sync, orig_path, compression, tmp_dir, set(replace), list(add), threads)
+        return orig_path
+    except Exception as e:
+        raise SigningScriptError(e)
+
+
+def _rewrite_tarfile_sync(orig_path, compression, tmp_dir, replace, add, threads=1):
+    fd, tmp_path = tempfile.mkstemp(prefix=".retar", dir=os.path.dirname(os.path.abspath(orig_path)))
+    os.close(fd)
+    try:
+        with tarfile.open(orig_path, mode="r|{}".format(compression)) as tin, _open_tarfile_for_writing(tmp_path, compression, threads) as tout:
+            for member in tin:
+                if member.name in replace:
+                    tout.add(os.path.join(tmp_dir, member.name), arcname=member.name, filter=_owner_filter)
+                else:
+                    tout.addfile(_owner_filter(member), tin.extractfile(member) if member.isfile() else None)
+            for name in add:
+                tout.add(os.path.join(tmp_dir, name), arcname=name, filter=_owner_filter)
+        shutil.copymode(orig_path, tmp_path)
+        os.replace(tmp_path, orig_path)
+    except BaseException:
+        rm(tmp_path)
+        raise
+
+
+def _get_signing_req_parts(signing_req):
+    """Split signing_req into its json-encoded parts.
+
+    `signing_req` is either a single request, or a list of requests to send
+    in one batch. File-like values are returned as-is, to be base64 encoded
+    as they are read; everything else is returned as json-encoded bytes.
+    """
+    signing_reqs = [signing_req] if isinstance(signing_req, dict) else signing_req
+    parts = [b"["]
+    for i, req in enumerate(signing_reqs):
+        parts.append(b",{" if i else b"{")
+        for j, (k, v) in enumerate(req.items()):
+            if j:
+                parts.append(b",")
+            parts.append(json.dumps(k).encode("utf8") + b":")
+            if hasattr(v, "read"):
+                parts.extend([b'"', v, b'"'])
+            else:
+                parts.append(json.dumps(v).encode("utf8"))
+        parts.append(b"}")
+    parts.append(b"]")
+    return parts
+
+
+def get_signing_req_size(signing_req):
+    """Return the size in bytes of the encoded signing_req, without encoding it."""
+    size = 0
+    for part in _get_signing_req_parts(signing_req):
+        if isinstance(part, bytes):
+            size += len(part)
+        else:
+            part.seek(0, 2)
+            # base64 encodes every (possibly padded) 3 bytes as 4
+            size += (part.tell() + 2) // 3 * 4
+    return size
+
+
+async def stream_signing_req(signing_req, hashers=()):
+    """Generate signing_req as json-encoded chunks of bytes.
+
+    File-like values are base64 encoded in chunks of `_SIGNING_REQ_CHUNK_SIZE`,
+    so the request never has to be held in memory or staged on disk.
+
+    Args:
+        signing_req (dict or list): the signing request(s), from `make_signing_req`
+        hashers (iterable, optional): hash objects to update with every chunk
+            as it's generated. Defaults to ().
+
+    Yields:
+        bytes: the next chunk of the request body
+
+    """
+    for part in _get_signing_req_parts(signing_req):
+        if isinstance(part, bytes):
+            chunks = [part]
+        else:
             # Make sure we're always reading from the beginning of the file
             # Sometimes we have to retry the request
-            v.seek(0)
-            fp.write(b'"')
-            while True:
-                block = v.read(1020)
-                if not block:
-                    break
-                e = b64encode(block).encode("utf8")
-                fp.write(e)
-            fp.write(b'"')
-        else:
-            fp.write(json.dumps(v).encode("utf8"))
-        fp.write(b",")
-    fp.seek(-1, 1)
-    fp.write(b"}]")
+            part.seek(0)
+            chunks = (base64.b64encode(block) for block in iter(partial(part.read, _SIGNING_REQ_CHUNK_SIZE), b""))
+        for chunk in chunks:
+            for h in hashers:
+                h.update(chunk)
+            yield chunk
 
 
-def get_hawk_content_hash(request_body, content_type):
+async def get_hawk_content_hash(signing_req, content_type):
     """Generate the content hash of the given request."""
     h = hashlib.new("sha256")
     h.update(b"hawk.1.payload\n")
     h.update(content_type.encode("utf8"))
     h.update(b"\n")
-    while True:
-        block = request_body.read(1024)
-        if not block:
-            break
-        h.update(block)
+    async for _ in stream_signing_req(signing_req, hashers=(h,)):
+        pass
     h.update(b"\n")
     return b64encode(h.digest())
 
@@ -860,30 +1614,210 @@ def get_hawk_header(url, user, password, content_type, content_hash):
 
 
 @time_async_function
-async def call_autograph(session, url, user, password, sign_req):
-    """Call autograph and return the json response."""
-    content_type = "application/json"
+async def call_autograph(session, url, user, password, sign_req, content_hash=None, to=None):
+    """Call autograph and return the json response.
 
-    request_body = tempfile.TemporaryFile("w+b")
-    write_signing_req_to_disk(request_body, sign_req)
-    request_body.seek(0)
+    The request body is streamed from `sign_req`, so a request costs one read
+    of the input file.
 
-    content_hash = get_hawk_content_hash(request_body, content_type)
+    Args:
+        session (aiohttp.ClientSession): client session object
+        url (str): the autograph endpoint to post to
+        user (str): the hawk user
+        password (str): the hawk password
+        sign_req (dict or list): the signing request(s), from `make_signing_req`
+        content_hash (str, optional): the hawk content hash of `sign_req`. If
+            None, read through the input to calculate it. Defaults to None.
+        to (str, optional): the path to decode the response's `signed_file`
+            to. If None, the whole response is held in memory. Defaults to None.
+
+    Returns:
+        list: the json response. If `to` is set, `signed_file` is empty.
+
+    """
+    content_type = _AUTOGRAPH_CONTENT_TYPE
+    if content_hash is None:
+        content_hash = await get_hawk_content_hash(sign_req, content_type)
 
     auth_header = get_hawk_header(url, user, password, content_type, content_hash)
 
-    request_body.seek(0, 2)
-    req_size = request_body.tell()
+    req_size = get_signing_req_size(sign_req)
     log.debug("req_size: %s", req_size)
-    request_body.seek(0)
 
-    resp = await session.post(url, data=request_body, headers={"Authorization": auth_header, "Content-Type": content_type, "Content-Length": str(req_size)})
+    resp = await session.post(
+        url, data=stream_signing_req(sign_req), headers={"Authorization": auth_header, "Content-Type": content_type, "Content-Length": str(req_size)}
+    )
     log.debug("Autograph response: %s", resp.status)
     resp.raise_for_status()
-    # TODO: Write this out to temporary file. The responses can be large,
-    # especially in the case of APK/omnija signing where the entire file is
-    # being sent and returned.
-    return await resp.json()
+    if to is None:
+        return await resp.json()
+    # The responses can be large, especially in the case of APK/omnija
+    # signing where the entire file is being sent and returned.
+    return await write_signed_file_response(resp, to)
+
+
+class SignedFileResponseDecoder:
+    """Incrementally decode an autograph /sign/file json response.
+
+    The base64 `signed_file` value is decoded and written to `fp` as the
+    response is fed in, rather than being held in memory. The rest of the
+    response is kept, with an empty `signed_file` value, to be parsed once
+    the response is complete.
+
+    Attributes:
+        fp (file object): the file to write the decoded `signed_file` to
+        bytes_written (int): the number of decoded bytes written to `fp`
+
+    """
+
+    _SIGNED_FILE_KEY_RE = re.compile(rb'"signed_file"\s*:\s*\Z')
+    _STRING_SPECIAL_RE = re.compile(rb'["\\]')
+
+    def __init__(self, fp):
+        """Initialize SignedFileResponseDecoder."""
+        self.fp = fp
+        self.bytes_written = 0
+        self._skeleton = bytearray()
+        self._b64_buffer = b""
+        self._in_string = False
+        self._in_signed_file = False
+        self._escape = False
+        self._found = False
+
+    def _write_b64(self, data):
+        data = self._b64_buffer + data
+        # Only decode complete base64 quads; keep the rest for the next chunk
+        end = len(data) - len(data) % 4
+        self._b64_buffer = data[end:]
+        if end:
+            decoded = base64.b64decode(data[:end])
+            self.fp.write(decoded)
+            self.bytes_written += len(decoded)
+
+    def feed(self, chunk):
+        """Feed the next chunk of the response.
+
+        Args:
+            chunk (bytes): the next chunk of the response
+
+        Raises:
+            SigningScriptError: on an unexpected escape in `signed_file`
+
+        """
+        pos = 0
+        while pos < len(chunk):
+            if self._escape:
+                self._escape = False
+                char = chunk[pos : pos + 1]
+                pos += 1
+                if not self._in_signed_file:
+                    self._skeleton += char
+                elif char == b"/":
+                    self._write_b64(char)
+                else:
+                    raise SigningScriptError(f"Unexpected escape in signed_file: \\{char.decode('utf8', 'replace')}")
+            elif self._in_string or self._in_signed_file:
+                m = self._STRING_SPECIAL_RE.search(chunk, pos)
+                end = m.start() if m else len(chunk)
+                if self._in_signed_file:
+                    self._write_b64(chunk[pos:end])
+                else:
+                    self._skeleton += chunk[pos:end]
+                if not m:
+                    break
+                pos = m.end()
+                if m.group() == b"\\":
+                    self._escape = True
+                    if not self._in_signed_file:
+                        self._skeleton += b"\\"
+                else:
+                    self._skeleton += b'"'
+                    if self._in_signed_file and self._b64_buffer:
+                        raise SigningScriptError("Truncated base64 in signed_file")
+                    self._in_string = self._in_signed_file = False
+            else:
+                end = chunk.find(b'"', pos)
+                if end == -1:
+                    self._skeleton += chunk[pos:]
+                    break
+                self._skeleton += chunk[pos:end]
+                pos = end + 1
+                if not self._found and self._SIGNED_FILE_KEY_RE.search(self._skeleton):
+                    self._found = self._in_signed_file = True
+                else:
+                    self._in_string = True
+                self._skeleton += b'"'
+
+    def close(self):
+        """Finish decoding the response.
+
+        Raises:
+            SigningScriptError: if the response is incomplete, or has no
+                `signed_file`
+
+        Returns:
+            list: the json response, with an empty `signed_file` value
+
+        """
+        if self._in_string or self._in_signed_file or self._escape:
+            raise SigningScriptError("Incomplete autograph response")
+        if not self._found:
+            raise SigningScriptError("No signed_file in autograph response")
+        return json.loads(self._skeleton.decode("utf8"))
+
+
+def _create_temp_file(dir_, prefix):
+    """Create a new, uniquely named file in `dir_`, with the default file mode.
+
+    Unlike `tempfile.mkstemp`, which always creates the file 0600, the
+    process umask applies, like it would to a file opened for writing.
+
+    Returns:
+        tuple: the file descriptor, opened for writing, and the path
+
+    """
+    while True:
+        path = os.path.join(dir_, "{}{}".format(prefix, secrets.token_hex(8)))
+        try:
+            return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), path
+        except FileExistsError:
+            continue
+
+
+@time_async_function
+async def write_signed_file_response(resp, to):
+    """Decode the `signed_file` of an autograph response straight to disk.
+
+    The file is written next to `to` and then renamed over it, so `to` is
+    untouched if the response fails part way through. The signed file keeps
+    the mode of the file it replaces.
+
+    Args:
+        resp (aiohttp.ClientResponse): the autograph /sign/file response
+        to (str): the path to write the signed file to
+
+    Raises:
+        SigningScriptError: on an invalid response
+
+    Returns:
+        list: the json response, with an empty `signed_file` value
+
+    """
+    fd, tmp_path = _create_temp_file(os.path.dirname(os.path.abspath(to)), ".signed")
+    try:
+        with os.fdopen(fd, "wb") as fout:
+            decoder = SignedFileResponseDecoder(fout)
+            async for chunk in resp.content.iter_chunked(_SIGNED_FILE_RESP_CHUNK_SIZE):
+                decoder.feed(chunk)
+            sign_resp = decoder.close()
+        if os.path.exists(to):
+            shutil.copymode(to, tmp_path)
+        os.replace(tmp_path, to)
+    except BaseException:
+        rm(tmp_path)
+        raise
+    log.debug("Wrote %s bytes of signed file to %s", decoder.bytes_written, to)
+    return sign_resp
 
 
 def b64encode(input_bytes):
@@ -928,43 +1862,111 @@ def make_signing_req(input_file, fmt, keyid=None, extension_id=None):
 
 
 @time_async_function
-async def sign_with_autograph(session, server, input_file, fmt, autograph_method, keyid=None, extension_id=None):
+async def sign_with_autograph(session, server, input_file, fmt, autograph_method, keyid=None, extension_id=None, to=None, selector=None):
     """Signs data with autograph and returns the result.
 
+    If `server` is a list, each attempt goes to the best server according to
+    `selector`, or the first one that hasn't failed if there's no selector,
+    so a server that's down or returning 5xx errors is failed over from.
+
     Args:
-        session (aiohttp.ClientSession): client session object
-        server (Autograph): the server to connect to sign
-        input_file (file object): the source data to sign
+        session (aiohttp.ClientSession or callable): client session object, or
+            a function returning the session to use for a given server
+        server (Autograph or list): the server to connect to sign, or a list
+            of interchangeable servers
+        input_file (file object or list): the source data to sign. A list
+            of file objects is signed in a single request.
         fmt (str): the format to sign with
         autograph_method (str): which autograph method to use to sign. must be
                                 one of 'file', 'hash', or 'data'
         keyid (str): which key to use on autograph (optional)
         extension_id (str): which id to send to autograph for the extension (optional)
+        to (str): for the 'file' method, the path to write the signed file to,
+                  instead of returning it (optional)
+        selector (AutographServerSelector): balances requests between servers (optional)
 
     Raises:
         aiohttp.ClientError: on failure
         SigningScriptError: when no suitable signing server is found for fmt
 
     Returns:
-        bytes: the signed data
+        bytes: the signed data, or `to` if it was set. A list of the signed
+            data if `input_file` is a list.
 
     """
     if autograph_method not in {"file", "hash", "data"}:
         raise SigningScriptError(f"Unsupported autograph method: {autograph_method}")
+    if isinstance(input_file, list) and autograph_method == "file" and to:
+        raise SigningScriptError("Can't write multiple signed files to one path")
+
+    servers = server if isinstance(server, list) else [server]
+    if not servers:
+        raise SigningScriptError(f"No autograph server to sign {fmt} with")
+    get_session = session if callable(session) else lambda _: session
+
+    # The signing request and its content hash don't change between attempts
+    # to the same key; only calculate them once per key
+    sign_reqs = {}
+
+    async def get_sign_req(server):
+        # Only send a keyid if the task asked for one, or the server's config
+        # sets one explicitly; otherwise autograph uses its default key
+        server_keyid = keyid
+        if not server_keyid and server.key_id:
+            server_keyid = server.key_id
+        if server_keyid not in sign_reqs:
+            if isinstance(input_file, list):
+                sign_req = [make_signing_req(f, fmt, server_keyid, extension_id) for f in input_file]
+            else:
+                sign_req = make_signing_req(input_file, fmt, server_keyid, extension_id)
+            sign_reqs[server_keyid] = (sign_req, await get_hawk_content_hash(sign_req, _AUTOGRAPH_CONTENT_TYPE))
+        return sign_reqs[server_keyid]
+
+    attempts = []
+    failed = set()
+
+    async def _call_autograph():
+        candidates = selector.order(servers) if selector else servers
+        server = next((s for s in candidates if s.url not in failed), candidates[0])
+        attempts.append(server.url)
+        sign_req, content_hash = await get_sign_req(server)
+        url = f"{server.url}/sign/{autograph_method}"
+        try:
+            with selector.track(server) if selector else nullcontext():
+                return await call_autograph(
+                    get_session(server),
+                    url,
+                    server.client_id,
+                    server.access_key,
+                    sign_req,
+                    content_hash=content_hash,
+                    to=to if autograph_method == "file" else None,
+                )
+        except Exception as e:
+            if utils.is_autograph_server_error(e) and len(servers) > 1:
+                log.warning("autograph %s failed (%s); failing over to another server", server.url, e)
+                failed.add(server.url)
+                if len(failed) == len(servers):
+                    failed.clear()
+            raise
 
-    keyid = keyid or server.key_id
-    sign_req = make_signing_req(input_file, fmt, keyid, extension_id)
-
-    url = f"{server.url}/sign/{autograph_method}"
-
-    sign_resp = await retry_async(
-        call_autograph, args=(session, url, server.client_id, server.access_key, sign_req), attempts=3, sleeptime_kwargs={"delay_factor": 2.0}
-    )
+    try:
+        sign_resp = await retry_async(
+            _call_autograph,
+            attempts=max(3, len(servers)),
+            sleeptime_kwargs={"delay_factor": 2.0},
+        )
+    finally:
+        utils.trace_annotate(autograph_server=attempts[-1] if attempts else servers[0].url, retries=max(len(attempts) - 1, 0))
 
-    if autograph_method == "file":
-        return sign_resp[0]["signed_file"]
-    else:
-        return sign_resp[0]["signature"]
+    if autograph_method == "file" and to:
+        return to
+    result_key = "signed_file" if autograph_method == "file" else "signature"
+    if not isinstance(input_file, list):
+        return sign_resp[0][result_key]
+    if len(sign_resp) != len(input_file):
+        raise SigningScriptError(f"Sent {len(input_file)} inputs to autograph, but got {len(sign_resp)} responses")
+    return [r[result_key] for r in sign_resp]
 
 
 @time_async_function
@@ -988,12 +1990,28 @@ async def sign_file_with_autograph(context, from_, fmt, to=None, extension_id=No
 
     """
     cert_type = task.task_cert_type(context)
-    a = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
+    servers = get_autograph_configs(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
     to = to or from_
-    input_file = open(from_, "rb")
-    signed_bytes = base64.b64decode(await sign_with_autograph(context.session, a, input_file, fmt, "file", extension_id=extension_id))
-    with open(to, "wb") as fout:
-        fout.write(signed_bytes)
+    cache = utils.get_signature_cache(context, fmt)
+    if cache is not None:
+        cache_key = cache.get_key(utils.get_hash(from_, "sha256"), fmt, get_autograph_signers(servers), cert_type, extension_id)
+        if cache.get_file(cache_key, to):
+            log.info("Using cached %s signature for %s", fmt, from_)
+            return to
+    with open(from_, "rb") as input_file:
+        async with _limit_concurrency(context, "autograph_semaphore"):
+            await sign_with_autograph(
+                partial(utils.get_autograph_session, context),
+                servers,
+                input_file,
+                fmt,
+                "file",
+                extension_id=extension_id,
+                to=to,
+                selector=utils.get_autograph_selector(context),
+            )
+    if cache is not None:
+        cache.put_file(cache_key, to)
     return to
 
 
@@ -1015,10 +2033,13 @@ async def sign_gpg_with_autograph(context, from_, fmt, **kwargs):
 
     """
     cert_type = task.task_cert_type(context)
-    a = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
+    servers = get_autograph_configs(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
     to = f"{from_}.asc"
     input_file = open(from_, "rb")
-    signature = await sign_with_autograph(context.session, a, input_file, fmt, "data")
+    async with _limit_concurrency(context, "autograph_semaphore"):
+        signature = await sign_with_autograph(
+            partial(utils.get_autograph_session, context), servers, input_file, fmt, "data", selector=utils.get_autograph_selector(context)
+        )
     with open(to, "w") as fout:
         fout.write(signature)
     return [from_, to]
@@ -1043,12 +2064,126 @@ async def sign_hash_with_autograph(context, hash_, fmt, keyid=None):
 
     """
     cert_type = task.task_cert_type(context)
-    a = get_autograph_config(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
-    input_file = BytesIO(hash_)
-    signature = base64.b64decode(await sign_with_autograph(context.session, a, input_file, fmt, "hash", keyid))
+    servers = get_autograph_configs(context.autograph_configs, cert_type, [fmt], raise_on_empty=True)
+    cache = utils.get_signature_cache(context, fmt)
+    if cache is not None:
+        cache_key = cache.get_key(hashlib.sha256(hash_).hexdigest(), fmt, get_autograph_signers(servers, keyid), cert_type)
+        signature = cache.get(cache_key)
+        if signature is not None:
+            log.info("Using cached %s signature", fmt)
+            return signature
+    batcher = _get_autograph_hash_batcher(context)
+    if batcher is not None:
+        signature = base64.b64decode(await batcher.sign(context, servers, hash_, fmt, keyid))
+    else:
+        input_file = BytesIO(hash_)
+        async with _limit_concurrency(context, "autograph_semaphore"):
+            signature = base64.b64decode(
+                await sign_with_autograph(
+                    partial(utils.get_autograph_session, context), servers, input_file, fmt, "hash", keyid, selector=utils.get_autograph_selector(context)
+                )
+            )
+    if cache is not None:
+        cache.put(cache_key, signature)
     return signature
 
 
+def _get_autograph_hash_batcher(context):
+    """Return the task's AutographHashBatcher, or None if batching is disabled.
+
+    The batcher is created on first use, from the `autograph_hash_batch_window`
+    and `autograph_hash_batch_size` config.
+    """
+    if not hasattr(context, "autograph_hash_batcher"):
+        batch_size = context.config.get("autograph_hash_batch_size", 1)
+        context.autograph_hash_batcher = AutographHashBatcher(context.config["autograph_hash_batch_window"], batch_size) if batch_size > 1 else None
+    return context.autograph_hash_batcher
+
+
+class AutographHashBatcher:
+    """Coalesce concurrent hash signing requests into batched autograph calls.
+
+    Autograph's /sign/hash endpoint takes a list of inputs. Requests for the
+    same servers, format and keyid that arrive within `window` seconds of each
+    other are sent together, up to `max_batch_size` at a time, and each
+    caller gets its own signature back.
+
+    Attributes:
+        window (float): how long to wait for more requests before sending a batch
+        max_batch_size (int): send a batch as soon as it has this many requests
+
+    """
+
+    def __init__(self, window, max_batch_size):
+        """Initialize AutographHashBatcher."""
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._batches = {}
+        # The event loop only keeps weak references to tasks; keep the
+        # in-flight batches alive until they're done.
+        self._tasks = set()
+
+    async def sign(self, context, servers, hash_, fmt, keyid=None):
+        """Add `hash_` to the current batch, and wait for its signature.
+
+        Args:
+            context (Context): the signing context
+            servers (list): the interchangeable Autograph servers to sign with
+            hash_ (bytes): the input hash to sign
+            fmt (str): the format to sign with
+            keyid (str): which key to use on autograph (optional)
+
+        Raises:
+            aiohttp.ClientError: on failure
+
+        Returns:
+            str: the base64 encoded signature
+
+        """
+        key = (tuple((s.url, s.client_id) for s in servers), fmt, keyid or servers[0].key_id)
+        future = asyncio.get_event_loop().create_future()
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = {"context": context, "servers": servers, "fmt": fmt, "keyid": keyid, "items": []}
+            batch["timer"] = asyncio.get_event_loop().call_later(self.window, self._send, key, batch)
+        batch["items"].append((hash_, future))
+        if len(batch["items"]) >= self.max_batch_size:
+            batch["timer"].cancel()
+            self._send(key, batch)
+        return await future
+
+    def _send(self, key, batch):
+        if self._batches.get(key) is batch:
+            del self._batches[key]
+        task = asyncio.ensure_future(self._sign_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _sign_batch(self, batch):
+        context, servers = batch["context"], batch["servers"]
+        hashes, futures = zip(*batch["items"])
+        log.debug("Signing a batch of %d %s hashes", len(hashes), batch["fmt"])
+        try:
+            async with _limit_concurrency(context, "autograph_semaphore"):
+                signatures = await sign_with_autograph(
+                    partial(utils.get_autograph_session, context),
+                    servers,
+                    [BytesIO(h) for h in hashes],
+                    batch["fmt"],
+                    "hash",
+                    batch["keyid"],
+                    selector=utils.get_autograph_selector(context),
+                )
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future, signature in zip(futures, signatures):
+                if not future.done():
+                    future.set_result(signature)
+
+
 def get_mar_verification_key(cert_type, fmt, keyid):
     """Get the public key file for the format/cert_type.
 
@@ -1080,7 +2215,7 @@ def get_mar_verification_key(cert_type, fmt, keyid):
         raise SigningScriptError(f"Can't find mar verify key for {fmt}, {cert_type} ({keyid}):\n{err}")
 
 
-def verify_mar_signature(cert_type, fmt, mar, keyid=None):
+def verify_mar_signature(cert_type, fmt, mar, keyid=None, mode="native"):
     """Verify a mar signature, via mardor.
 
     Args:
@@ -1088,12 +2223,40 @@ def verify_mar_signature(cert_type, fmt, mar, keyid=None):
         fmt (str): the signing format
         mar (str): the path to the mar file
         keyid (str, optional): the key id to use (can be None)
+        mode (str, optional): `native` to verify with the mardor library,
+            or `binary` to run mardor's `mar` script. Defaults to `native`.
 
     Raises:
         SigningScriptError: if the signature doesn't verify, or the nick isn't found
 
     """
     mar_verify_key = get_mar_verification_key(cert_type, fmt, keyid)
+    if mode == "native":
+        _verify_mar_signature_native(mar_verify_key, mar)
+    elif mode == "binary":
+        _verify_mar_signature_binary(mar_verify_key, mar)
+    else:
+        raise SigningScriptError("Unknown mar verification mode {}".format(mode))
+
+
+def _verify_mar_signature_native(mar_verify_key, mar):
+    log.info("Verifying %s with %s", mar, mar_verify_key)
+    with open(mar_verify_key, "rb") as fh:
+        key = fh.read()
+    try:
+        with open(mar, "rb") as fh, MarReader(fh) as m:
+            # Like the `mar` script, check that the mar is well formed first
+            errors = m.get_errors()
+            if errors:
+                raise SigningScriptError("{} is not well formed: {}".format(mar, errors))
+            if not m.verify(key):
+                raise SigningScriptError("Signature verification failed for {}".format(mar))
+    except (OSError, ValueError, ConstructError) as e:
+        raise SigningScriptError("Can't verify {}: {}".format(mar, e))
+    log.info("Verified signature.")
+
+
+def _verify_mar_signature_binary(mar_verify_key, mar):
     try:
         mar_path = os.path.join(os.path.dirname(sys.executable), "mar")
         cmd = [mar_path, "-k", mar_verify_key, "-v", mar]
@@ -1131,39 +2294,138 @@ async def sign_mar384_with_autograph_hash(context, from_, fmt, to=None, **kwargs
 
     hash_algo, expected_signature_length = "sha384", 512
 
-    # Add a dummy signature into a temporary file (TODO: dedup with mardor.cli do_hash)
-    with tempfile.TemporaryFile() as tmp:
-        with open(from_, "rb") as f:
-            add_signature_block(f, tmp, hash_algo)
-
-        tmp.seek(0)
-
-        with MarReader(tmp) as m:
-            hashes = m.calculate_hashes()
-        h = hashes[0][1]
-
-    signature = await sign_hash_with_autograph(context, h, fmt, keyid)
+    to = to or from_
+    layout = await _run_archive_job(context, _get_signed_mar_layout, from_, hash_algo, expected_signature_length)
+    signature = await sign_hash_with_autograph(context, layout["hash"], fmt, keyid)
 
-    # Add a signature to the MAR file (TODO: dedup with mardor.cli do_add_signature)
+    # Add a signature to the MAR file
     if len(signature) != expected_signature_length:
         raise SigningScriptError(
             "signed mar hash signature has invalid length for hash algo {}. Got {} expected {}.".format(hash_algo, len(signature), expected_signature_length)
         )
+    await _run_archive_job(context, _write_signed_mar, from_, to, layout, signature)
+    await _run_archive_job(context, verify_mar_signature, cert_type, fmt, to, keyid, mode=context.config.get("mar_verify_mode", "native"))
 
-    # use the tmp file in case param `to` is `from_` which causes stream errors
-    tmp_dst = tempfile.NamedTemporaryFile(mode="w+b", delete=False)
-    with open(tmp_dst.name, "w+b") as dst:
-        with open(from_, "rb") as src:
-            add_signature_block(src, dst, hash_algo, signature)
+    log.info("wrote mar with autograph signed hash %s to %s", from_, to)
+    return to
 
-    to = to or from_
-    shutil.copyfile(tmp_dst.name, to)
-    os.unlink(tmp_dst.name)
 
-    verify_mar_signature(cert_type, fmt, to, keyid)
+def _get_signed_mar_layout(path, hash_algo, signature_size):
+    """Work out the layout of the mar at `path` with a single signature, and hash it.
 
-    log.info("wrote mar with autograph signed hash %s to %s", from_, to)
-    return to
+    The hash covers the mar as `mardor.writer.add_signature_block` would
+    write it, but is calculated from the headers we'd write and a single
+    read of the original data, rather than from a dummy-signed copy.
+
+    Args:
+        path (str): the path to the mar
+        hash_algo (str): `sha1` or `sha384`
+        signature_size (int): the size of the signature
+
+    Returns:
+        dict: the `hash` to sign, the new `header` (with a blank signature)
+            and `index`, the `signature_offset` and `signature_size` in the
+            header, and the `data_offset` and `data_length` of the data to
+            copy from `path`
+
+    """
+    algo_id = {"sha1": 1, "sha384": 2}[hash_algo]
+    with open(path, "rb") as fh:
+        mardata = mar.parse_stream(fh)
+        sig = dict(algorithm_id=algo_id, size=signature_size, signature=b"\0" * signature_size)
+        sigs_size = len(sigs_header.build(dict(filesize=0, count=1, sigs=[sig])))
+        extras = extras_header.build(mardata.additional)
+        data_offset = len(mar_header.build(mardata.header)) + sigs_size + len(extras)
+        for e in mardata.index.entries:
+            e.offset += data_offset - mardata.data_offset
+        index = index_header.build(mardata.index)
+        mardata.header.index_offset = data_offset + mardata.data_length
+        filesize = mardata.header.index_offset + len(index)
+        header = mar_header.build(mardata.header) + sigs_header.build(dict(filesize=filesize, count=1, sigs=[sig])) + extras
+        # The signature itself is the only part of the file the hash doesn't cover
+        signature_offset = data_offset - len(extras) - signature_size
+        h = hashlib.new(hash_algo)
+        h.update(header[:signature_offset])
+        h.update(header[signature_offset + signature_size :])
+        fh.seek(mardata.data_offset)
+        remaining = mardata.data_length
+        while remaining:
+            block = fh.read(min(remaining, _ZIP_COPY_CHUNK_SIZE))
+            if not block:
+                raise SigningScriptError("Truncated mar {}".format(path))
+            h.update(block)
+            remaining -= len(block)
+        h.update(index)
+    return {
+        "hash": h.digest(),
+        "header": header,
+        "index": index,
+        "signature_offset": signature_offset,
+        "signature_size": signature_size,
+        "data_offset": mardata.data_offset,
+        "data_length": mardata.data_length,
+    }
+
+
+def _write_signed_mar(from_, to, layout, signature):
+    """Write the mar at `from_`, with `signature`, to `to`.
+
+    If `from_` already has the same layout, e.g. it's being re-signed, only
+    the signature is overwritten. Otherwise the signed mar is written to a
+    temporary file that's renamed to `to`.
+
+    Args:
+        from_ (str): the path to the mar
+        to (str): the path to write the signed mar to. This can be `from_`.
+        layout (dict): the layout from `_get_signed_mar_layout`
+        signature (bytes): the signature
+
+    """
+    header = layout["header"]
+    signature_offset = layout["signature_offset"]
+    signed_header = header[:signature_offset] + signature + header[signature_offset + layout["signature_size"] :]
+    if to == from_ and _has_signed_mar_layout(from_, layout):
+        log.debug("Overwriting the signature of %s", from_)
+        with open(from_, "r+b") as fh:
+            fh.seek(signature_offset)
+            fh.write(signature)
+        return
+    fd, tmp_path = tempfile.mkstemp(prefix=".signedmar", dir=os.path.dirname(os.path.abspath(to)))
+    try:
+        with open(from_, "rb") as src, os.fdopen(fd, "wb") as dst:
+            dst.write(signed_header)
+            src.seek(layout["data_offset"])
+            remaining = layout["data_length"]
+            while remaining:
+                block = src.read(min(remaining, _ZIP_COPY_CHUNK_SIZE))
+                if not block:
+                    raise SigningScriptError("Truncated mar {}".format(from_))
+                dst.write(block)
+                remaining -= len(block)
+            dst.write(layout["index"])
+        shutil.copymode(from_, tmp_path)
+        os.replace(tmp_path, to)
+    except BaseException:
+        rm(tmp_path)
+        raise
+
+
+def _has_signed_mar_layout(path, layout):
+    """Return True if the mar at `path` only differs from `layout` by its signature."""
+    header = layout["header"]
+    signature_start = layout["signature_offset"]
+    signature_end = signature_start + layout["signature_size"]
+    if layout["data_offset"] != len(header):
+        return False
+    with open(path, "rb") as fh:
+        existing_header = fh.read(len(header))
+        fh.seek(len(header) + layout["data_length"])
+        existing_index = fh.read()
+    return (
+        existing_header[:signature_start] == header[:signature_start]
+        and existing_header[signature_end:] == header[signature_end:]
+        and existing_index == layout["index"]
+    )
 
 
 @time_async_function
@@ -1225,13 +2487,10 @@ async def sign_omnija_with_autograph(context, from_):
 
     """
     signed_out = tempfile.mkstemp(prefix="oj_signed", suffix=".ja", dir=context.config["work_dir"])[1]
-    merged_out = tempfile.mkstemp(prefix="oj_merged", suffix=".ja", dir=context.config["work_dir"])[1]
 
     await sign_file_with_autograph(context, from_, "autograph_omnija", to=signed_out, extension_id="omni.ja@mozilla.org")
-    await merge_omnija_files(orig=from_, signed=signed_out, to=merged_out)
-    with open(from_, "wb") as fout:
-        with open(merged_out, "rb") as fin:
-            fout.write(fin.read())
+    # This replaces `from_` atomically once the merged file is complete
+    await merge_omnija_files(orig=from_, signed=signed_out, to=from_)
     return from_
 
 
@@ -1239,42 +2498,220 @@ async def sign_omnija_with_autograph(context, from_):
 async def merge_omnija_files(orig, signed, to):
     """Merge multiple omnijar files together.
 
-    This takes the original file, and reads it in, including performance
-    characteristics (e.g. jarlog ordering for preloading),
-    then adds data from the "signed" copy (the META-INF folder)
-    and finally writes it all out to a new omni.ja file.
+    This takes the original file, including performance characteristics
+    (e.g. jarlog ordering for preloading), then adds data from the "signed"
+    copy (the META-INF folder) and finally writes it all out to a new
+    omni.ja file.
+
+    The original entries' compressed data is streamed over as-is, so the
+    original is never loaded into memory or recompressed. The output is
+    the same as rebuilding the file with `mozjar.JarWriter`.
 
     Args:
-        context (Context): the signing context
         orig (str): the source file to sign
         signed (str): the signed file, without optimizations
-        to (str): the output path for the merge
+        to (str): the output path for the merge. This is written to a
+            temporary file that's renamed into place, so it can be `orig`.
+
+    Raises:
+        SigningScriptError: if `orig` isn't a valid jar
 
     Returns:
         bool: always True if function succeeded.
 
     """
-    orig_jarreader = mozjar.JarReader(orig)
-    with mozjar.JarWriter(to, compress=orig_jarreader.compression) as to_writer:
-        for origjarfile in orig_jarreader:
-            to_writer.add(origjarfile.filename, origjarfile, compress=origjarfile.compress)
-        # Use ZipFile here because mozjar can't read the signed copies
-        signed_zip = zipfile.ZipFile(signed, "r")
-        for fname in signed_zip.namelist():
-            if fname.startswith("META-INF"):
-                to_writer.add(fname, signed_zip.open(fname, "r"))
-        if orig_jarreader.last_preloaded:
-            jarlog = list(orig_jarreader.entries.keys())
-            preloads = jarlog[: jarlog.index(orig_jarreader.last_preloaded) + 1]
-            to_writer.preload(preloads)
+    await utils.run_in_executor(None, _merge_omnija_files_sync, orig, signed, to)
     return True
 
 
+def _merge_omnija_files_sync(orig, signed, to):
+    fd, tmp_path = tempfile.mkstemp(prefix=".merge", dir=os.path.dirname(os.path.abspath(to)))
+    try:
+        with open(orig, "rb") as fin, os.fdopen(fd, "wb") as fout:
+            orig_entries, last_preloaded = _read_jar_entries(fin)
+            compression = max([e["compression"] for e, _ in orig_entries] or [mozjar.JAR_STORED])
+            entries = [
+                (_make_jar_cdir_entry(e["filename"], e["compression"], e["crc32"], e["compressed_size"], e["uncompressed_size"]), data_offset)
+                for e, data_offset in orig_entries
+            ]
+            # Use ZipFile here because mozjar can't read the signed copies
+            with zipfile.ZipFile(signed, "r") as signed_zip:
+                for fname in signed_zip.namelist():
+                    if fname.startswith("META-INF"):
+                        deflater = mozjar.Deflater(compression)
+                        deflater.write(signed_zip.open(fname, "r").read())
+                        entry = _make_jar_cdir_entry(
+                            fname,
+                            deflater.compress if deflater.compressed else mozjar.JAR_STORED,
+                            deflater.crc32,
+                            deflater.compressed_size,
+                            deflater.uncompressed_size,
+                        )
+                        entries.append((entry, deflater.compressed_data))
+            _write_jar(fin, fout, entries, last_preloaded)
+        shutil.copymode(orig, tmp_path)
+        os.replace(tmp_path, to)
+    except BaseException:
+        rm(tmp_path)
+        raise
+
+
+def _read_jar_entries(fh):
+    """Read the central directory of the jar `fh`.
+
+    Returns:
+        tuple: a list of (JarCdirEntry, data offset) for each file, in order,
+            and the name of the last preloaded file, or None.
+
+    """
+    fh.seek(0, os.SEEK_END)
+    size = fh.tell()
+    tail_size = min(size, mozjar.CDIR_END_SIZE + 0xFFFF)
+    fh.seek(size - tail_size)
+    tail = fh.read(tail_size)
+    # Like mozjar.JarReader, use the last end of central directory record
+    end_offset = tail.rfind(struct.pack("<I", mozjar.JarCdirEnd.MAGIC))
+    if end_offset < 0:
+        raise SigningScriptError("Not a jar?")
+    cdir_end = mozjar.JarCdirEnd(tail[end_offset:])
+    preload = 0
+    # Optimized jars have the central directory at the start of the file,
+    # after the size of the data to preload
+    if cdir_end["cdir_offset"] == 4:
+        fh.seek(0)
+        preload = struct.unpack("<I", fh.read(4))[0]
+    fh.seek(cdir_end["cdir_offset"])
+    cdir = fh.read(cdir_end["cdir_size"])
+    entries = []
+    last_preloaded = None
+    offset = 0
+    for _ in range(cdir_end["cdir_entries"]):
+        entry = mozjar.JarCdirEntry(cdir[offset:])
+        offset += entry.size
+        # Skip directories, like mozjar.JarReader does
+        host = entry["creator_version"] >> 8
+        xattr = entry["external_attr"]
+        if (host == 0 and xattr & 0x10) or (host == 3 and xattr & (0o040000 << 16)):
+            continue
+        if entry["compression"] not in (mozjar.JAR_STORED, mozjar.JAR_DEFLATED, mozjar.JAR_BROTLI):
+            raise SigningScriptError("Unknown compression for {}".format(entry["filename"]))
+        fh.seek(entry["offset"])
+        header = fh.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader or struct.unpack("<I", header[:4])[0] != mozjar.JarLocalFileHeader.MAGIC:
+            raise SigningScriptError("Bad local file header for {}".format(entry["filename"]))
+        name_size, extra_size = struct.unpack("<HH", header[-4:])
+        entries.append((entry, entry["offset"] + zipfile.sizeFileHeader + name_size + extra_size))
+        if entry["offset"] < preload:
+            last_preloaded = entry["filename"]
+    return entries, last_preloaded
+
+
+def _make_jar_cdir_entry(filename, compression, crc32, compressed_size, uncompressed_size):
+    """Return the central directory entry `mozjar.JarWriter.add` would write."""
+    entry = mozjar.JarCdirEntry()
+    entry["creator_version"] = 20
+    if compression != mozjar.JAR_STORED:
+        entry["min_version"] = 20
+        entry["general_flag"] = 2
+    else:
+        entry["min_version"] = 10
+        entry["general_flag"] = 0
+    entry["compression"] = compression
+    # January 1st, 2010. See bug 592369.
+    entry["lastmod_date"] = ((2010 - 1980) << 9) | (1 << 5) | 1
+    entry["lastmod_time"] = 0
+    entry["crc32"] = crc32
+    entry["compressed_size"] = compressed_size
+    entry["uncompressed_size"] = uncompressed_size
+    entry["filename"] = filename
+    return entry
+
+
+def _write_jar(fin, fout, entries, last_preloaded):
+    """Write a jar, laid out like `mozjar.JarWriter.finish` does.
+
+    Args:
+        fin (file): the jar to copy data from
+        fout (file): the file to write the jar to
+        entries (list): (JarCdirEntry, data) for each file, where data is
+            either bytes, or the offset in `fin` to copy `compressed_size`
+            bytes from
+        last_preloaded (str): the name of the last file to preload, or None
+
+    """
+    offset = 0
+    headers = []
+    preload_size = 0
+    for entry, _ in entries:
+        header = mozjar.JarLocalFileHeader()
+        for name in entry.STRUCT:
+            if name in header:
+                header[name] = entry[name]
+        entry["offset"] = offset
+        offset += entry["compressed_size"] + header.size
+        if entry["filename"] == last_preloaded:
+            preload_size = offset
+        headers.append(header)
+    end = mozjar.JarCdirEnd()
+    end["disk_entries"] = len(entries)
+    end["cdir_entries"] = end["disk_entries"]
+    end["cdir_size"] = sum(entry.size for entry, _ in entries)
+    if preload_size:
+        end["cdir_offset"] = 4
+        offset = end["cdir_size"] + end["cdir_offset"] + end.size
+        preload_size += offset
+        fout.write(struct.pack("<I", preload_size))
+        for entry, _ in entries:
+            entry["offset"] += offset
+            fout.write(entry.serialize())
+        fout.write(end.serialize())
+    for header, (entry, data) in zip(headers, entries):
+        fout.write(header.serialize())
+        if isinstance(data, bytes):
+            fout.write(data)
+            continue
+        fin.seek(data)
+        remaining = entry["compressed_size"]
+        while remaining:
+            block = fin.read(min(remaining, _ZIP_COPY_CHUNK_SIZE))
+            if not block:
+                raise SigningScriptError("Truncated jar member {}".format(entry["filename"]))
+            fout.write(block)
+            remaining -= len(block)
+    if not preload_size:
+        end["cdir_offset"] = offset
+        for entry, _ in entries:
+            fout.write(entry.serialize())
+    fout.write(end.serialize())
+
+
 # sign_authenticode_file {{{1
+def _sign_file_in_thread(call_signer, infile, outfile, digest_algo, certs, **kwargs):
+    """Run `winsign.sign.sign_file` on a new event loop in this worker thread.
+
+    `sign_file` digests and rewrites the file with blocking `osslsigncode`
+    calls, so it can't run on the main event loop. Its signer calls
+    `call_signer`, which signs on the main loop and returns a
+    `concurrent.futures.Future`.
+
+    Returns:
+        True on success, False otherwise
+
+    """
+    async def signer(digest, digest_algo):
+        return await asyncio.wrap_future(call_signer(digest, digest_algo))
+
+    return asyncio.run(winsign.sign.sign_file(infile, outfile, digest_algo, certs, signer, **kwargs))
+
+
 @time_async_function
-async def sign_authenticode_file(context, orig_path, fmt, *, authenticode_comment=None):
+async def sign_authenticode_file(context, orig_path, fmt, *, authenticode_comment=None, executor=None, check_signed=True):
     """Sign a file in-place with authenticode, using autograph as a backend.
 
+    `winsign.sign.sign_file` runs in `executor`, since it blocks while
+    `osslsigncode` digests the file, and its hashes are signed with autograph
+    on this event loop.
+
     Args:
         context (Context): the signing context
         orig_path (str): the source file to sign
@@ -1282,12 +2719,17 @@ async def sign_authenticode_file(context, orig_path, fmt, *, authenticode_commen
         comment (str): The authenticode comment to sign with, if present.
                        currently only used for msi files.
                        (Defaults to None)
+        executor (concurrent.futures.ThreadPoolExecutor, optional): where to
+            run the blocking steps. Defaults to the loop's default executor.
+        check_signed (bool, optional): whether to skip `orig_path` if it's
+            already signed. Callers that already know it isn't can pass
+            False. Defaults to True.
 
     Returns:
         True on success, False otherwise
 
     """
-    if winsign.osslsigncode.is_signed(orig_path):
+    if check_signed and await utils.run_in_executor(executor, winsign.osslsigncode.is_signed, orig_path):
         log.info("%s is already signed", orig_path)
         return True
 
@@ -1300,6 +2742,16 @@ async def sign_authenticode_file(context, orig_path, fmt, *, authenticode_commen
             log.exception("Error signing authenticode hash with autograph")
             raise
 
+    loop = asyncio.get_event_loop()
+    signer_futures = []
+    cancelled = False
+
+    def call_signer(digest, digest_algo):
+        if cancelled:
+            raise asyncio.CancelledError()
+        signer_futures.append(asyncio.run_coroutine_threadsafe(signer(digest, digest_algo), loop))
+        return signer_futures[-1]
+
     infile = orig_path
     outfile = orig_path + "-new"
     if "authenticode_ev" in fmt:
@@ -1325,9 +2777,30 @@ async def sign_authenticode_file(context, orig_path, fmt, *, authenticode_commen
         log.info("Not using specified comment to sign %s, not yet implemented for non *.msi files.", orig_path)
         authenticode_comment = None
 
-    if not await winsign.sign.sign_file(
-        infile, outfile, digest_algo, certs, signer, url=url, comment=authenticode_comment, crosscert=crosscert, timestamp_style=timestamp_style,
-    ):
+    try:
+        signed = await utils.run_in_executor(
+            executor,
+            partial(
+                _sign_file_in_thread,
+                call_signer,
+                infile,
+                outfile,
+                digest_algo,
+                certs,
+                url=url,
+                comment=authenticode_comment,
+                crosscert=crosscert,
+                timestamp_style=timestamp_style,
+            ),
+        )
+    except asyncio.CancelledError:
+        # The thread can't be cancelled, but it stops once its autograph
+        # requests are
+        cancelled = True
+        for future in signer_futures:
+            future.cancel()
+        raise
+    if not signed:
         raise IOError(f"Couldn't sign {orig_path}")
     os.rename(outfile, infile)
 
@@ -1342,6 +2815,11 @@ async def sign_authenticode_zip(context, orig_path, fmt, *, authenticode_comment
     Extract the zip and only sign unsigned files that don't match certain
     patterns (see `_should_sign_windows`). Then recreate the zip.
 
+    At most `max_concurrent_authenticode_files` files are signed at once, and
+    their blocking `osslsigncode` steps run in a pool of as many threads.
+    Progress is logged every
+    `authenticode_progress_interval` files.
+
     Args:
         context (Context): the signing context
         orig_path (str): the source file to sign
@@ -1368,11 +2846,53 @@ async def sign_authenticode_zip(context, orig_path, fmt, *, authenticode_comment
     files_to_sign = [file for file in files if _should_sign_windows(file)]
     if not files_to_sign:
         raise SigningScriptError("Did not find any files to sign, all files: {}".format(files))
+    # Check PE headers up front, so already signed files (like the Microsoft
+    # runtime dlls) aren't checked with osslsigncode one by one. Files that
+    # aren't PE files, like msis, are still checked by `sign_authenticode_file`.
+    signed_states = await asyncio.gather(*[utils.run_in_executor(None, _is_signed_pe_file, file_) for file_ in files_to_sign])
+    already_signed = [file_ for file_, signed in zip(files_to_sign, signed_states) if signed]
+    if already_signed:
+        log.info("Skipping %d already signed files in %s: %s", len(already_signed), orig_path, [os.path.basename(f) for f in already_signed])
+    check_signed = {file_: signed is None for file_, signed in zip(files_to_sign, signed_states) if not signed}
+    files_to_sign = list(check_signed)
 
     # Sign the appropriate inner files
-    tasks = [sign_authenticode_file(context, file_, fmt, authenticode_comment=authenticode_comment) for file_ in files_to_sign]
-    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
-    [f.result() for f in done]
+    max_concurrent = context.config.get("max_concurrent_authenticode_files", 20)
+    semaphore = asyncio.Semaphore(max_concurrent)
+    interval = context.config.get("authenticode_progress_interval", 50)
+    progress = {"files": 0, "bytes": 0}
+    start = time.time()
+
+    async def sign_one(file_, executor):
+        async with semaphore:
+            await sign_authenticode_file(context, file_, fmt, authenticode_comment=authenticode_comment, executor=executor, check_signed=check_signed[file_])
+        progress["files"] += 1
+        progress["bytes"] += os.path.getsize(file_)
+        if progress["files"] % interval == 0 or progress["files"] == len(files_to_sign):
+            elapsed = max(time.time() - start, 1e-6)
+            log.info(
+                "Signed %d/%d authenticode files in %s; %.1f files/s, %.1f MB/s",
+                progress["files"],
+                len(files_to_sign),
+                orig_path,
+                progress["files"] / elapsed,
+                progress["bytes"] / elapsed / 1024 / 1024,
+            )
+
+    if files_to_sign:
+        executor = ThreadPoolExecutor(max_workers=min(max_concurrent, len(files_to_sign)))
+        try:
+            tasks = [asyncio.ensure_future(sign_one(file_, executor)) for file_ in files_to_sign]
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task_ in pending:
+                task_.cancel()
+            # Let the cancelled tasks finish before raising the first error
+            await asyncio.gather(*pending, return_exceptions=True)
+            [f.result() for f in done]
+        finally:
+            # Waiting for the worker threads to exit blocks, so don't do it on
+            # the event loop
+            await utils.run_in_executor(None, executor.shutdown)
     if file_extension == ".zip":
         # Recreate the zipfile
         await _create_zipfile(context, orig_path, files, tmp_dir=tmp_dir)
@@ -15,6 +15,7 @@ from scriptworker.exceptions import TaskVerificationError
 from scriptworker.utils import get_single_item_from_sequence
 
 from signingscript.sign import (
+    sign_archive_members,
     sign_authenticode_zip,
     sign_file,
     sign_gpg,
@@ -55,6 +56,12 @@ FORMAT_TO_SIGNING_FUNCTION = immutabledict(
 )
 
 
+# Formats that sign members inside an archive. When these are next to each
+# other in the signing formats, `sign` does them together with
+# `sign_archive_members`, which only unpacks and repacks the archive once.
+ARCHIVE_MEMBER_FORMATS = frozenset(("widevine", "autograph_widevine", "autograph_omnija"))
+
+
 # task_cert_type {{{1
 def task_cert_type(context):
     """Extract task certificate type.
@@ -139,14 +146,19 @@ async def sign(context, path, signing_formats, **kwargs):
 
     """
     output = path
-    # Loop through the formats and sign one by one.
-    for fmt in signing_formats:
-        signing_func = _get_signing_function_from_format(fmt)
+    plan = _plan_signing(signing_formats)
+    log.info("sign(): Signing %s in %d steps: %s", path, len(plan), " -> ".join("+".join(step) for step in plan))
+    # Loop through the steps and sign one by one.
+    for step in plan:
+        if len(step) > 1:
+            signing_func, fmt = sign_archive_members, step
+        else:
+            signing_func, fmt = _get_signing_function_from_format(step[0]), step[0]
         try:
             size = os.path.getsize(output)
         except OSError:
             size = "??"
-        log.info("sign(): Signing %s bytes in %s with %s...", size, output, fmt)
+        log.info("sign(): Signing %s bytes in %s with %s...", size, output, "+".join(step))
         output = await signing_func(context, output, fmt, **kwargs)
     # We want to return a list
     if not isinstance(output, (tuple, list)):
@@ -154,6 +166,32 @@ async def sign(context, path, signing_formats, **kwargs):
     return output
 
 
+def _plan_signing(signing_formats):
+    """Group the signing formats into the steps `sign` runs, in order.
+
+    Consecutive `ARCHIVE_MEMBER_FORMATS` are fused into one step. The order
+    of the formats, e.g. from `_sort_formats`, is kept.
+
+    Args:
+        signing_formats (list): the formats to sign with
+
+    Returns:
+        list: a list of the formats for each step
+
+    """
+    plan = []
+    for fmt in signing_formats:
+        if plan and _is_archive_member_format(fmt) and _is_archive_member_format(plan[-1][-1]):
+            plan[-1].append(fmt)
+        else:
+            plan.append([fmt])
+    return plan
+
+
+def _is_archive_member_format(fmt):
+    return fmt.split(":")[0] in ARCHIVE_MEMBER_FORMATS
+
+
 def _get_signing_function_from_format(fmt):
     return FORMAT_TO_SIGNING_FUNCTION.get(fmt.split(":")[0], FORMAT_TO_SIGNING_FUNCTION["default"])
 
@@ -1,18 +1,52 @@
 """Signingscript general utility functions."""
 import asyncio
+import bz2
+import contextvars
+import fcntl
 import functools
 import hashlib
 import json
 import logging
 import os
+import resource
+import struct
+import tempfile
+import threading
+import time
+import zlib
 from asyncio.subprocess import PIPE, STDOUT
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
-from shutil import copyfile
+from shutil import copyfile, copyfileobj
+
+import aiohttp
 
 from signingscript.exceptions import FailedSubprocess, SigningServerError
 
 log = logging.getLogger(__name__)
 
+# ioctl to share a file's data with another file on the same filesystem, from
+# linux/fs.h
+FICLONE = 0x40049409
+
+# Connection settings for each autograph server. These can be overridden for
+# all servers with the `autograph_connection` config, and per `Autograph.url`
+# with `autograph_connection_overrides`.
+AUTOGRAPH_CONNECTION_DEFAULTS = {
+    # max simultaneous connections to the server
+    "limit_per_host": 20,
+    # seconds to cache dns lookups
+    "ttl_dns_cache": 300,
+    # seconds to keep idle connections open for reuse
+    "keepalive_timeout": 60,
+    # timeouts, in seconds
+    "total_timeout": 300,
+    "sock_connect_timeout": 30,
+    "sock_read_timeout": 120,
+}
+
 
 @dataclass
 class Autograph:
@@ -25,6 +59,584 @@ class Autograph:
     key_id: str = None
 
 
+@dataclass
+class AutographServerStats:
+    """Connection statistics for a single autograph server."""
+
+    requests: int = 0
+    connections_opened: int = 0
+    connections_reused: int = 0
+    connection_wait_time: float = 0.0
+
+
+class AutographSessions:
+    """The aiohttp sessions to talk to autograph, one per `Autograph.url`.
+
+    Each server gets its own connection pool, so connections are kept alive
+    and reused across the many small requests of e.g. hash signing.
+
+    Attributes:
+        config (dict): the signingscript config
+        sessions (dict): `Autograph.url` to aiohttp.ClientSession
+        stats (dict): `Autograph.url` to AutographServerStats
+
+    """
+
+    def __init__(self, config):
+        """Initialize AutographSessions."""
+        self.config = config
+        self.sessions = {}
+        self.stats = {}
+
+    def get_connection_config(self, url):
+        """Return the connection settings for the server at `url`."""
+        return {
+            **AUTOGRAPH_CONNECTION_DEFAULTS,
+            **self.config.get("autograph_connection", {}),
+            **self.config.get("autograph_connection_overrides", {}).get(url, {}),
+        }
+
+    def _create_trace_config(self, stats):
+        async def on_request_start(session, ctx, params):
+            stats.requests += 1
+
+        async def on_connection_queued_start(session, ctx, params):
+            ctx.queued_start = time.monotonic()
+
+        async def on_connection_queued_end(session, ctx, params):
+            stats.connection_wait_time += time.monotonic() - ctx.queued_start
+
+        async def on_connection_create_end(session, ctx, params):
+            stats.connections_opened += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            stats.connections_reused += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_queued_start.append(on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(on_connection_queued_end)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def get_session(self, url):
+        """Return the session for the server at `url`, creating it if needed.
+
+        Args:
+            url (str): the `Autograph.url` of the server
+
+        Returns:
+            aiohttp.ClientSession: the session
+
+        """
+        if url not in self.sessions:
+            cfg = self.get_connection_config(url)
+            log.debug("Creating autograph session for %s: %s", url, cfg)
+            connector = aiohttp.TCPConnector(
+                limit_per_host=cfg["limit_per_host"], ttl_dns_cache=cfg["ttl_dns_cache"], keepalive_timeout=cfg["keepalive_timeout"]
+            )
+            timeout = aiohttp.ClientTimeout(total=cfg["total_timeout"], sock_connect=cfg["sock_connect_timeout"], sock_read=cfg["sock_read_timeout"])
+            self.stats[url] = AutographServerStats()
+            self.sessions[url] = aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[self._create_trace_config(self.stats[url])])
+        return self.sessions[url]
+
+    def log_stats(self):
+        """Log the connection statistics for each server."""
+        for url, stats in self.stats.items():
+            log.info(
+                "autograph %s: %d requests, %d connections opened, %d reused, %.2fs waiting for a connection",
+                url,
+                stats.requests,
+                stats.connections_opened,
+                stats.connections_reused,
+                stats.connection_wait_time,
+            )
+
+    async def close(self):
+        """Close all the sessions."""
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions = {}
+
+
+def get_autograph_session(context, server):
+    """Return the aiohttp session to use to talk to `server`.
+
+    Args:
+        context (Context): the signing context
+        server (Autograph): the autograph server
+
+    Returns:
+        aiohttp.ClientSession: `server`'s session from `context.autograph_sessions`,
+            if set, or `context.session` otherwise
+
+    """
+    autograph_sessions = getattr(context, "autograph_sessions", None)
+    if autograph_sessions is None:
+        return context.session
+    return autograph_sessions.get_session(server.url)
+
+
+def is_autograph_server_error(e):
+    """Return whether `e` means the server, rather than the request, failed.
+
+    Connection errors, timeouts and 5xx responses are worth retrying on a
+    different server; anything else, e.g. a 4xx, would fail there too.
+
+    """
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status >= 500
+    return isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+@dataclass
+class AutographServerHealth:
+    """Load and health statistics for a single autograph server."""
+
+    outstanding: int = 0
+    requests: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    latency: float = None
+    open_until: float = 0.0
+
+
+class AutographServerSelector:
+    """Spread autograph requests across the servers that can handle them.
+
+    Servers are ordered by the fewest outstanding requests, then by their
+    average latency. A server that fails `failure_threshold` times in a row
+    is skipped for `cooldown` seconds; after that it gets another try, and a
+    success closes the circuit again. If every server is skipped, they're
+    all tried anyway, since failing the task is worse.
+
+    Attributes:
+        failure_threshold (int): consecutive failures before skipping a server
+        cooldown (float): how long to skip a failing server for, in seconds
+        health (dict): `Autograph.url` to AutographServerHealth
+
+    """
+
+    # Weight of the latest request in the average latency.
+    LATENCY_WEIGHT = 0.3
+
+    def __init__(self, failure_threshold, cooldown):
+        """Initialize AutographServerSelector."""
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.health = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """Create an AutographServerSelector from the signingscript config."""
+        return cls(config["autograph_circuit_breaker_failures"], config["autograph_circuit_breaker_cooldown"])
+
+    def _get_health(self, server):
+        return self.health.setdefault(server.url, AutographServerHealth())
+
+    def is_available(self, server):
+        """Return whether `server`'s circuit is closed, or its cooldown is over."""
+        return self._get_health(server).open_until <= time.monotonic()
+
+    def order(self, servers):
+        """Return `servers` sorted from the best to the worst one to send a request to."""
+
+        def key(server):
+            health = self._get_health(server)
+            return (not self.is_available(server), health.outstanding, health.latency or 0.0)
+
+        return sorted(servers, key=key)
+
+    @contextmanager
+    def track(self, server):
+        """Count a request to `server` as outstanding, and record how it went."""
+        health = self._get_health(server)
+        health.outstanding += 1
+        health.requests += 1
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            if is_autograph_server_error(e):
+                self.record_failure(server)
+            raise
+        else:
+            elapsed = time.monotonic() - start
+            health.latency = elapsed if health.latency is None else (1 - self.LATENCY_WEIGHT) * health.latency + self.LATENCY_WEIGHT * elapsed
+            health.consecutive_failures = 0
+            health.open_until = 0.0
+        finally:
+            health.outstanding -= 1
+
+    def record_failure(self, server):
+        """Record a server side failure, opening `server`'s circuit if it keeps failing."""
+        health = self._get_health(server)
+        health.failures += 1
+        health.consecutive_failures += 1
+        if health.consecutive_failures >= self.failure_threshold:
+            if self.is_available(server):
+                log.warning("autograph %s failed %d times in a row; skipping it for %ss", server.url, health.consecutive_failures, self.cooldown)
+            health.open_until = time.monotonic() + self.cooldown
+
+    def log_stats(self):
+        """Log the load and health statistics for each server."""
+        for url, health in self.health.items():
+            log.info(
+                "autograph %s: %d requests, %d failures, %s average latency",
+                url,
+                health.requests,
+                health.failures,
+                "n/a" if health.latency is None else "{:.2f}s".format(health.latency),
+            )
+
+
+def get_autograph_selector(context):
+    """Return the AutographServerSelector to use, or None to try servers in config order."""
+    return getattr(context, "autograph_selector", None)
+
+
+class SignatureCache:
+    """An on-disk cache of signatures, keyed by what was signed and how.
+
+    Entries are stored as `cache_dir/<key[:2]>/<key>`. An entry's mtime is
+    when it was written, and is used to expire it after `ttl` seconds; its
+    atime is when it was last used, and the least recently used entries are
+    evicted once the cache grows past `max_size` bytes.
+
+    Only the `formats` that always produce the same signature for the same
+    input should be cached; formats that embed timestamps must not be.
+
+    Attributes:
+        cache_dir (str): the directory to store the cache in
+        formats (set): the signing formats to cache
+        max_size (int): the maximum size of the cache, in bytes
+        ttl (int): the maximum age of a cache entry, in seconds
+        hits (int): the number of lookups that found an entry
+        misses (int): the number of lookups that didn't
+
+    """
+
+    def __init__(self, cache_dir, formats, max_size, ttl):
+        """Initialize SignatureCache."""
+        self.cache_dir = cache_dir
+        self.formats = set(formats)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a SignatureCache from the config, or return None if it's disabled."""
+        if not config.get("signature_cache_dir") or not config.get("signature_cache_formats"):
+            return None
+        return cls(config["signature_cache_dir"], config["signature_cache_formats"], config["signature_cache_max_size"], config["signature_cache_ttl"])
+
+    @staticmethod
+    def get_key(digest, fmt, keyid=None, cert_type=None, extension_id=None):
+        """Return the cache key for a signature.
+
+        Args:
+            digest (str): the sha256 hexdigest of the input
+            fmt (str): the signing format
+            keyid (str or list, optional): the key the input is signed with, or
+                every server and key it may be signed with
+            cert_type (str, optional): the cert scope string
+            extension_id (str, optional): the extension id the input is signed with
+
+        Returns:
+            str: the key
+
+        """
+        return hashlib.sha256(json.dumps([digest, fmt, keyid, cert_type, extension_id]).encode("utf-8")).hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _lookup(self, key):
+        path = self._get_path(key)
+        try:
+            stat = os.stat(path)
+            if stat.st_mtime + self.ttl < time.time():
+                log.debug("Signature cache entry %s has expired", key)
+                os.remove(path)
+                path = None
+            else:
+                # Mark the entry as recently used
+                os.utime(path, (time.time(), stat.st_mtime))
+        except OSError:
+            path = None
+        if path is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return path
+
+    def get(self, key):
+        """Return the cached signature for `key`, or None if there isn't one."""
+        path = self._lookup(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as fh:
+                return fh.read()
+        except OSError as e:
+            log.warning("Can't read signature cache entry %s: %s", key, e)
+            return None
+
+    def get_file(self, key, to):
+        """Copy the cached signed file for `key` to `to`.
+
+        Returns:
+            bool: whether there was a cached file to copy
+
+        """
+        path = self._lookup(key)
+        if path is None:
+            return False
+        try:
+            copyfile(path, to)
+            return True
+        except OSError as e:
+            log.warning("Can't read signature cache entry %s: %s", key, e)
+            return False
+
+    def put(self, key, data):
+        """Cache the signature `data` for `key`."""
+        self._put(key, lambda fh: fh.write(data))
+
+    def put_file(self, key, path):
+        """Cache the signed file at `path` for `key`."""
+
+        def write(fh):
+            with open(path, "rb") as src:
+                copyfileobj(src, fh)
+
+        self._put(key, write)
+
+    def _put(self, key, write):
+        path = self._get_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=".tmp", dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as fh:
+                    write(fh)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            if self._size is None:
+                self.evict()
+            else:
+                self._size += os.path.getsize(path)
+                if self._size > self.max_size:
+                    self.evict()
+        except OSError as e:
+            log.warning("Can't write signature cache entry %s: %s", key, e)
+
+    def evict(self):
+        """Remove the expired entries, then the least recently used ones until the cache fits in `max_size`."""
+        entries = []
+        now = time.time()
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_mtime + self.ttl < now:
+                        os.remove(path)
+                    else:
+                        entries.append((stat.st_atime, stat.st_size, path))
+                except OSError:
+                    pass
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self._size <= self.max_size:
+                break
+            try:
+                log.debug("Evicting %s from the signature cache", path)
+                os.remove(path)
+                self._size -= size
+            except OSError:
+                pass
+
+    def log_stats(self):
+        """Log the cache hits and misses."""
+        log.info("signature cache: %d hits, %d misses", self.hits, self.misses)
+
+
+def get_signature_cache(context, fmt):
+    """Return the SignatureCache to use for `fmt`.
+
+    Args:
+        context (Context): the signing context
+        fmt (str): the signing format
+
+    Returns:
+        SignatureCache: `context.signature_cache`, if set and `fmt` is cached,
+            or None otherwise
+
+    """
+    cache = getattr(context, "signature_cache", None)
+    if cache is None or fmt not in cache.formats:
+        return None
+    return cache
+
+
+# The `TraceRecorder` for this task, and the span being recorded in the
+# current asyncio task or thread, if any.
+_trace_recorder = contextvars.ContextVar("trace_recorder", default=None)
+_trace_span = contextvars.ContextVar("trace_span", default=None)
+
+
+def get_rss():
+    """Return the maximum resident set size for this process."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class TraceRecorder:
+    """Record nested timing spans, and write them out as a Chrome trace.
+
+    Each asyncio task and each thread gets its own track (`tid`), so the
+    spans on a track nest, even though files are signed concurrently. The
+    output loads in `chrome://tracing` or https://ui.perfetto.dev.
+
+    Attributes:
+        start (float): when recording started
+        events (list): the Chrome trace events recorded so far
+
+    """
+
+    def __init__(self):
+        """Initialize TraceRecorder."""
+        self.start = time.time()
+        self.events = []
+        self._tracks = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a TraceRecorder, or return None if `signing_trace_path` isn't set."""
+        if not config.get("signing_trace_path"):
+            return None
+        return cls()
+
+    def _get_track(self):
+        try:
+            key = ("task", id(asyncio.current_task()))
+        except RuntimeError:
+            key = ("thread", threading.get_ident())
+        with self._lock:
+            return self._tracks.setdefault(key, len(self._tracks) + 1)
+
+    def add_span(self, name, start, end, args, track):
+        """Record a finished span.
+
+        Args:
+            name (str): the name of the span
+            start (float): when the span started, from `time.time()`
+            end (float): when the span ended, from `time.time()`
+            args (dict): details of the span
+            track (int): the track the span is on
+
+        """
+        event = {
+            "name": name,
+            "cat": "signingscript",
+            "ph": "X",
+            "ts": int((start - self.start) * 1000000),
+            "dur": int((end - start) * 1000000),
+            "pid": os.getpid(),
+            "tid": track,
+            "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def write(self, path):
+        """Write the recorded spans to `path` as Chrome trace JSON."""
+        mkdir(os.path.dirname(path))
+        with self._lock:
+            events = sorted(self.events, key=lambda event: (event["tid"], event["ts"]))
+        with open(path, "w") as fh:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"start": self.start}}, fh)
+        log.info("Wrote %d trace spans to %s", len(events), path)
+
+
+def set_trace_recorder(recorder):
+    """Record the spans of this asyncio task, and the tasks and threads it starts, in `recorder`."""
+    _trace_recorder.set(recorder)
+
+
+@contextmanager
+def trace_span(name, **args):
+    """Time the code in the block, as a span of the current `TraceRecorder`.
+
+    The duration and RSS change are always logged at debug level. Values of
+    `args` that are None are left out.
+
+    Args:
+        name (str): the name of the span, e.g. the function name
+        **args: details of the span, e.g. the path and format being signed
+
+    Yields:
+        dict: the span's args, which the block can add to, e.g. with `trace_annotate`
+
+    """
+    recorder = _trace_recorder.get()
+    span_args = {key: value for key, value in args.items() if value is not None}
+    start = time.time()
+    start_rss = get_rss()
+    track = recorder._get_track() if recorder is not None else None
+    token = _trace_span.set(span_args)
+    try:
+        yield span_args
+    except BaseException as e:
+        span_args["error"] = type(e).__name__
+        raise
+    finally:
+        _trace_span.reset(token)
+        end = time.time()
+        rss = get_rss()
+        log.debug("%s took %.2fs; RSS:%s (%+d)", name, end - start, rss, rss - start_rss)
+        if recorder is not None:
+            span_args.update(rss=rss, rss_delta=rss - start_rss)
+            recorder.add_span(name, start, end, span_args, track)
+
+
+def trace_annotate(**args):
+    """Add `args` to the current trace span, if there is one."""
+    span_args = _trace_span.get()
+    if span_args is not None:
+        span_args.update({key: value for key, value in args.items() if value is not None})
+
+
+def run_in_executor(executor, func, *args):
+    """Run `func(*args)` in `executor`, like `loop.run_in_executor`.
+
+    Threads don't inherit the caller's contextvars, so the function runs in
+    a copy of the current context, and its `trace_span`s are recorded. A
+    process pool can't be sent the context, so functions there run as is.
+
+    Args:
+        executor (concurrent.futures.Executor): where to run `func`, or None
+            for the loop's default executor
+        func (callable): the function to run
+        *args: the arguments to call `func` with
+
+    Returns:
+        asyncio.Future: the result of `func`
+
+    """
+    loop = asyncio.get_event_loop()
+    if isinstance(executor, ProcessPoolExecutor):
+        return loop.run_in_executor(executor, func, *args)
+    return loop.run_in_executor(executor, contextvars.copy_context().run, func, *args)
+
+
 def mkdir(path):
     """Equivalent to `mkdir -p`.
 
@@ -109,14 +721,88 @@ async def log_output(fh, log_level=logging.INFO):
             break
 
 
-def copy_to_dir(source, parent_dir, target=None):
+def _copy_file_data(fsrc, fdst, size):
+    """Copy `size` bytes between file descriptors in the kernel.
+
+    Uses `os.copy_file_range` where available, which can share blocks on
+    filesystems that support it, and `os.sendfile` otherwise.
+
+    Returns:
+        str: the method used
+
+    Raises:
+        OSError: if neither works between these files
+
+    """
+    if hasattr(os, "copy_file_range"):
+        method, copy = "copy_file_range", lambda offset: os.copy_file_range(fsrc, fdst, size - offset, offset, offset)
+    else:
+        method, copy = "sendfile", lambda offset: os.sendfile(fdst, fsrc, offset, size - offset)
+    offset = 0
+    while offset < size:
+        copied = copy(offset)
+        if not copied:
+            raise OSError("{} copied nothing at offset {}".format(method, offset))
+        offset += copied
+    return method
+
+
+def stage_file(source, target_path, link=False):
+    """Copy `source` to `target_path`, without reading it into python if possible.
+
+    In order, this tries a hardlink (only if `link` is True), a reflink, an
+    in-kernel copy, and then a regular copy. All but the hardlink leave
+    `target_path` independent of `source`, so only ask for a hardlink if
+    neither file will be modified in place afterwards.
+
+    Args:
+        source (str): the source path
+        target_path (str): the target path. Any existing file is replaced.
+        link (bool, optional): whether `target_path` may be a hardlink to
+            `source`. Defaults to False.
+
+    Returns:
+        str: the method used, one of `link`, `reflink`, `copy_file_range`,
+            `sendfile` or `copy`
+
+    """
+    if link:
+        if os.path.lexists(target_path):
+            os.unlink(target_path)
+        try:
+            os.link(source, target_path)
+            return "link"
+        except OSError:
+            log.debug("Can't hardlink %s to %s", source, target_path, exc_info=True)
+    with open(source, "rb") as fsrc, open(target_path, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return "reflink"
+        except OSError:
+            pass
+        try:
+            return _copy_file_data(fsrc.fileno(), fdst.fileno(), os.fstat(fsrc.fileno()).st_size)
+        except OSError:
+            log.debug("Can't copy %s to %s in the kernel", source, target_path, exc_info=True)
+            fdst.seek(0)
+            fdst.truncate()
+    copyfile(source, target_path)
+    return "copy"
+
+
+def copy_to_dir(source, parent_dir, target=None, link=False):
     """Copy `source` to `parent_dir`, optionally renaming.
 
+    The data is shared with `source` where the filesystem allows it; see
+    `stage_file`.
+
     Args:
         source (str): the source path
         parent_dir (str): the target parent dir. This doesn't have to exist
         target (str, optional): the basename of the target file.  If None,
             use the basename of `source`. Defaults to None.
+        link (bool, optional): whether the copy may be a hardlink to
+            `source`. Defaults to False.
 
     Raises:
         SigningServerError: on failure
@@ -128,8 +814,8 @@ def copy_to_dir(source, parent_dir, target=None):
         parent_dir = os.path.dirname(target_path)
         mkdir(parent_dir)
         if source != target_path:
-            log.info("Copying %s to %s" % (source, target_path))
-            copyfile(source, target_path)
+            method = stage_file(source, target_path, link=link)
+            log.info("Copied %s to %s (%s)", source, target_path, method)
             return target_path
         else:
             log.info("Not copying %s to itself" % (source))
@@ -200,3 +886,99 @@ def split_autograph_format(format_):
         return format_.split(":", 1)
     else:
         return format_, None
+
+
+def _gzip_member(data, compresslevel):
+    """Compress `data` into a complete, standalone gzip member."""
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # magic, deflate, no flags, no mtime, no extra flags, unknown OS
+    header = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+    trailer = struct.pack("<LL", zlib.crc32(data) & 0xFFFFFFFF, len(data) & 0xFFFFFFFF)
+    return header + compressor.compress(data) + compressor.flush() + trailer
+
+
+class ParallelCompressor:
+    """A writable file object that compresses blocks of its input in parallel.
+
+    Each block is compressed into a standalone gzip member or bzip2 stream.
+    Concatenated, these are a valid gzip or bzip2 file, which decompresses to
+    the original input with any standard tool (and with python's `gzip`,
+    `bz2` and `tarfile` modules).
+
+    zlib and bz2 release the GIL while compressing, so a thread pool is
+    enough to keep all the cores busy.
+
+    Attributes:
+        fileobj (file object): the file to write the compressed data to
+        compression (str): `gz` or `bz2`
+        threads (int): the number of compression threads
+        block_size (int): the amount of input to compress in each block
+
+    """
+
+    BLOCK_SIZES = {"gz": 1024 * 1024, "bz2": 900 * 1000}
+
+    def __init__(self, fileobj, compression, threads, block_size=None, compresslevel=9):
+        """Initialize ParallelCompressor."""
+        if compression == "gz":
+            self._compress = functools.partial(_gzip_member, compresslevel=compresslevel)
+        elif compression == "bz2":
+            self._compress = functools.partial(bz2.compress, compresslevel=compresslevel)
+        else:
+            raise SigningServerError("{} not a supported compression format!".format(compression))
+        self.fileobj = fileobj
+        self.compression = compression
+        self.threads = threads
+        self.block_size = block_size or self.BLOCK_SIZES[compression]
+        self._executor = ThreadPoolExecutor(threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._blocks = 0
+        self.closed = False
+
+    def __enter__(self):
+        """Enter the runtime context."""
+        return self
+
+    def __exit__(self, exc_type, *args):
+        """Flush and close, unless there was an exception."""
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(wait=False)
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(self._compress, block))
+        self._blocks += 1
+        # Bound the amount of data in flight
+        while len(self._pending) > self.threads * 2:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def write(self, data):
+        """Buffer `data`, compressing each full block in the background.
+
+        Args:
+            data (bytes): the data to write
+
+        Returns:
+            int: the number of bytes written
+
+        """
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[: self.block_size]))
+            del self._buffer[: self.block_size]
+        return len(data)
+
+    def close(self):
+        """Compress the last block, and wait for all the blocks to be written."""
+        if self.closed:
+            return
+        # An empty input still needs one (empty) member to be a valid file
+        if self._buffer or not self._blocks:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self.fileobj.write(self._pending.popleft().result())
+        self._executor.shutdown()
+        self.closed = True
@@ -0,0 +1,369 @@
+import io
+import os
+import stat
+import struct
+import tarfile
+
+import pytest
+
+import signingscript.hfsplus as hfsplus
+from signingscript.exceptions import SigningScriptError
+
+BLOCK_SIZE = 4096
+NODE_SIZE = 4096
+FIRST_CNID = 16
+MTIME = 1600000000
+
+
+# helpers {{{1
+def _key(parent_id, name):
+    name = name.encode("utf-16-be")
+    return struct.pack(">HIH", 6 + len(name), parent_id, len(name) // 2) + name
+
+
+def _fork_data(size, extents):
+    # Any extents after the first 8 go in the extents overflow file
+    total_blocks = sum(count for _, count in extents)
+    extents = list(extents)[:8]
+    values = [v for extent in extents + [(0, 0)] * (8 - len(extents)) for v in extent]
+    return struct.pack(">QII16I", size, 0, total_blocks, *values)
+
+
+def _folder_record(cnid, mode=0o755):
+    date = MTIME + hfsplus.HFS_EPOCH_OFFSET
+    return struct.pack(
+        ">hHIIIIIIIIIBBHI16s16sII", hfsplus.FOLDER_RECORD, 0, 0, cnid, date, date, date, date, 0, 0, 0, 0, 0, stat.S_IFDIR | mode, 0, b"", b"", 0, 0
+    )
+
+
+def _file_record(cnid, size, extents, mode=0o644, file_type=b"", creator=b"", special=0, owner_flags=0):
+    date = MTIME + hfsplus.HFS_EPOCH_OFFSET
+    return struct.pack(
+        ">hHIIIIIIIIIBBHI4s4sHhhh16sII80s80s",
+        hfsplus.FILE_RECORD,
+        0,
+        0,
+        cnid,
+        date,
+        date,
+        date,
+        date,
+        0,
+        0,
+        0,
+        0,
+        owner_flags,
+        mode,
+        special,
+        file_type,
+        creator,
+        0,
+        0,
+        0,
+        0,
+        b"",
+        0,
+        0,
+        _fork_data(size, extents),
+        _fork_data(0, []),
+    )
+
+
+def _thread_record(record_type, parent_id, name):
+    name = name.encode("utf-16-be")
+    return struct.pack(">hhIH", record_type, 0, parent_id, len(name) // 2) + name
+
+
+def _node(kind, height, records, forward_link=0):
+    offsets = []
+    body = struct.pack(">IIbBHH", forward_link, 0, kind, height, len(records), 0)
+    for record in records:
+        offsets.append(len(body))
+        body += record
+    offsets.append(len(body))
+    assert len(body) + 2 * len(offsets) <= NODE_SIZE
+    return body + b"\0" * (NODE_SIZE - len(body) - 2 * len(offsets)) + struct.pack(">{}H".format(len(offsets)), *offsets[::-1])
+
+
+def _btree(records, max_key_length, attributes, records_per_leaf):
+    """Return the bytes of a B-tree holding the sorted `(key, data)` records."""
+    leaves = [records[i : i + records_per_leaf] for i in range(0, len(records), records_per_leaf)]
+    nodes = [None]
+    for i, leaf in enumerate(leaves):
+        forward_link = len(nodes) + 1 if i < len(leaves) - 1 else 0
+        nodes.append(_node(hfsplus.LEAF_NODE, 1, [key + data for key, data in leaf], forward_link))
+    depth, root = (1, 1) if leaves else (0, 0)
+    if len(leaves) > 1:
+        # Index keys are padded to the max key length unless the tree uses
+        # variable length index keys, like the catalog does.
+        index = []
+        for i, leaf in enumerate(leaves):
+            key = leaf[0][0]
+            if not attributes & 4:
+                key = struct.pack(">H", max_key_length) + key[2:].ljust(max_key_length, b"\0")
+            index.append(key + struct.pack(">I", i + 1))
+        nodes.append(_node(0, 2, index))
+        depth, root = 2, len(nodes) - 1
+    total_nodes = len(nodes)
+    header = struct.pack(
+        ">HIIIIHHIIHIBBI64s",
+        depth,
+        root,
+        len(records),
+        1 if leaves else 0,
+        len(leaves),
+        NODE_SIZE,
+        max_key_length,
+        total_nodes,
+        0,
+        0,
+        NODE_SIZE,
+        0,
+        0,
+        attributes,
+        b"",
+    )
+    map_size = NODE_SIZE - 14 - len(header) - 128 - 8
+    node_map = (b"\xff" * (total_nodes // 8) + (bytes([(0xFF00 >> (total_nodes % 8)) & 0xFF]) if total_nodes % 8 else b"")).ljust(map_size, b"\0")
+    nodes[0] = _node(1, 0, [header, b"\0" * 128, node_map])
+    return b"".join(nodes)
+
+
+def _make_hfs_image(path, entries, fragment=(), records_per_leaf=1000):
+    """Write an HFS+ image with `entries`.
+
+    Each entry is `(path, kind, value)`, where `kind` is `dir`, `file`
+    (value: the contents), `symlink` (value: the target) or `hardlink` (value:
+    the contents, shared by every hardlink entry with the same contents).
+    Files in `fragment` get one extent per block, with gaps in between.
+
+    """
+    blocks = [b""]  # block 0 holds the volume header
+    overflow = []
+
+    def allocate(data, file_id, fragmented=False):
+        count = max(1, -(-len(data) // BLOCK_SIZE)) if data else 0
+        extents = []
+        for i in range(count):
+            chunk = data[i * BLOCK_SIZE : (i + 1) * BLOCK_SIZE]
+            if fragmented and extents:
+                blocks.append(b"")
+            if extents and extents[-1][0] + extents[-1][1] == len(blocks):
+                extents[-1] = (extents[-1][0], extents[-1][1] + 1)
+            else:
+                extents.append((len(blocks), 1))
+            blocks.append(chunk)
+        for i in range(8, len(extents), 8):
+            start_block = sum(count for _, count in extents[:i])
+            more = list(extents[i : i + 8])
+            values = [v for extent in more + [(0, 0)] * (8 - len(more)) for v in extent]
+            overflow.append((struct.pack(">HBxII", 10, 0, file_id, start_block), struct.pack(">16I", *values)))
+        return extents
+
+    ids = {"": hfsplus.ROOT_FOLDER_ID}
+    catalog = [(_key(1, "vol"), _folder_record(hfsplus.ROOT_FOLDER_ID)), (_key(hfsplus.ROOT_FOLDER_ID, ""), _thread_record(3, 1, "vol"))]
+    next_id = FIRST_CNID
+    inodes = {}
+    private_id = None
+    for entry_path, kind, value in entries:
+        parent, name = os.path.split(entry_path)
+        cnid = ids[entry_path] = next_id
+        next_id += 1
+        if kind == "dir":
+            record = _folder_record(cnid)
+        elif kind == "file":
+            data = value
+            record = _file_record(cnid, len(data), allocate(data, cnid, entry_path in fragment), mode=stat.S_IFREG | 0o644)
+        elif kind == "symlink":
+            data = value.encode("utf-8")
+            record = _file_record(cnid, len(data), allocate(data, cnid), mode=stat.S_IFLNK | 0o755, file_type=b"slnk", creator=b"rhap")
+        elif kind == "hardlink":
+            if private_id is None:
+                private_id = next_id
+                next_id += 1
+                catalog.append((_key(hfsplus.ROOT_FOLDER_ID, hfsplus.PRIVATE_DATA_FOLDER), _folder_record(private_id)))
+                catalog.append((_key(private_id, ""), _thread_record(3, hfsplus.ROOT_FOLDER_ID, hfsplus.PRIVATE_DATA_FOLDER)))
+            if value not in inodes:
+                inode_id = inodes[value] = next_id
+                next_id += 1
+                inode_name = "iNode{}".format(inode_id)
+                catalog.append(
+                    (_key(private_id, inode_name), _file_record(inode_id, len(value), allocate(value, inode_id), mode=stat.S_IFREG | 0o755, special=2))
+                )
+                catalog.append((_key(inode_id, ""), _thread_record(4, private_id, inode_name)))
+            record = _file_record(cnid, 0, [], mode=stat.S_IFREG | 0o644, file_type=b"hlnk", creator=b"hfs+", special=inodes[value])
+        else:
+            raise ValueError(kind)
+        catalog.append((_key(ids[parent], name), record))
+        catalog.append((_key(cnid, ""), _thread_record(3 if kind == "dir" else 4, ids[parent], name)))
+    catalog.sort(key=lambda record: (struct.unpack_from(">I", record[0], 2)[0], record[0][8:].decode("utf-16-be").lower()))
+
+    extents_tree = _btree(sorted(overflow, key=lambda record: record[0]), 10, 2, records_per_leaf)
+    catalog_tree = _btree(catalog, 516, 6, records_per_leaf)
+    forks = {}
+    for name, data in (("extents", extents_tree), ("catalog", catalog_tree)):
+        forks[name] = _fork_data(len(data), allocate(data, 0))
+    # The allocation file and the alternate volume header take two more blocks
+    total_blocks = len(blocks) + 2
+    bitmap = (b"\xff" * (total_blocks // 8) + (bytes([(0xFF00 >> (total_blocks % 8)) & 0xFF]) if total_blocks % 8 else b"")).ljust(BLOCK_SIZE, b"\0")
+    forks["allocation"] = _fork_data(BLOCK_SIZE, allocate(bitmap, 0))
+    date = MTIME + hfsplus.HFS_EPOCH_OFFSET
+    header = struct.pack(
+        ">2sHII15IQ32s",
+        b"H+",
+        4,
+        1 << 8,
+        0x31302E30,
+        0,
+        date,
+        date,
+        0,
+        date,
+        len([e for e in entries if e[1] != "dir"]),
+        len([e for e in entries if e[1] == "dir"]),
+        BLOCK_SIZE,
+        total_blocks,
+        0,
+        0,
+        BLOCK_SIZE,
+        BLOCK_SIZE,
+        next_id,
+        1,
+        1,
+        b"",
+    )
+    header += forks["allocation"] + forks["extents"] + forks["catalog"] + _fork_data(0, []) + _fork_data(0, [])
+    assert len(header) == 512
+    image = bytearray(b"".join(block.ljust(BLOCK_SIZE, b"\0") for block in blocks) + b"\0" * BLOCK_SIZE)
+    image[hfsplus.VOLUME_HEADER_OFFSET : hfsplus.VOLUME_HEADER_OFFSET + 512] = header
+    image[-1024:-512] = header
+    with open(path, "wb") as fh:
+        fh.write(image)
+
+
+def _hfs_to_tar_members(image_path):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w|") as t:
+        hfsplus.hfs_to_tarfile(image_path, t)
+    buf.seek(0)
+    members = {}
+    with tarfile.open(fileobj=buf, mode="r") as t:
+        for member in t.getmembers():
+            data = t.extractfile(member).read() if member.isfile() else None
+            members[member.name] = (member.type, member.mode, member.mtime, member.linkname, data)
+    return members
+
+
+ENTRIES = [
+    ("Firefox.app", "dir", None),
+    ("Firefox.app/Contents", "dir", None),
+    ("Firefox.app/Contents/MacOS", "dir", None),
+    ("Firefox.app/Contents/MacOS/firefox", "file", b"\xcf\xfa\xed\xfe" * 5000),
+    ("Firefox.app/Contents/MacOS/empty", "file", b""),
+    ("Firefox.app/Contents/Resources", "dir", None),
+    ("Firefox.app/Contents/Resources/omni.ja", "file", bytes(range(256)) * 200),
+    ("Firefox.app/Contents/Resources/a-link", "hardlink", b"linked"),
+    ("Firefox.app/Contents/Resources/b-link", "hardlink", b"linked"),
+    ("Applications", "symlink", "/Applications"),
+]
+
+
+# hfs_to_tarfile {{{1
+@pytest.mark.parametrize("records_per_leaf", (1000, 3))
+def test_hfs_to_tarfile(tmp_path, records_per_leaf):
+    image = str(tmp_path / "tmp.hfs")
+    _make_hfs_image(image, ENTRIES, fragment=("Firefox.app/Contents/Resources/omni.ja",), records_per_leaf=records_per_leaf)
+    members = _hfs_to_tar_members(image)
+    assert list(members) == [
+        ".",
+        "./Applications",
+        "./Firefox.app",
+        "./Firefox.app/Contents",
+        "./Firefox.app/Contents/MacOS",
+        "./Firefox.app/Contents/MacOS/empty",
+        "./Firefox.app/Contents/MacOS/firefox",
+        "./Firefox.app/Contents/Resources",
+        "./Firefox.app/Contents/Resources/a-link",
+        "./Firefox.app/Contents/Resources/b-link",
+        "./Firefox.app/Contents/Resources/omni.ja",
+    ]
+    assert members["./Applications"] == (tarfile.SYMTYPE, 0o755, MTIME, "/Applications", None)
+    assert members["./Firefox.app/Contents"] == (tarfile.DIRTYPE, 0o755, MTIME, "", None)
+    assert members["./Firefox.app/Contents/MacOS/firefox"] == (tarfile.REGTYPE, 0o644, MTIME, "", b"\xcf\xfa\xed\xfe" * 5000)
+    assert members["./Firefox.app/Contents/MacOS/empty"][-1] == b""
+    assert members["./Firefox.app/Contents/Resources/omni.ja"][-1] == bytes(range(256)) * 200
+    assert members["./Firefox.app/Contents/Resources/a-link"] == (tarfile.REGTYPE, 0o755, MTIME, "", b"linked")
+    assert members["./Firefox.app/Contents/Resources/b-link"] == (tarfile.REGTYPE, 0o755, MTIME, "", b"linked")
+
+
+def test_hfs_image_overflow_extents(tmp_path):
+    image = str(tmp_path / "tmp.hfs")
+    _make_hfs_image(image, [("big", "file", b"x" * BLOCK_SIZE * 20)], fragment=("big",))
+    with open(image, "rb") as fh:
+        hfs = hfsplus.HFSPlusImage(fh)
+        ((path, record_type, record),) = list(hfs.walk())
+        fork = hfs.open_data_fork(record)
+        assert len(fork.extents) == 20
+        assert fork.read(10) == b"x" * 10
+        assert fork.read() == b"x" * (BLOCK_SIZE * 20 - 10)
+        assert fork.read() == b""
+
+
+@pytest.mark.parametrize(
+    "contents",
+    (
+        b"",
+        b"\0" * 2048,
+        b"\0" * 1024 + b"XX" + b"\0" * 1022,
+    ),
+)
+def test_hfs_to_tarfile_not_hfs(tmp_path, contents):
+    image = tmp_path / "tmp.hfs"
+    image.write_bytes(contents)
+    with pytest.raises(SigningScriptError):
+        _hfs_to_tar_members(str(image))
+
+
+def test_hfs_to_tarfile_compressed(tmp_path, mocker):
+    image = str(tmp_path / "tmp.hfs")
+    _make_hfs_image(image, [("file", "file", b"data")])
+    record = _file_record(FIRST_CNID, 4, [(1, 1)], mode=stat.S_IFREG | 0o644, owner_flags=hfsplus.UF_COMPRESSED)
+    mocker.patch.object(hfsplus.HFSPlusImage, "walk", return_value=[("file", hfsplus.FILE_RECORD, record)])
+    with pytest.raises(SigningScriptError):
+        _hfs_to_tar_members(image)
+
+
+def _empty_record(image, name):
+    """Lengthen the catalog key for `name` in the root folder, so that its file record is empty."""
+    key = _key(hfsplus.ROOT_FOLDER_ID, name)
+    struct.pack_into(">H", image, image.index(key), len(key) - 2 + 248)
+    return image
+
+
+@pytest.mark.parametrize(
+    "corrupt",
+    (
+        # The image is cut off partway through the catalog
+        lambda image: image[: len(image) // 2],
+        # A record is too short to hold its record type
+        lambda image: _empty_record(image, "Applications"),
+        # A symlink target isn't utf-8
+        lambda image: image.replace(b"/Applications", b"\xffApplications"),
+    ),
+)
+def test_hfs_to_tarfile_malformed(tmp_path, corrupt):
+    image = tmp_path / "tmp.hfs"
+    _make_hfs_image(str(image), ENTRIES)
+    image.write_bytes(corrupt(bytearray(image.read_bytes())))
+    with pytest.raises(SigningScriptError):
+        _hfs_to_tar_members(str(image))
+
+
+def test_hfs_to_tarfile_truncated_record(tmp_path, mocker):
+    image = str(tmp_path / "tmp.hfs")
+    _make_hfs_image(image, [("file", "file", b"data")])
+    # The record is cut off before its data fork
+    record = _file_record(FIRST_CNID, 4, [(1, 1)], mode=stat.S_IFREG | 0o644)[:60]
+    mocker.patch.object(hfsplus.HFSPlusImage, "walk", return_value=[("file", hfsplus.FILE_RECORD, record)])
+    with pytest.raises(SigningScriptError):
+        _hfs_to_tar_members(image)
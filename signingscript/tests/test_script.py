@@ -1,3 +1,5 @@
+import asyncio
+import json
 import os
 from unittest.mock import MagicMock
 
@@ -7,20 +9,22 @@ import scriptworker.client
 
 import signingscript.script as script
 from conftest import BASE_DIR, noop_sync
+from signingscript.sign import time_function
+from signingscript.utils import run_in_executor
 
 # helper constants, fixtures, functions {{{1
 EXAMPLE_CONFIG = os.path.join(BASE_DIR, "config_example.json")
 
 
 # async_main {{{1
-async def async_main_helper(tmpdir, mocker, formats, extra_config={}, server_type="signing_server", use_comment=None):
+async def async_main_helper(tmpdir, mocker, formats, extra_config={}, server_type="signing_server", use_comment=None, fake_sign=None):
     def fake_filelist_dict(*args, **kwargs):
         ret = {"path1": {"full_path": "full_path1", "formats": formats}}
         if use_comment:
             ret = {"path1": {"full_path": "full_path1", "formats": formats, "comment": "Some authenticode comment"}}
         return ret
 
-    async def fake_sign(_, val, *args, authenticode_comment=None):
+    async def default_fake_sign(_, val, *args, authenticode_comment=None):
         if not use_comment:
             assert authenticode_comment is None
         else:
@@ -31,9 +35,10 @@ async def async_main_helper(tmpdir, mocker, formats, extra_config={}, server_typ
     # mocker.patch.object(script, "task_cert_type", new=noop_sync)
     mocker.patch.object(script, "task_signing_formats", return_value=formats)
     mocker.patch.object(script, "build_filelist_dict", new=fake_filelist_dict)
-    mocker.patch.object(script, "sign", new=fake_sign)
+    mocker.patch.object(script, "sign", new=fake_sign or default_fake_sign)
     context = mock.MagicMock()
-    context.config = {"work_dir": tmpdir, "artifact_dir": tmpdir, "autograph_configs": {}}
+    context.config = script.get_default_config()
+    context.config.update({"work_dir": tmpdir, "artifact_dir": tmpdir, "autograph_configs": {}})
     context.config.update(extra_config)
     await script.async_main(context)
 
@@ -95,6 +100,76 @@ async def test_async_main_autograph_authenticode(tmpdir, mocker, use_comment):
     await async_main_helper(tmpdir, mocker, formats, {}, "autograph", use_comment=use_comment)
 
 
+@pytest.mark.asyncio
+async def test_async_main_signs_files_concurrently(tmpdir, mocker):
+    paths = ["path1", "path2", "path3"]
+    all_started = asyncio.Event()
+    started = []
+
+    def fake_filelist_dict(*args, **kwargs):
+        return {path: {"full_path": f"full_{path}", "formats": ["autograph_mar"]} for path in paths}
+
+    async def fake_sign(context, val, *args, **kwargs):
+        started.append(val)
+        if len(started) == len(paths):
+            all_started.set()
+        # Every file must be in flight before any of them can finish
+        await asyncio.wait_for(all_started.wait(), timeout=5)
+        return [val]
+
+    mocker.patch.object(script, "load_autograph_configs", new=noop_sync)
+    mocker.patch.object(script, "task_signing_formats", return_value=["autograph_mar"])
+    mocker.patch.object(script, "build_filelist_dict", new=fake_filelist_dict)
+    mocker.patch.object(script, "sign", new=fake_sign)
+    mocked_copy_to_dir = mocker.patch.object(script, "copy_to_dir")
+    context = mock.MagicMock()
+    context.config = script.get_default_config()
+    context.config.update({"work_dir": tmpdir, "artifact_dir": tmpdir, "autograph_configs": {}, "max_concurrent_autograph_requests": 2})
+    await script.async_main(context)
+
+    assert sorted(started) == sorted(os.path.join(tmpdir, path) for path in paths)
+    assert mocked_copy_to_dir.call_count == 2 * len(paths)
+    # Only the signed copies in `work_dir` may be hardlinked into `artifact_dir`
+    for call in mocked_copy_to_dir.call_args_list:
+        assert call[1].get("link", False) == (call[0][1] == context.config["artifact_dir"] and call[0][0].startswith(str(tmpdir)))
+    assert context.autograph_semaphore._value == 2
+    assert context.archive_semaphore._value == context.config["max_concurrent_archive_jobs"]
+
+
+@pytest.mark.asyncio
+async def test_async_main_writes_trace(tmpdir, mocker):
+    @time_function
+    def fake_archive_job(path):
+        return path
+
+    async def fake_sign(context, val, *args, **kwargs):
+        with script.trace_span("fake_sign", path=val):
+            await run_in_executor(None, fake_archive_job, val)
+            return [val]
+
+    mocker.patch.object(script, "copy_to_dir")
+    await async_main_helper(tmpdir, mocker, ["autograph_mar"], fake_sign=fake_sign)
+    with open(os.path.join(tmpdir, "public/logs/signing_trace.json")) as fh:
+        trace = json.load(fh)
+    spans = {event["name"]: event for event in trace["traceEvents"]}
+    assert set(spans) == {"sign_path", "fake_sign", "fake_archive_job"}
+    # Spans in executor threads are recorded, on their own track
+    assert spans["fake_archive_job"]["args"]["path"] == spans["fake_sign"]["args"]["path"]
+    assert spans["fake_archive_job"]["tid"] != spans["fake_sign"]["tid"]
+    assert spans["sign_path"]["args"]["path"] == "path1"
+    assert spans["sign_path"]["args"]["format"] == "autograph_mar"
+    assert spans["fake_sign"]["tid"] == spans["sign_path"]["tid"]
+    assert spans["sign_path"]["ts"] <= spans["fake_sign"]["ts"]
+    assert spans["fake_sign"]["ts"] + spans["fake_sign"]["dur"] <= spans["sign_path"]["ts"] + spans["sign_path"]["dur"]
+
+
+@pytest.mark.asyncio
+async def test_async_main_no_trace(tmpdir, mocker):
+    mocker.patch.object(script, "copy_to_dir")
+    await async_main_helper(tmpdir, mocker, ["autograph_mar"], {"signing_trace_path": None})
+    assert not os.path.exists(os.path.join(tmpdir, "public/logs/signing_trace.json"))
+
+
 def test_get_default_config():
     parent_dir = os.path.dirname(os.getcwd())
     c = script.get_default_config()
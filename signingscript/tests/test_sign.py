@@ -1,21 +1,39 @@
 import asyncio
 import base64
+import glob
+import io
 import json
+import logging
 import os
 import os.path
 import re
 import shutil
+import stat
+import struct
 import subprocess
 import sys
 import tarfile
+import tempfile
+import threading
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from functools import partial
 from hashlib import sha256
+from io import BytesIO
 from unittest import mock
 
 import aiohttp
 import pytest
+import winsign.osslsigncode
 import winsign.sign
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from mardor.reader import MarReader
+from mardor.signing import sign_hash
+from mardor.writer import MarWriter, add_signature_block
 from scriptworker.utils import makedirs
 
 import signingscript.sign as sign
@@ -66,9 +84,12 @@ class MockedSession:
         self.signed_file = signed_file
         self.exception = exception
         self.signature = signature
+        self.body = None
         self.post = mock.MagicMock(wraps=self.post)
 
-    async def post(self, *args, **kwargs):
+    async def post(self, *args, data=None, **kwargs):
+        # Consume the streamed request body, like a real session would
+        self.body = b"".join([chunk async for chunk in data])
         resp = mock.MagicMock()
         resp.status = 200
         resp.json.return_value = asyncio.Future()
@@ -78,8 +99,16 @@ class MockedSession:
             resp.json.return_value.set_result([{"signature": self.signature}])
         if self.exception:
             resp.json.side_effect = self.exception
+        resp.content.iter_chunked = self.iter_chunked
         return resp
 
+    async def iter_chunked(self, n):
+        if self.exception:
+            raise self.exception
+        body = json.dumps([{"signed_file": self.signed_file}]).encode("utf8")
+        for i in range(0, len(body), n):
+            yield body[i : i + n]
+
 
 async def assert_file_permissions(archive):
     with tarfile.open(archive, mode="r") as t:
@@ -107,6 +136,31 @@ async def helper_archive(context, filename, create_fn, extract_fn, *args):
         assert hash1 == hash2
 
 
+# _limit_concurrency {{{1
+@pytest.mark.asyncio
+async def test_limit_concurrency(context):
+    running = []
+    max_running = 0
+
+    def job(i):
+        nonlocal max_running
+        running.append(i)
+        max_running = max(max_running, len(running))
+        # Give the other threads a chance to start
+        time.sleep(0.01)
+        running.remove(i)
+        return i
+
+    context.archive_semaphore = asyncio.Semaphore(2)
+    assert await asyncio.gather(*[sign._run_archive_job(context, job, i) for i in range(6)]) == list(range(6))
+    assert max_running == 2
+
+    # No semaphore means no limit
+    del context.archive_semaphore
+    async with sign._limit_concurrency(context, "archive_semaphore"):
+        pass
+
+
 # get_autograph_config {{{1
 @pytest.mark.parametrize(
     "formats,expected",
@@ -146,9 +200,9 @@ async def test_sign_file_autograph(context, mocker, to, expected):
         ("to", "to", "autograph_apk_sha1", {"pkcs7_digest": "SHA1", "zip": "passthrough"}),
     ),
 )
-async def test_sign_file_with_autograph(context, mocker, to, expected, format, options):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
+async def test_sign_file_with_autograph(context, mocker, tmp_path, monkeypatch, to, expected, format, options):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "from").write_bytes(b"0xdeadbeef")
 
     mocked_session = MockedSession(signed_file="bW96aWxsYQ==")
     mocker.patch.object(context, "session", new=mocked_session)
@@ -160,14 +214,13 @@ async def test_sign_file_with_autograph(context, mocker, to, expected, format, o
         ]
     }
     assert await sign.sign_file_with_autograph(context, "from", format, to=to) == expected
-    open_mock.assert_called()
+    assert (tmp_path / expected).read_bytes() == b"mozilla"
     kwargs = {"input": "MHhkZWFkYmVlZg=="}
     if options:
         kwargs["options"] = options
     mocked_session.post.assert_called_with("https://autograph-hsm.dev.mozaws.net/sign/file", headers=mocker.ANY, data=mocker.ANY)
-    data = mocked_session.post.call_args[1]["data"]
-    data.seek(0)
-    assert json.load(data) == [kwargs]
+    assert json.loads(mocked_session.body) == [kwargs]
+    assert mocked_session.post.call_args[1]["headers"]["Content-Length"] == str(len(mocked_session.body))
 
 
 @pytest.mark.asyncio
@@ -197,8 +250,8 @@ async def test_sign_file_with_autograph_raises_http_error(context, mocker, to, e
     mocked_session = MockedSession(signed_file="bW96aWxsYQ==", exception=aiohttp.ClientError)
     mocker.patch.object(context, "session", new=mocked_session)
 
-    async def fake_retry_async(func, args=(), attempts=5, sleeptime_kwargs=None):
-        await func(*args)
+    async def fake_retry_async(func, args=(), kwargs=None, attempts=5, sleeptime_kwargs=None):
+        await func(*args, **(kwargs or {}))
 
     mocker.patch.object(sign, "retry_async", new=fake_retry_async)
 
@@ -213,6 +266,288 @@ async def test_sign_file_with_autograph_raises_http_error(context, mocker, to, e
     open_mock.assert_called()
 
 
+# SignedFileResponseDecoder {{{1
+@pytest.mark.parametrize("chunk_size", (1, 2, 3, 5, 1024))
+@pytest.mark.parametrize(
+    "resp,expected",
+    (
+        ([{"signed_file": base64.b64encode(b"mozilla").decode("ascii")}], b"mozilla"),
+        ([{"ref": 'a\\"b', "signed_file": base64.b64encode(b"\xff\xfe" * 1000).decode("ascii"), "x5u": "https://x/y"}], b"\xff\xfe" * 1000),
+        ([{"signed_file": ""}], b""),
+    ),
+)
+def test_signed_file_response_decoder(chunk_size, resp, expected):
+    body = json.dumps(resp, indent=1).replace("/", "\\/").encode("utf8")
+    fp = BytesIO()
+    decoder = sign.SignedFileResponseDecoder(fp)
+    for i in range(0, len(body), chunk_size):
+        decoder.feed(body[i : i + chunk_size])
+    expected_resp = [dict(resp[0], signed_file="")]
+    assert decoder.close() == expected_resp
+    assert fp.getvalue() == expected
+    assert decoder.bytes_written == len(expected)
+
+
+@pytest.mark.parametrize(
+    "body",
+    (b'[{"signature": "abcd"}]', b'[{"signed_file": "abcd', b'[{"signed_file": "abc"}]', b'[{"signed_file": "ab\\ncd"}]', b'[{"signed_file": "abcd"}, "\\'),
+)
+def test_signed_file_response_decoder_raises(body):
+    decoder = sign.SignedFileResponseDecoder(BytesIO())
+    with pytest.raises(SigningScriptError):
+        decoder.feed(body)
+        decoder.close()
+
+
+@pytest.mark.asyncio
+async def test_write_signed_file_response(tmp_path):
+    to = tmp_path / "signed"
+    to.write_bytes(b"original")
+    to.chmod(0o755)
+    session = MockedSession(signed_file=base64.b64encode(b"signed").decode("ascii"))
+    resp = await session.post(data=sign.stream_signing_req({}))
+    assert await sign.write_signed_file_response(resp, str(to)) == [{"signed_file": ""}]
+    assert to.read_bytes() == b"signed"
+    # The signed file keeps the original's mode
+    assert stat.S_IMODE(os.stat(to).st_mode) == 0o755
+
+    # A new file gets the default mode
+    new = tmp_path / "new"
+    session = MockedSession(signed_file=base64.b64encode(b"signed").decode("ascii"))
+    resp = await session.post(data=sign.stream_signing_req({}))
+    umask = os.umask(0o027)
+    try:
+        await sign.write_signed_file_response(resp, str(new))
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(os.stat(new).st_mode) == 0o640
+    new.unlink()
+
+    # A failed response leaves the original file, and no temp files, behind
+    session = MockedSession(signed_file="abc")
+    resp = await session.post(data=sign.stream_signing_req({}))
+    with pytest.raises(SigningScriptError):
+        await sign.write_signed_file_response(resp, str(to))
+    assert to.read_bytes() == b"signed"
+    assert os.listdir(tmp_path) == ["signed"]
+
+
+# AutographHashBatcher {{{1
+class BatchingSession:
+    """Sign each input of a /sign/hash request, recording the batch sizes."""
+
+    def __init__(self, fail=False, gate=None):
+        self.batches = []
+        self.fail = fail
+        self.gate = gate
+
+    async def post(self, url, data=None, **kwargs):
+        body = json.loads(b"".join([chunk async for chunk in data]))
+        if self.gate is not None:
+            await self.gate.wait()
+        self.batches.append(len(body))
+        resp = mock.MagicMock()
+        resp.status = 200
+        if self.fail:
+            resp.raise_for_status.side_effect = aiohttp.ClientError
+        resp.json.return_value = asyncio.Future()
+        resp.json.return_value.set_result([{"signature": base64.b64encode(b"sig:" + base64.b64decode(r["input"])).decode("ascii")} for r in body])
+        return resp
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("max_batch_size,num_hashes,expected_batches", ((50, 10, [10]), (4, 10, [4, 4, 2]), (1, 3, [1, 1, 1])))
+async def test_autograph_hash_batcher(context, mocker, max_batch_size, num_hashes, expected_batches):
+    context.task = {"scopes": ["project:releng:signing:cert:dep-signing"]}
+    gate = asyncio.Event()
+    context.session = BatchingSession(gate=gate)
+    context.autograph_hash_batcher = sign.AutographHashBatcher(0.01, max_batch_size)
+    hashes = [f"hash{i}".encode("ascii") for i in range(num_hashes)]
+    futures = [asyncio.ensure_future(sign.sign_hash_with_autograph(context, h, "autograph_authenticode")) for h in hashes]
+    await asyncio.sleep(0.02)
+    # The batcher holds on to the batches in flight
+    assert len(context.autograph_hash_batcher._tasks) == len(expected_batches)
+    gate.set()
+    signatures = await asyncio.gather(*futures)
+    assert signatures == [b"sig:" + h for h in hashes]
+    assert context.session.batches == expected_batches
+    await asyncio.sleep(0)
+    assert not context.autograph_hash_batcher._tasks
+
+
+@pytest.mark.parametrize("batch_size,expected", ((1, None), (10, 10)))
+def test_get_autograph_hash_batcher(context, batch_size, expected):
+    context.config["autograph_hash_batch_size"] = batch_size
+    batcher = sign._get_autograph_hash_batcher(context)
+    assert getattr(batcher, "max_batch_size", None) == expected
+    assert sign._get_autograph_hash_batcher(context) is batcher
+
+
+@pytest.mark.asyncio
+async def test_autograph_hash_batcher_keys(context):
+    context.task = {"scopes": ["project:releng:signing:cert:dep-signing"]}
+    context.session = BatchingSession()
+    context.autograph_hash_batcher = sign.AutographHashBatcher(0.01, 50)
+    await asyncio.gather(
+        sign.sign_hash_with_autograph(context, b"1", "autograph_authenticode"),
+        sign.sign_hash_with_autograph(context, b"2", "autograph_authenticode", keyid="key1"),
+        sign.sign_hash_with_autograph(context, b"3", "autograph_authenticode", keyid="key1"),
+    )
+    # Different keyids can't share a request
+    assert sorted(context.session.batches) == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_autograph_hash_batcher_error(context, mocker):
+    context.task = {"scopes": ["project:releng:signing:cert:dep-signing"]}
+    context.session = BatchingSession(fail=True)
+    context.autograph_hash_batcher = sign.AutographHashBatcher(0.01, 50)
+
+    async def fake_retry_async(func, args=(), kwargs=None, attempts=5, sleeptime_kwargs=None):
+        return await func(*args, **(kwargs or {}))
+
+    mocker.patch.object(sign, "retry_async", new=fake_retry_async)
+    results = await asyncio.gather(*[sign.sign_hash_with_autograph(context, b"hash", "autograph_authenticode") for _ in range(3)], return_exceptions=True)
+    assert all(isinstance(r, aiohttp.ClientError) for r in results)
+
+
+# signature cache {{{1
+@pytest.mark.asyncio
+async def test_sign_hash_with_autograph_cache(context, tmp_path):
+    context.task = {"scopes": ["project:releng:signing:cert:dep-signing"]}
+    context.session = BatchingSession()
+    context.autograph_hash_batcher = None
+    context.signature_cache = utils.SignatureCache(str(tmp_path), ["autograph_authenticode"], 1024, 60)
+    for _ in range(2):
+        assert await sign.sign_hash_with_autograph(context, b"1", "autograph_authenticode") == b"sig:1"
+    assert context.session.batches == [1]
+    # A different key or input is a different signature
+    assert await sign.sign_hash_with_autograph(context, b"1", "autograph_authenticode", keyid="key1") == b"sig:1"
+    assert await sign.sign_hash_with_autograph(context, b"2", "autograph_authenticode") == b"sig:2"
+    assert context.session.batches == [1, 1, 1]
+    assert (context.signature_cache.hits, context.signature_cache.misses) == (1, 3)
+    # Formats that aren't opted in are never cached
+    for _ in range(2):
+        await sign.sign_hash_with_autograph(context, b"1", "autograph_marsha384")
+    assert context.session.batches == [1, 1, 1, 1, 1]
+
+
+@pytest.mark.asyncio
+async def test_sign_file_with_autograph_cache(context, mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "from").write_bytes(b"0xdeadbeef")
+    (tmp_path / "from2").write_bytes(b"0xdeadbeef")
+    mocked_session = MockedSession(signed_file="bW96aWxsYQ==")
+    context.session = mocked_session
+    context.signature_cache = utils.SignatureCache(str(tmp_path / "cache"), ["autograph_mar"], 1024, 60)
+    context.task = {"scopes": ["project:releng:signing:cert:dep-signing"]}
+    context.autograph_configs = {
+        "project:releng:signing:cert:dep-signing": [
+            utils.Autograph(*["https://autograph-hsm.dev.mozaws.net", "alice", "fs5wgcer9qj819kfptdlp8gm227ewxnzvsuj9ztycsx08hfhzu", ["autograph_mar"]])
+        ]
+    }
+    assert await sign.sign_file_with_autograph(context, "from", "autograph_mar", to="to") == "to"
+    assert await sign.sign_file_with_autograph(context, "from2", "autograph_mar") == "from2"
+    assert mocked_session.post.call_count == 1
+    assert (tmp_path / "to").read_bytes() == b"mozilla"
+    assert (tmp_path / "from2").read_bytes() == b"mozilla"
+    # A signature from a different set of servers or keys isn't reused
+    (tmp_path / "from3").write_bytes(b"0xdeadbeef")
+    (tmp_path / "from4").write_bytes(b"0xdeadbeef")
+    context.autograph_configs["project:releng:signing:cert:dep-signing"].append(
+        utils.Autograph("https://autograph-backup", "bob", "key", ["autograph_mar"], key_id="backup_key")
+    )
+    await sign.sign_file_with_autograph(context, "from3", "autograph_mar")
+    context.autograph_configs["project:releng:signing:cert:dep-signing"][1].key_id = "other_key"
+    await sign.sign_file_with_autograph(context, "from4", "autograph_mar")
+    assert mocked_session.post.call_count == 3
+
+
+def test_get_autograph_signers():
+    servers = [
+        utils.Autograph("https://b", "bob", "key", ["autograph_mar"], key_id="b_key"),
+        utils.Autograph("https://a", "alice", "key", ["autograph_mar"]),
+    ]
+    assert sign.get_autograph_signers(servers) == [["https://a", "alice", ""], ["https://b", "bob", "b_key"]]
+    assert sign.get_autograph_signers(servers, "task_key") == [["https://a", "alice", "task_key"], ["https://b", "bob", "task_key"]]
+    assert sign.get_autograph_signers(servers) == sign.get_autograph_signers(servers[::-1])
+
+
+@pytest.mark.asyncio
+async def test_sign_with_autograph_batch_errors(context):
+    server = utils.Autograph("https://autograph", "user", "key", ["autograph_authenticode"])
+    with pytest.raises(SigningScriptError):
+        await sign.sign_with_autograph(None, server, [BytesIO(b"1")], "autograph_apk", "file", to="to")
+    session = BatchingSession()
+    mocked_post = session.post
+
+    async def short_post(*args, **kwargs):
+        resp = await mocked_post(*args, **kwargs)
+        resp.json.return_value = asyncio.Future()
+        resp.json.return_value.set_result([])
+        return resp
+
+    session.post = short_post
+    with pytest.raises(SigningScriptError):
+        await sign.sign_with_autograph(session, server, [BytesIO(b"1")], "autograph_authenticode", "hash")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("use_selector", (True, False))
+async def test_sign_with_autograph_failover(mocker, use_selector):
+    async def fake_retry_async(func, args=(), kwargs=None, attempts=5, sleeptime_kwargs=None):
+        for attempt in range(attempts):
+            try:
+                return await func(*args, **(kwargs or {}))
+            except Exception:
+                if attempt == attempts - 1:
+                    raise
+
+    mocker.patch.object(sign, "retry_async", new=fake_retry_async)
+    servers = [utils.Autograph(f"https://autograph{i}", "user", "key", ["autograph_authenticode"]) for i in range(2)]
+    sessions = {servers[0].url: BatchingSession(), servers[1].url: BatchingSession()}
+
+    async def refuse(*args, **kwargs):
+        raise aiohttp.ClientConnectionError()
+
+    sessions[servers[0].url].post = refuse
+    selector = utils.AutographServerSelector(1, 30) if use_selector else None
+    signatures = await sign.sign_with_autograph(
+        lambda server: sessions[server.url], servers, [BytesIO(b"1")], "autograph_authenticode", "hash", selector=selector
+    )
+    assert signatures == [base64.b64encode(b"sig:1").decode("ascii")]
+    assert sessions[servers[1].url].batches == [1]
+    if use_selector:
+        # The failed server is skipped until its cooldown is over
+        assert selector.order(servers) == [servers[1], servers[0]]
+        assert selector.health[servers[1].url].latency is not None
+
+    # Client errors aren't failed over
+    async def reject(*args, **kwargs):
+        raise aiohttp.ClientResponseError(None, (), status=401)
+
+    sessions[servers[0].url].post = sessions[servers[1].url].post = reject
+    with pytest.raises(aiohttp.ClientResponseError):
+        await sign.sign_with_autograph(lambda server: sessions[server.url], servers, [BytesIO(b"1")], "autograph_authenticode", "hash")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "task_keyid,server_keyid,expected",
+    ((None, None, None), (None, "server_key", "server_key"), ("task_key", None, "task_key"), ("task_key", "server_key", "task_key")),
+)
+async def test_sign_with_autograph_keyid(task_keyid, server_keyid, expected):
+    server = utils.Autograph("https://autograph", "user", "key", ["autograph_mar"], key_id=server_keyid)
+    session = MockedSession(signature=base64.b64encode(b"sig").decode("ascii"))
+    await sign.sign_with_autograph(session, [server], BytesIO(b"1"), "autograph_mar", "hash", keyid=task_keyid)
+    sign_req = json.loads(session.body)[0]
+    if expected is None:
+        # A task with no keyid doesn't pick one for autograph
+        assert "keyid" not in sign_req
+    else:
+        assert sign_req["keyid"] == expected
+
+
 # get_mar_verification_key {{{1
 @pytest.mark.parametrize(
     "format,cert_type,keyid,raises,expected",
@@ -243,31 +578,92 @@ def test_verify_mar_signature(mocker, raises):
     mocker.patch.object(subprocess, "check_call", new=fake_check_call)
     if raises:
         with pytest.raises(SigningScriptError):
-            sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", "foo")
+            sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", "foo", mode="binary")
     else:
-        sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", "foo")
+        sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", "foo", mode="binary")
+
+
+@pytest.fixture(scope="module")
+def mar_signing_keys(tmp_path_factory):
+    keys = []
+    for _ in range(2):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+        keys.append(
+            (
+                private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()),
+                private_key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo),
+            )
+        )
+    return keys
+
+
+@pytest.mark.parametrize("signed_with,expected", ((0, True), (1, False), (None, False)))
+def test_verify_mar_signature_native(mocker, tmp_path, mar_signing_keys, signed_with, expected):
+    key_path = tmp_path / "key.pem"
+    key_path.write_bytes(mar_signing_keys[0][1])
+    mocker.patch.object(sign, "get_mar_verification_key", return_value=str(key_path))
+    mar_path = str(tmp_path / "test.mar")
+    _make_mar(mar_path)
+    if signed_with is not None:
+        layout = sign._get_signed_mar_layout(mar_path, "sha384", 256)
+        signature = sign_hash(mar_signing_keys[signed_with][0], layout["hash"], "sha384")
+        sign._write_signed_mar(mar_path, mar_path, layout, signature)
+    if expected:
+        sign.verify_mar_signature("dep-signing", "autograph_hash_only_mar384", mar_path)
+    else:
+        with pytest.raises(SigningScriptError):
+            sign.verify_mar_signature("dep-signing", "autograph_hash_only_mar384", mar_path)
+
+
+def test_verify_mar_signature_native_bad_mar(mocker, tmp_path):
+    mar_path = tmp_path / "test.mar"
+    mar_path.write_bytes(b"not a mar")
+    with pytest.raises(SigningScriptError):
+        sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", str(mar_path))
+
+
+def test_verify_mar_signature_unknown_mode():
+    with pytest.raises(SigningScriptError):
+        sign.verify_mar_signature("dep-signing", "autograph_stage_mar384", "foo", mode="unknown")
 
 
 # sign_mar384_with_autograph_hash {{{1
-@pytest.mark.asyncio
-@pytest.mark.parametrize("to,expected", ((None, "from"), ("to", "to")))
-async def test_sign_mar384_with_autograph_hash(context, mocker, to, expected):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
+def _make_mar(path, signed=False):
+    unsigned = BytesIO()
+    with MarWriter(unsigned, productversion="99.0", channel="test") as m:
+        m.add_fileobj(BytesIO(b"foo" * 1000), "foo", None, flags=0o644)
+        m.add_fileobj(BytesIO(os.urandom(100000)), "bar", None, flags=0o755)
+    with open(path, "w+b") as fh:
+        if signed:
+            add_signature_block(unsigned, fh, "sha384", b"\1" * 512)
+        else:
+            fh.write(unsigned.getvalue())
 
-    mocked_session = MockedSession(signature=base64.b64encode(b"0" * 512))
-    mocker.patch.object(context, "session", new=mocked_session)
 
-    add_signature_mock = mocker.Mock()
-    mocker.patch("signingscript.sign.add_signature_block", add_signature_mock, create=True)
+def _get_mar_hash(path):
+    """Get the signing hash of a mar via mardor, with a dummy-signed copy."""
+    with tempfile.TemporaryFile() as tmp:
+        with open(path, "rb") as fh:
+            add_signature_block(fh, tmp, "sha384")
+        tmp.seek(0)
+        with MarReader(tmp) as m:
+            return m.calculate_hashes()[0][1]
 
-    m_mock = mocker.MagicMock()
-    m_mock.calculate_hashes.return_value = [[None, b"b64marhash"]]
-    MarReader_mock = mocker.Mock()
-    MarReader_mock.return_value.__enter__ = mocker.Mock(return_value=m_mock)
-    MarReader_mock.return_value.__exit__ = mocker.Mock()
-    mocker.patch("signingscript.sign.MarReader", MarReader_mock, create=True)
-    mocker.patch("signingscript.sign.verify_mar_signature")
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("to", (None, "to.mar"))
+@pytest.mark.parametrize("signed", (False, True))
+async def test_sign_mar384_with_autograph_hash(context, mocker, tmp_path, to, signed):
+    from_ = str(tmp_path / "from.mar")
+    _make_mar(from_, signed=signed)
+    expected_hash = _get_mar_hash(from_)
+    with open(from_, "rb") as src, open(tmp_path / "expected.mar", "w+b") as dst:
+        add_signature_block(src, dst, "sha384", b"#" * 512)
+    to = to and str(tmp_path / to)
+
+    mocked_session = MockedSession(signature=base64.b64encode(b"#" * 512))
+    mocker.patch.object(context, "session", new=mocked_session)
+    verify = mocker.patch("signingscript.sign.verify_mar_signature")
 
     context.task = {"scopes": ["project:releng:signing:cert:dep-signing"]}
     context.autograph_configs = {
@@ -277,17 +673,25 @@ async def test_sign_mar384_with_autograph_hash(context, mocker, to, expected):
             )
         ]
     }
-    assert await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384", to=to) == expected
-    open_mock.assert_called()
-    add_signature_mock.assert_called()
-    MarReader_mock.assert_called()
-    m_mock.calculate_hashes.assert_called()
+    inode = os.stat(from_).st_ino
+    with open(from_, "rb") as fh:
+        contents = fh.read()
+    assert await sign.sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384", to=to) == (to or from_)
     mocked_session.post.assert_called_with("https://autograph-hsm.dev.mozaws.net/sign/hash", headers=mocker.ANY, data=mocker.ANY)
-    assert json.load(mocked_session.post.call_args[1]["data"]) == [{"input": "YjY0bWFyaGFzaA=="}]
+    assert json.loads(mocked_session.body) == [{"input": base64.b64encode(expected_hash).decode("ascii")}]
+    verify.assert_called_with("project:releng:signing:cert:dep-signing", "autograph_hash_only_mar384", to or from_, None, mode="native")
+    assert (tmp_path / (to or from_)).read_bytes() == (tmp_path / "expected.mar").read_bytes()
+    if to:
+        with open(from_, "rb") as fh:
+            assert fh.read() == contents
+    else:
+        # Signed mars are re-signed in place
+        assert (os.stat(from_).st_ino == inode) == signed
+    assert not glob.glob(str(tmp_path / ".signedmar*"))
 
 
 @pytest.mark.asyncio
-async def test_sign_mar384_with_autograph_hash_keyid(context, mocker):
+async def test_sign_mar384_with_autograph_hash_keyid(context, mocker, tmp_path):
     context.task = {"scopes": ["project:releng:signing:cert:dep-signing"]}
     context.autograph_configs = {
         "project:releng:signing:cert:dep-signing": [
@@ -300,12 +704,8 @@ async def test_sign_mar384_with_autograph_hash_keyid(context, mocker):
             )
         ]
     }
-
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
-    mocker.patch("signingscript.sign.add_signature_block")
-    mar_reader = mocker.patch("signingscript.sign.MarReader")
-    mar_reader.calculate_hashes.return_value = [[None, b"b64marhash"]]
+    from_ = str(tmp_path / "from.mar")
+    _make_mar(from_)
     mocker.patch("signingscript.sign.verify_mar_signature")
 
     async def fake_sign_hash(context, h, fmt, keyid):
@@ -314,7 +714,7 @@ async def test_sign_mar384_with_autograph_hash_keyid(context, mocker):
     fake_sign_hash = mock.MagicMock(wraps=fake_sign_hash)
     mocker.patch("signingscript.sign.sign_hash_with_autograph", fake_sign_hash)
 
-    assert await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384:keyid1") == "from"
+    assert await sign.sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384:keyid1") == from_
     fake_sign_hash.assert_called_with(mocker.ANY, mocker.ANY, "autograph_hash_only_mar384", "keyid1")
 
 
@@ -337,24 +737,17 @@ async def test_sign_mar384_with_autograph_hash_no_suitable_servers_errors(contex
 
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize("to,expected", ((None, "from"), ("to", "to")))
-async def test_sign_mar384_with_autograph_hash_returns_invalid_signature_length(context, mocker, to, expected):
-    open_mock = mocker.mock_open(read_data=b"0xdeadbeef")
-    mocker.patch("builtins.open", open_mock, create=True)
+@pytest.mark.parametrize("to", (None, "to.mar"))
+async def test_sign_mar384_with_autograph_hash_returns_invalid_signature_length(context, mocker, tmp_path, to):
+    from_ = str(tmp_path / "from.mar")
+    _make_mar(from_)
+    with open(from_, "rb") as fh:
+        contents = fh.read()
+    to = to and str(tmp_path / to)
 
     mocked_session = MockedSession(signature=base64.b64encode(b"0"))
     mocker.patch.object(context, "session", new=mocked_session)
 
-    add_signature_mock = mocker.Mock()
-    mocker.patch("signingscript.sign.add_signature_block", add_signature_mock, create=True)
-
-    m_mock = mocker.MagicMock()
-    m_mock.calculate_hashes.return_value = [[None, b"b64marhash"]]
-    MarReader_mock = mocker.Mock()
-    MarReader_mock.return_value.__enter__ = mocker.Mock(return_value=m_mock)
-    MarReader_mock.return_value.__exit__ = mocker.Mock()
-    mocker.patch("signingscript.sign.MarReader", MarReader_mock, create=True)
-
     context.task = {"scopes": ["project:releng:signing:cert:dep-signing"]}
     context.autograph_configs = {
         "project:releng:signing:cert:dep-signing": [
@@ -364,14 +757,41 @@ async def test_sign_mar384_with_autograph_hash_returns_invalid_signature_length(
         ]
     }
     with pytest.raises(SigningScriptError):
-        assert await sign.sign_mar384_with_autograph_hash(context, "from", "autograph_hash_only_mar384", to=to) == expected
+        await sign.sign_mar384_with_autograph_hash(context, from_, "autograph_hash_only_mar384", to=to)
 
-    open_mock.assert_called()
-    add_signature_mock.assert_called()
-    MarReader_mock.assert_called()
-    m_mock.calculate_hashes.assert_called()
     mocked_session.post.assert_called_with("https://autograph-hsm.dev.mozaws.net/sign/hash", headers=mocker.ANY, data=mocker.ANY)
-    assert json.load(mocked_session.post.call_args[1]["data"]) == [{"input": "YjY0bWFyaGFzaA=="}]
+    assert json.loads(mocked_session.body) == [{"input": base64.b64encode(_get_mar_hash(from_)).decode("ascii")}]
+    with open(from_, "rb") as fh:
+        assert fh.read() == contents
+    assert not to or not os.path.exists(to)
+    assert not glob.glob(str(tmp_path / ".signedmar*"))
+
+
+# time_async_function {{{1
+@pytest.mark.asyncio
+async def test_time_async_function_trace(tmp_path):
+    from_ = tmp_path / "from"
+    from_.write_bytes(b"x" * 10)
+    to = str(tmp_path / "to")
+
+    @sign.time_async_function
+    async def fake_sign(context, from_, fmt, to=None):
+        with open(to, "wb") as fh:
+            fh.write(b"y" * 20)
+        return to
+
+    recorder = utils.TraceRecorder()
+    utils.set_trace_recorder(recorder)
+    assert await fake_sign(None, str(from_), "autograph_foo", to=to) == to
+    with pytest.raises(SigningScriptError):
+        await sign.sign_archive_members(None, "foo.zip", ["gpg"])
+    spans = {event["name"]: event["args"] for event in recorder.events}
+    assert spans["fake_sign"]["path"] == str(from_)
+    assert spans["fake_sign"]["format"] == "autograph_foo"
+    assert spans["fake_sign"]["bytes_in"] == 10
+    assert spans["fake_sign"]["bytes_out"] == 20
+    assert spans["sign_archive_members"]["format"] == "gpg"
+    assert spans["sign_archive_members"]["error"] == "SigningScriptError"
 
 
 # sign_gpg {{{1
@@ -469,7 +889,7 @@ async def test_sign_widevine(context, mocker, filename, fmt, raises, should_sign
         assert f.endswith(".zip")
         return files
 
-    async def fake_untar(_, f, comp, **kwargs):
+    async def fake_scan(_, f, comp, basenames, **kwargs):
         assert f.endswith(".tar.{}".format(comp.lstrip(".")))
         return files
 
@@ -489,8 +909,7 @@ async def test_sign_widevine(context, mocker, filename, fmt, raises, should_sign
     def fake_isfile(path):
         return "isdir" not in path
 
-    mocker.patch.object(sign, "_get_tarfile_files", new=fake_filelist)
-    mocker.patch.object(sign, "_extract_tarfile", new=fake_untar)
+    mocker.patch.object(sign, "_scan_tarfile", new=fake_scan)
     mocker.patch.object(sign, "_get_zipfile_files", new=fake_filelist)
     mocker.patch.object(sign, "_extract_zipfile", new=fake_unzip)
     mocker.patch.object(sign, "_convert_dmg_to_tar_gz", new=fake_undmg)
@@ -498,8 +917,9 @@ async def test_sign_widevine(context, mocker, filename, fmt, raises, should_sign
     mocker.patch.object(sign, "sign_widevine_with_autograph", new=noop_async)
     mocker.patch.object(sign, "makedirs", new=noop_sync)
     mocker.patch.object(sign, "generate_precomplete", new=noop_sync)
-    mocker.patch.object(sign, "_create_tarfile", new=noop_async)
+    mocker.patch.object(sign, "_rewrite_tarfile", new=noop_async)
     mocker.patch.object(sign, "_create_zipfile", new=noop_async)
+    mocker.patch.object(sign, "_rewrite_zipfile", new=noop_async)
     mocker.patch.object(sign, "_run_generate_precomplete", new=noop_sync)
     mocker.patch.object(os.path, "isfile", new=fake_isfile)
 
@@ -563,6 +983,60 @@ def test_run_generate_precomplete(context, num_precomplete, raises, mocker):
             sign._run_generate_precomplete(context, work_dir)
     else:
         sign._run_generate_precomplete(context, work_dir)
+        # The diff is renamed into place, leaving no temporary files behind
+        assert os.listdir(os.path.join(context.config["artifact_dir"], "public/logs")) == ["precomplete.diff"]
+
+
+def test_run_generate_precomplete_concurrently(context, mocker):
+    mocker.patch.object(sign, "generate_precomplete", new=noop_sync)
+    tmp_dirs = []
+    for i in range(8):
+        tmp_dir = os.path.join(context.config["work_dir"], str(i))
+        makedirs(tmp_dir)
+        with open(os.path.join(tmp_dir, "precomplete"), "w") as fh:
+            fh.write("".join("remove \"{}/{}\"\n".format(i, j) for j in range(1000)))
+        tmp_dirs.append(tmp_dir)
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(partial(sign._run_generate_precomplete, context), tmp_dirs))
+    # The diff is one file's whole diff, not a mix of them
+    with open(os.path.join(context.config["artifact_dir"], "public/logs/precomplete.diff")) as fh:
+        lines = fh.readlines()
+    assert len(lines) == 1000
+    assert len({line.split("/")[0] for line in lines}) == 1
+
+
+# _generate_precomplete_from_file_list {{{1
+@pytest.mark.parametrize(
+    "files",
+    (
+        ["firefox/precomplete", "firefox/firefox", "firefox/a/b/c.so", "firefox/defaults/pref/channel-prefs.js", "firefox/distribution/x", "firefox/empty/"],
+        [
+            "Firefox.app/Contents/Resources/precomplete",
+            "Firefox.app/Contents/MacOS/XUL",
+            "Firefox.app/Contents/Resources/XUL.sig",
+            "Firefox.app/update-settings.ini",
+        ],
+        ["precomplete", "a", "b/c"],
+        ["./firefox/precomplete", "./firefox/firefox", "./firefox/a/", "./firefox/a/b.so"],
+    ),
+)
+def test_generate_precomplete_from_file_list(tmp_path, files):
+    extracted = tmp_path / "extracted"
+    for f in files:
+        path = extracted / f
+        if f.endswith("/"):
+            path.mkdir(parents=True, exist_ok=True)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text("x")
+    precomplete = [f for f in files if f.endswith("precomplete")][0]
+    sign.generate_precomplete(os.path.dirname(str(extracted / precomplete)))
+    expected = (extracted / precomplete).read_text()
+
+    partial = tmp_path / "partial"
+    (partial / precomplete).parent.mkdir(parents=True)
+    sign._generate_precomplete_from_file_list(str(partial / precomplete), str(partial), files)
+    assert (partial / precomplete).read_text() == expected
 
 
 # remove_extra_files {{{1
@@ -590,44 +1064,142 @@ def test_remove_extra_files(context):
 
 
 # zip_align_apk {{{1
+def _stored_data_offsets(path):
+    offsets = {}
+    with open(path, "rb") as fh, zipfile.ZipFile(fh) as z:
+        for info in z.infolist():
+            fh.seek(info.header_offset)
+            header = struct.unpack(zipfile.structFileHeader, fh.read(zipfile.sizeFileHeader))
+            if info.compress_type == zipfile.ZIP_STORED:
+                name_and_extra_length = header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH]
+                offsets[info.filename] = info.header_offset + zipfile.sizeFileHeader + name_and_extra_length
+    return offsets
+
+
 @pytest.mark.asyncio
-@pytest.mark.parametrize("is_verbose", (True, False))
-async def test_zip_align_apk(context, monkeypatch, is_verbose):
-    context.config["zipalign"] = "/path/to/android/sdk/zipalign"
-    context.config["verbose"] = is_verbose
-    abs_to = "/absolute/path/to/apk.apk"
+async def test_zip_align_apk(context, tmp_path, mocker):
+    mocker.patch.object(sign, "_ZIP_COPY_CHUNK_SIZE", new=100)
+    abs_to = str(tmp_path / "apk.apk")
+    with zipfile.ZipFile(abs_to, mode="w") as z:
+        for i, size in enumerate((0, 1, 2, 3, 1000, 4097)):
+            compress_type = zipfile.ZIP_STORED if i % 2 else zipfile.ZIP_DEFLATED
+            z.writestr("f{}{}".format(i, "x" * i), bytes(range(256)) * (size // 256) + b"a" * (size % 256), compress_type=compress_type)
+            z.writestr("stored{}".format(i), b"b" * size, compress_type=zipfile.ZIP_STORED)
+        # Written with a data descriptor after the data
+        with z.open("streamed", mode="w") as fh:
+            fh.write(b"c" * 1234)
+        z.comment = b"comment"
+    with zipfile.ZipFile(abs_to) as z:
+        expected = {name: z.read(name) for name in z.namelist()}
+    assert any(offset % 4 for offset in _stored_data_offsets(abs_to).values())
 
-    async def execute_subprocess_mock(command):
-        if is_verbose:
-            assert command[0:4] == ["/path/to/android/sdk/zipalign", "-v", "4", abs_to]
-            assert len(command) == 5
-        else:
-            assert command[0:3] == ["/path/to/android/sdk/zipalign", "4", abs_to]
-            assert len(command) == 4
+    await sign.zip_align_apk(context, abs_to)
+    assert all(offset % 4 == 0 for offset in _stored_data_offsets(abs_to).values())
+    with zipfile.ZipFile(abs_to) as z:
+        assert z.testzip() is None
+        assert z.comment == b"comment"
+        assert {name: z.read(name) for name in z.namelist()} == expected
+
+    # Aligning an aligned apk doesn't change it
+    with open(abs_to, "rb") as fh:
+        contents = fh.read()
+    await sign.zip_align_apk(context, abs_to)
+    with open(abs_to, "rb") as fh:
+        assert fh.read() == contents
 
-    def shutil_mock(_, destination):
-        assert destination == abs_to
 
-    monkeypatch.setattr("signingscript.utils.execute_subprocess", execute_subprocess_mock)
-    monkeypatch.setattr("shutil.move", shutil_mock)
+@pytest.mark.asyncio
+async def test_bad_zip_align_apk(context, tmp_path):
+    abs_to = tmp_path / "apk.apk"
+    abs_to.write_bytes(b"not a zip")
+    with pytest.raises(SigningScriptError):
+        await sign.zip_align_apk(context, str(abs_to))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("zip64_limit", ("ZIP_FILECOUNT_LIMIT", "ZIP64_LIMIT"))
+async def test_zip_align_apk_zip64(context, tmp_path, mocker, zip64_limit):
+    abs_to = str(tmp_path / "apk.apk")
+    # Write a zip64 end of central directory record, or zip64 header offsets
+    with mock.patch.object(zipfile, zip64_limit, new=1):
+        with zipfile.ZipFile(abs_to, mode="w") as z:
+            for i in range(3):
+                z.writestr("stored{}".format(i), b"b" * (i + 1), compress_type=zipfile.ZIP_STORED)
+    with open(abs_to, "rb") as fh:
+        contents = fh.read()
+    commands = []
+
+    async def execute_subprocess_mock(command, **kwargs):
+        commands.append(command)
+        shutil.copyfile(command[-2], command[-1])
 
+    mocker.patch.object(utils, "execute_subprocess", new=execute_subprocess_mock)
     await sign.zip_align_apk(context, abs_to)
+    assert len(commands) == 1
+    assert commands[0][0] == context.config["zipalign"]
+    assert commands[0][-3:-1] == ["4", abs_to]
+    with open(abs_to, "rb") as fh:
+        assert fh.read() == contents
+
+
+def test_verify_zip_alignment(tmp_path):
+    abs_to = str(tmp_path / "apk.apk")
+    with zipfile.ZipFile(abs_to, mode="w") as z:
+        z.writestr("a", b"a", compress_type=zipfile.ZIP_STORED)
+    with pytest.raises(SigningScriptError):
+        sign._verify_zip_alignment(abs_to, 4)
+    sign._zip_align_sync(abs_to, 4)
+    sign._verify_zip_alignment(abs_to, 4)
 
 
 # _convert_dmg_to_tar_gz {{{1
 @pytest.mark.asyncio
-async def test_convert_dmg_to_tar_gz(context, monkeypatch, tmpdir):
+@pytest.mark.parametrize("threads", (1, 4))
+async def test_convert_dmg_to_tar_gz(context, monkeypatch, tmpdir, threads):
     dmg_path = "path/to/foo.dmg"
     abs_dmg_path = os.path.join(context.config["work_dir"], dmg_path)
     tarball_path = "path/to/foo.tar.gz"
     abs_tarball_path = os.path.join(context.config["work_dir"], tarball_path)
+    os.makedirs(os.path.dirname(abs_tarball_path))
+    context.config["tar_compression_threads"] = threads
+    commands = []
 
     async def execute_subprocess_mock(command, **kwargs):
-        assert command in (
-            ["dmg", "extract", abs_dmg_path, "tmp.hfs"],
-            ["hfsplus", "tmp.hfs", "extractall", "/", "{}/app".format(tmpdir)],
-            ["tar", "czf", abs_tarball_path, "."],
-        )
+        commands.append(command)
+
+    def fake_hfs_to_tarfile(image_path, tar):
+        assert image_path == os.path.join(tmpdir, "tmp.hfs")
+        info = tarfile.TarInfo("./foo.app")
+        info.type = tarfile.DIRTYPE
+        tar.addfile(info)
+
+    @contextmanager
+    def fake_tmpdir():
+        yield tmpdir
+
+    monkeypatch.setattr("signingscript.utils.execute_subprocess", execute_subprocess_mock)
+    monkeypatch.setattr("tempfile.TemporaryDirectory", fake_tmpdir)
+    monkeypatch.setattr(sign.hfsplus, "hfs_to_tarfile", fake_hfs_to_tarfile)
+
+    assert await sign._convert_dmg_to_tar_gz(context, dmg_path) == tarball_path
+    assert commands == [["dmg", "extract", abs_dmg_path, "tmp.hfs"]]
+    assert list(_tar_members(abs_tarball_path)) == ["./foo.app"]
+
+
+@pytest.mark.asyncio
+async def test_convert_dmg_to_tar_gz_fallback(context, monkeypatch, tmpdir):
+    dmg_path = "path/to/foo.dmg"
+    abs_dmg_path = os.path.join(context.config["work_dir"], dmg_path)
+    tarball_path = "path/to/foo.tar.gz"
+    abs_tarball_path = os.path.join(context.config["work_dir"], tarball_path)
+    os.makedirs(os.path.dirname(abs_tarball_path))
+    commands = []
+
+    async def execute_subprocess_mock(command, **kwargs):
+        commands.append(command)
+
+    def fake_hfs_to_tarfile(image_path, tar):
+        raise SigningScriptError("Compressed files aren't supported")
 
     @contextmanager
     def fake_tmpdir():
@@ -635,8 +1207,14 @@ async def test_convert_dmg_to_tar_gz(context, monkeypatch, tmpdir):
 
     monkeypatch.setattr("signingscript.utils.execute_subprocess", execute_subprocess_mock)
     monkeypatch.setattr("tempfile.TemporaryDirectory", fake_tmpdir)
+    monkeypatch.setattr(sign.hfsplus, "hfs_to_tarfile", fake_hfs_to_tarfile)
 
-    await sign._convert_dmg_to_tar_gz(context, dmg_path)
+    assert await sign._convert_dmg_to_tar_gz(context, dmg_path) == tarball_path
+    assert commands == [
+        ["dmg", "extract", abs_dmg_path, "tmp.hfs"],
+        ["hfsplus", "tmp.hfs", "extractall", "/", "{}/app".format(tmpdir)],
+        ["tar", "czf", abs_tarball_path, "."],
+    ]
 
 
 # _extract_zipfile _create_zipfile {{{1
@@ -689,6 +1267,98 @@ async def test_zipfile_append_write(context):
     assert sorted(await sign._get_zipfile_files(to)) == full_rel_files
 
 
+# _rewrite_zipfile {{{1
+def _zip_members_raw(path):
+    members = {}
+    with zipfile.ZipFile(path) as z:
+        for info in z.infolist():
+            z.fp.seek(info.header_offset)
+            fheader = struct.unpack(zipfile.structFileHeader, z.fp.read(zipfile.sizeFileHeader))
+            z.fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+            members[info.filename] = (info.compress_type, info.CRC, info.external_attr, z.fp.read(info.compress_size))
+    return members
+
+
+class UnseekableWriter(io.RawIOBase):
+    def __init__(self, fh):
+        self.fh = fh
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.fh.write(data)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("raw_copy", (True, False))
+@pytest.mark.parametrize("stream", (True, False))
+async def test_rewrite_zipfile(context, tmp_path, mocker, stream, raw_copy):
+    mocker.patch.object(sign, "_ZIP_RAW_COPY", raw_copy)
+    orig = tmp_path / "orig.zip"
+    with open(orig, "wb") as fh:
+        # Writing to an unseekable stream uses data descriptors
+        with zipfile.ZipFile(UnseekableWriter(fh) if stream else fh, "w", compression=zipfile.ZIP_DEFLATED) as z:
+            z.writestr("dir/", b"")
+            z.writestr("dir/keep", b"keep" * 1000)
+            z.writestr(zipfile.ZipInfo("stored", date_time=(2000, 1, 2, 3, 4, 6)), b"stored")
+            info = zipfile.ZipInfo("dir/keep_attrs", date_time=(2002, 1, 2, 3, 4, 6))
+            info.external_attr = 0o644 << 16
+            info.extra = struct.pack("<HHI", 0xCAFE, 4, 1234)
+            z.writestr(info, b"attrs", compress_type=zipfile.ZIP_STORED)
+            info = zipfile.ZipInfo("dir/replace", date_time=(2001, 1, 2, 3, 4, 6))
+            info.external_attr = 0o755 << 16
+            z.writestr(info, b"original", compress_type=zipfile.ZIP_DEFLATED)
+    before = _zip_members_raw(orig)
+
+    tmp_dir = tmp_path / "tmp"
+    (tmp_dir / "dir").mkdir(parents=True)
+    (tmp_dir / "dir" / "replace").write_bytes(b"replaced")
+    (tmp_dir / "dir" / "replace.sig").write_bytes(b"sig")
+    await sign._rewrite_zipfile(context, str(orig), str(tmp_dir), replace=["dir/replace"], add=["dir/replace.sig"])
+
+    with zipfile.ZipFile(orig) as z:
+        assert z.testzip() is None
+        assert z.namelist() == ["dir/", "dir/keep", "stored", "dir/keep_attrs", "dir/replace", "dir/replace.sig"]
+        assert z.read("dir/keep") == b"keep" * 1000
+        info = z.getinfo("dir/keep_attrs")
+        assert (info.external_attr, info.date_time, info.extra) == (0o644 << 16, (2002, 1, 2, 3, 4, 6), struct.pack("<HHI", 0xCAFE, 4, 1234))
+        assert info.compress_type == zipfile.ZIP_STORED
+        assert z.read("stored") == b"stored"
+        assert z.read("dir/replace") == b"replaced"
+        assert z.read("dir/replace.sig") == b"sig"
+        info = z.getinfo("dir/replace")
+        assert info.external_attr == 0o755 << 16
+        assert info.date_time == (2001, 1, 2, 3, 4, 6)
+    after = _zip_members_raw(orig)
+    for name in ("dir/", "dir/keep", "stored", "dir/keep_attrs"):
+        if raw_copy:
+            assert after[name] == before[name]
+        else:
+            # The data may be compressed differently, but is the same
+            assert after[name][:3] == before[name][:3]
+    assert not [f for f in os.listdir(tmp_path) if f.startswith(".rezip")]
+
+
+@pytest.mark.asyncio
+async def test_rewrite_zipfile_copies_compressed_data(context, tmp_path):
+    orig = tmp_path / "orig.zip"
+    with zipfile.ZipFile(orig, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as z:
+        z.writestr("a", os.urandom(100) * 100)
+    with zipfile.ZipFile(orig) as z:
+        compress_size = z.getinfo("a").compress_size
+    await sign._rewrite_zipfile(context, str(orig), str(tmp_path))
+    with zipfile.ZipFile(orig) as z:
+        # Recompressing at the default level would have changed the size
+        assert z.getinfo("a").compress_size == compress_size
+
+
+@pytest.mark.asyncio
+async def test_bad_rewrite_zipfile(context, tmp_path):
+    with pytest.raises(SigningScriptError):
+        await sign._rewrite_zipfile(context, str(tmp_path / "missing.zip"), str(tmp_path))
+
+
 # tarfile {{{1
 @pytest.mark.asyncio
 @pytest.mark.parametrize("path,compression", ((os.path.join(TEST_DATA_DIR, "test.tar.bz2"), "bz2"), (os.path.join(TEST_DATA_DIR, "test.tar.gz"), "gz")))
@@ -710,6 +1380,13 @@ async def test_working_tarfile(context):
     await helper_archive(context, "foo.tar.gz", sign._create_tarfile, sign._extract_tarfile, "gz")
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("filename,compression", (("foo.tar.gz", "gz"), ("foo.tar.bz2", "bz2")))
+async def test_working_parallel_tarfile(context, filename, compression):
+    context.config["tar_compression_threads"] = 4
+    await helper_archive(context, filename, sign._create_tarfile, sign._extract_tarfile, compression)
+
+
 @pytest.mark.asyncio
 async def test_bad_create_tarfile(context, mocker):
     mocker.patch.object(tarfile, "open", new=context_die)
@@ -737,6 +1414,166 @@ async def test_tarfile_append_write(context):
     assert sorted(await sign._get_tarfile_files(to, "bz2")) == rel_files
 
 
+def _make_tarfile(path, compression, members):
+    with tarfile.open(path, mode="w:{}".format(compression)) as t:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.mtime = 1234567890
+            info.uid = 1000
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                t.addfile(info)
+            else:
+                info.size = len(data)
+                info.mode = 0o644
+                t.addfile(info, BytesIO(data))
+
+
+def _tar_members(path):
+    members = {}
+    with tarfile.open(path, mode="r") as t:
+        for member in t:
+            fh = t.extractfile(member) if member.isfile() else None
+            members[member.name] = (member.type, member.mode, member.uid, member.gid, fh and fh.read())
+    return members
+
+
+# _scan_tarfile {{{1
+@pytest.mark.asyncio
+async def test_scan_tarfile(context, tmp_path):
+    orig = str(tmp_path / "foo.tar.gz")
+    _make_tarfile(orig, "gz", [("./firefox", None), ("./firefox/firefox", b"binary"), ("./firefox/omni.ja", b"omni"), ("./firefox/browser/omni.ja", b"omni2")])
+    tmp_dir = str(tmp_path / "scanned")
+    names = await sign._scan_tarfile(context, orig, ".gz", ("omni.ja",), tmp_dir=tmp_dir)
+    assert names == ["./firefox/", "./firefox/firefox", "./firefox/omni.ja", "./firefox/browser/omni.ja"]
+    assert sorted(glob.glob(os.path.join(tmp_dir, "**"), recursive=True)) == sorted(
+        [tmp_dir + "/", *[os.path.join(tmp_dir, f) for f in ("firefox", "firefox/omni.ja", "firefox/browser", "firefox/browser/omni.ja")]]
+    )
+
+
+@pytest.mark.parametrize("archive_type", ("tar", "zip"))
+@pytest.mark.asyncio
+async def test_archive_symlinks_precomplete(context, tmp_path, archive_type):
+    """Symlinks to directories are listed as directories, and precomplete
+    from the member list matches precomplete from the extracted tree.
+
+    """
+    links = {"firefox/lib": "real", "firefox/lib2": "lib", "firefox/libfile": "real/a.so", "firefox/broken": "missing"}
+    files = ["firefox/precomplete", "firefox/firefox", "firefox/real/a.so"]
+    orig = str(tmp_path / "foo.{}".format(archive_type))
+    if archive_type == "tar":
+        with tarfile.open(orig, mode="w:gz") as t:
+            for name in files:
+                info = tarfile.TarInfo(name)
+                info.size = 1
+                t.addfile(info, BytesIO(b"x"))
+            for name, target in links.items():
+                info = tarfile.TarInfo(name)
+                info.type = tarfile.SYMTYPE
+                info.linkname = target
+                t.addfile(info)
+        names = await sign._scan_tarfile(context, orig, ".gz", (), tmp_dir=str(tmp_path / "scanned"))
+    else:
+        with zipfile.ZipFile(orig, "w") as z:
+            for name in files:
+                z.writestr(name, "x")
+            for name, target in links.items():
+                info = zipfile.ZipInfo(name)
+                info.external_attr = (0o120777 << 16) | 0x20
+                z.writestr(info, target)
+        names = await sign._get_zipfile_files(orig)
+    assert sorted(n for n in names if n.endswith("/")) == ["firefox/lib/", "firefox/lib2/"]
+
+    extracted = tmp_path / "extracted"
+    for name in files:
+        (extracted / name).parent.mkdir(parents=True, exist_ok=True)
+        (extracted / name).write_text("x")
+    for name, target in links.items():
+        os.symlink(target, str(extracted / name))
+    sign.generate_precomplete(str(extracted / "firefox"))
+    partial = tmp_path / "partial" / "firefox"
+    partial.mkdir(parents=True)
+    sign._generate_precomplete_from_file_list(str(partial / "precomplete"), str(tmp_path / "partial"), names)
+    assert (partial / "precomplete").read_text() == (extracted / "firefox" / "precomplete").read_text()
+
+
+@pytest.mark.asyncio
+async def test_bad_scan_tarfile(context, tmp_path):
+    with pytest.raises(SigningScriptError):
+        await sign._scan_tarfile(context, str(tmp_path / "missing.tar.gz"), "gz", ())
+
+
+# _rewrite_tarfile {{{1
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compression", ("gz", "bz2"))
+@pytest.mark.parametrize("threads", (1, 4))
+async def test_rewrite_tarfile(context, tmp_path, compression, threads):
+    context.config["tar_compression_threads"] = threads
+    orig = str(tmp_path / "foo.tar.{}".format(compression))
+    _make_tarfile(orig, compression, [("dir", None), ("dir/keep", b"keep" * 1000), ("dir/replace", b"old")])
+    expected = _tar_members(orig)
+    tmp_dir = tmp_path / "tmp"
+    (tmp_dir / "dir").mkdir(parents=True)
+    (tmp_dir / "dir" / "replace").write_bytes(b"new")
+    (tmp_dir / "dir" / "replace.sig").write_bytes(b"sig")
+    assert await sign._rewrite_tarfile(context, orig, "." + compression, str(tmp_dir), replace=["dir/replace"], add=["dir/replace.sig"]) == orig
+
+    members = _tar_members(orig)
+    assert list(members) == ["dir", "dir/keep", "dir/replace", "dir/replace.sig"]
+    # Unchanged members keep everything but their owner
+    for name in ("dir", "dir/keep"):
+        assert members[name] == expected[name][:2] + (0, 0) + expected[name][4:]
+    assert members["dir/replace"][-1] == b"new"
+    assert members["dir/replace.sig"][-1] == b"sig"
+    assert not glob.glob(str(tmp_path / ".retar*"))
+
+
+@pytest.mark.asyncio
+async def test_bad_rewrite_tarfile(context, tmp_path):
+    orig = str(tmp_path / "foo.tar.gz")
+    _make_tarfile(orig, "gz", [("a", b"a")])
+    with open(orig, "rb") as fh:
+        contents = fh.read()
+    with pytest.raises(SigningScriptError):
+        await sign._rewrite_tarfile(context, orig, "gz", str(tmp_path), replace=["a"])
+    with open(orig, "rb") as fh:
+        assert fh.read() == contents
+    assert not glob.glob(str(tmp_path / ".retar*"))
+
+
+@pytest.mark.asyncio
+async def test_sign_widevine_tar_streams_members(context, mocker, tmp_path):
+    orig = str(tmp_path / "foo.tar.gz")
+    members = [
+        ("firefox", None),
+        ("firefox/precomplete", b'remove "firefox"\n'),
+        ("firefox/firefox", b"binary"),
+        ("firefox/libxul.so", b"xul"),
+        ("firefox/libxul.so.sig", b"already signed"),
+        ("firefox/other", b"other" * 1000),
+    ]
+    _make_tarfile(orig, "gz", members)
+    signed = []
+
+    async def fake_sign(_, from_, blessed, to=None):
+        signed.append(os.path.relpath(from_, os.path.dirname(os.path.dirname(from_))))
+        with open(to, "wb") as fh:
+            fh.write(b"sig")
+
+    mocker.patch.object(sign, "sign_widevine_with_autograph", new=fake_sign)
+    await sign.sign_widevine(context, orig, "autograph_widevine")
+    assert signed == ["firefox/firefox"]
+
+    result = _tar_members(orig)
+    assert list(result) == [name for name, _ in members] + ["firefox/firefox.sig"]
+    assert result["firefox/other"][-1] == b"other" * 1000
+    assert result["firefox/firefox.sig"][-1] == b"sig"
+    precomplete = result["firefox/precomplete"][-1].decode("utf-8")
+    assert 'remove "firefox.sig"' in precomplete
+    assert 'remove "other"' in precomplete
+
+
 def test_signreq_task_keyid():
     fmt = "autograph_hash_only_mar384"
     req = sign.make_signing_req(None, fmt, "newkeyid")
@@ -771,6 +1608,28 @@ def test_signreq_task_langpack():
     assert req["options"]["pkcs7_digest"] == "SHA256"
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("data", (b"", b"a", b"ab", b"abc", b"abcd", os.urandom(sign._SIGNING_REQ_CHUNK_SIZE * 2 + 1)))
+async def test_stream_signing_req(mocker, data):
+    mocker.patch.object(sign, "_SIGNING_REQ_CHUNK_SIZE", 3)
+    sign_req = sign.make_signing_req(BytesIO(data), "autograph_apk_foo", keyid="key")
+    h = sha256()
+    body = b"".join([chunk async for chunk in sign.stream_signing_req(sign_req, hashers=(h,))])
+    assert json.loads(body) == [{"input": base64.b64encode(data).decode("ascii"), "keyid": "key", "options": {"zip": "passthrough"}}]
+    assert sign.get_signing_req_size(sign_req) == len(body)
+    assert h.digest() == sha256(body).digest()
+    # A second pass, e.g. on retry, starts from the beginning of the input
+    assert b"".join([chunk async for chunk in sign.stream_signing_req(sign_req)]) == body
+
+
+@pytest.mark.asyncio
+async def test_get_hawk_content_hash():
+    sign_req = sign.make_signing_req(BytesIO(b"0xdeadbeef"), "autograph_mar")
+    body = json.dumps([{"input": "MHhkZWFkYmVlZg=="}], separators=(",", ":")).encode("utf8")
+    expected = base64.b64encode(sha256(b"hawk.1.payload\napplication/json\n" + body + b"\n").digest()).decode("ascii")
+    assert await sign.get_hawk_content_hash(sign_req, "application/json") == expected
+
+
 @pytest.mark.asyncio
 async def test_bad_autograph_method():
     with pytest.raises(SigningScriptError):
@@ -848,6 +1707,78 @@ async def test_gpg_autograph(context, mocker, tmp_path):
         result = await sign.sign_gpg_with_autograph(context, tmp, "gpg")
 
 
+@pytest.mark.asyncio
+async def test_sign_archive_members_fuses_formats(context, mocker, tmp_path):
+    orig = str(tmp_path / "foo.tar.gz")
+    members = [
+        ("firefox", None),
+        ("firefox/precomplete", b'remove "firefox"\n'),
+        ("firefox/firefox", b"binary"),
+        ("firefox/omni.ja", b"omni"),
+    ]
+    _make_tarfile(orig, "gz", members)
+    signed = []
+    rewrites = []
+    rewrite_tarfile = sign._rewrite_tarfile
+
+    async def fake_widevine(_, from_, blessed, to=None):
+        signed.append(os.path.basename(from_))
+        with open(to, "wb") as fh:
+            fh.write(b"sig")
+
+    async def fake_omnija(_, from_):
+        signed.append(os.path.basename(from_))
+        with open(from_, "wb") as fh:
+            fh.write(b"signed omni")
+
+    async def fake_rewrite(*args, **kwargs):
+        rewrites.append(kwargs)
+        return await rewrite_tarfile(*args, **kwargs)
+
+    mocker.patch.object(sign, "sign_widevine_with_autograph", new=fake_widevine)
+    mocker.patch.object(sign, "sign_omnija_with_autograph", new=fake_omnija)
+    mocker.patch.object(sign, "_rewrite_tarfile", new=fake_rewrite)
+    assert await sign.sign_archive_members(context, orig, ["autograph_widevine", "autograph_omnija"]) == orig
+    assert signed == ["firefox", "omni.ja"]
+    assert rewrites == [{"replace": ["firefox/precomplete", "firefox/omni.ja"], "add": ["firefox/firefox.sig"]}]
+
+    result = _tar_members(orig)
+    assert list(result) == [name for name, _ in members] + ["firefox/firefox.sig"]
+    assert result["firefox/omni.ja"][-1] == b"signed omni"
+    assert result["firefox/firefox.sig"][-1] == b"sig"
+
+
+@pytest.mark.asyncio
+async def test_sign_archive_members_bad_format(context):
+    with pytest.raises(SigningScriptError):
+        await sign.sign_archive_members(context, "foo.zip", ["autograph_widevine", "gpg"])
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "func, fmt, kinds",
+    (
+        (sign.sign_widevine, "autograph_widevine", ["widevine"]),
+        (sign.sign_widevine, "widevine_blessed", ["widevine"]),
+        (sign.sign_omnija, "autograph_omnija", ["omnija"]),
+        (sign.sign_omnija, "gpg", None),
+    ),
+)
+async def test_sign_archive_members_kind_from_format(context, mocker, func, fmt, kinds):
+    calls = []
+
+    async def fake_sign_zip_members(context, orig_path, kinds):
+        calls.append(kinds)
+
+    mocker.patch.object(sign, "_sign_zip_members", new=fake_sign_zip_members)
+    if kinds is None:
+        with pytest.raises(SigningScriptError):
+            await func(context, "foo.zip", fmt)
+    else:
+        assert await func(context, "foo.zip", fmt) == "foo.zip"
+    assert calls == ([kinds] if kinds else [])
+
+
 # sign_omnija {{{1  -- 537
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
@@ -876,7 +1807,7 @@ async def test_sign_omnija(context, mocker, filename, raises, nofiles):
         assert f.endswith(".zip")
         return files
 
-    async def fake_untar(_, f, comp, **kwargs):
+    async def fake_scan(_, f, comp, basenames, **kwargs):
         assert f.endswith(".tar.{}".format(comp.lstrip(".")))
         return files
 
@@ -886,14 +1817,14 @@ async def test_sign_omnija(context, mocker, filename, raises, nofiles):
     def fake_isfile(path):
         return "isdir" not in path
 
-    mocker.patch.object(sign, "_get_tarfile_files", new=fake_filelist)
-    mocker.patch.object(sign, "_extract_tarfile", new=fake_untar)
+    mocker.patch.object(sign, "_scan_tarfile", new=fake_scan)
     mocker.patch.object(sign, "_get_zipfile_files", new=fake_filelist)
     mocker.patch.object(sign, "_extract_zipfile", new=fake_unzip)
     mocker.patch.object(sign, "_convert_dmg_to_tar_gz", new=fake_undmg)
     mocker.patch.object(sign, "sign_omnija_with_autograph", new=noop_async)
-    mocker.patch.object(sign, "_create_tarfile", new=noop_async)
+    mocker.patch.object(sign, "_rewrite_tarfile", new=noop_async)
     mocker.patch.object(sign, "_create_zipfile", new=noop_async)
+    mocker.patch.object(sign, "_rewrite_zipfile", new=noop_async)
     mocker.patch.object(os.path, "isfile", new=fake_isfile)
 
     if raises:
@@ -927,6 +1858,12 @@ async def test_omnija_same(mocker, tmpdir, orig):
             assert name == "signed.ja"
             assert mode == "r"
 
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
         def namelist(self):
             return ["foobar", "baseball"]
 
@@ -957,6 +1894,22 @@ async def test_omnija_sign(tmpdir, mocker, context, orig, signed, sha256_expecte
     assert sha256_actual == sha256_expected
 
 
+@pytest.mark.asyncio
+async def test_omnija_sign_bad_jar(tmpdir, mocker, context):
+    copy_from = os.path.join(tmpdir, "omni.ja")
+    with open(copy_from, "wb") as fh:
+        fh.write(b"not a jar")
+
+    async def mocked_autograph(context, from_, fmt, to, extension_id):
+        shutil.copyfile(os.path.join(TEST_DATA_DIR, "no_preload_signed_omni.ja"), to)
+
+    mocker.patch.object(sign, "sign_file_with_autograph", mocked_autograph)
+    with pytest.raises(SigningScriptError):
+        await sign.sign_omnija_with_autograph(context, copy_from)
+    assert open(copy_from, "rb").read() == b"not a jar"
+    assert not glob.glob(os.path.join(tmpdir, ".merge*"))
+
+
 def test_langpack_id_regex():
     assert sign.LANGPACK_RE.match("langpack-en-CA@firefox.mozilla.org") is not None
     assert sign.LANGPACK_RE.match("langpack-ja-JP-mac@devedition.mozilla.org") is not None
@@ -1006,6 +1959,22 @@ def test_extension_id_raises(json_, raises, mocker):
         assert id == json_["applications"]["gecko"]["id"]
 
 
+@pytest.fixture
+def mocked_winsign(mocker):
+    """Mock out `winsign.sign.sign_file`, and return the names of the files it signs."""
+    signed = []
+
+    async def mocked_sign_file(infile, outfile, digest_algo, certs, signer, **kwargs):
+        signed.append(os.path.basename(infile))
+        await signer("", digest_algo)
+        shutil.copyfile(infile, outfile)
+        return True
+
+    mocker.patch.object(winsign.sign, "sign_file", mocked_sign_file)
+    mocker.patch.object(winsign.osslsigncode, "is_signed", lambda filename: filename.endswith("signed.exe"))
+    return signed
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize("fmt", ("autograph_authenticode", "autograph_authenticode_stub"))
 @pytest.mark.parametrize("use_comment", (True, False))
@@ -1182,6 +2151,196 @@ async def test_authenticode_sign_authenticode_permanent_error(tmpdir, mocker, co
     assert "BAD!" in caplog.text
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("timestamp_style", (None, "old", "rfc3161"))
+async def test_authenticode_sign_file_in_thread(tmpdir, mocker, context, timestamp_style):
+    context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
+    context.config["authenticode_url"] = "https://example.com"
+    context.config["authenticode_timestamp_style"] = timestamp_style
+
+    test_file = os.path.join(tmpdir, "helper.exe")
+    with open(test_file, "wb") as f:
+        f.write(b"MZ")
+
+    async def mocked_autograph(context, from_, fmt, keyid):
+        # autograph is called on the main thread's event loop
+        assert threading.current_thread() is threading.main_thread()
+        return b"signature"
+
+    async def mocked_winsign(infile, outfile, digest_algo, certs, signer, url=None, comment=None, crosscert=None, timestamp_style=None):
+        assert threading.current_thread() is not threading.main_thread()
+        assert (url, comment, crosscert, timestamp_style) == ("https://example.com", None, None, context.config["authenticode_timestamp_style"])
+        assert await signer(b"digest", digest_algo) == b"signature"
+        shutil.copyfile(infile, outfile)
+        return True
+
+    mocker.patch.object(sign, "sign_hash_with_autograph", mocked_autograph)
+    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+    mocker.patch.object(winsign.osslsigncode, "is_signed", lambda filename: False)
+
+    assert await sign.sign_authenticode_file(context, test_file, "autograph_authenticode")
+    assert not os.path.exists(test_file + "-new")
+
+
+@pytest.mark.asyncio
+async def test_authenticode_sign_zip_concurrency(tmpdir, mocker, context, mocked_winsign, caplog):
+    context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
+    context.config["authenticode_url"] = "https://example.com"
+    context.config["authenticode_timestamp_style"] = None
+    context.config["max_concurrent_authenticode_files"] = 2
+    context.config["authenticode_progress_interval"] = 2
+    caplog.set_level(logging.INFO)
+
+    test_file = os.path.join(tmpdir, "windows.zip")
+    names = ["lib{}.dll".format(i) for i in range(5)] + ["signed.exe", "readme.txt"]
+    with zipfile.ZipFile(test_file, "w") as z:
+        for name in names:
+            z.writestr(name, name)
+
+    executors = []
+    mocker.patch.object(sign, "ThreadPoolExecutor", lambda max_workers: executors.append(max_workers) or ThreadPoolExecutor(max_workers))
+
+    in_flight = []
+    max_in_flight = []
+
+    async def mocked_autograph(context, from_, fmt, keyid):
+        in_flight.append(from_)
+        max_in_flight.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.pop()
+        return b""
+
+    mocker.patch.object(sign, "sign_hash_with_autograph", mocked_autograph)
+
+    assert await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode") == test_file
+    # signed.exe is skipped, and readme.txt doesn't need signing
+    assert executors == [2]
+    assert len(max_in_flight) == 5
+    assert max(max_in_flight) == 2
+    progress = [r.getMessage() for r in caplog.records if "authenticode files in" in r.getMessage()]
+    assert [p.split()[1] for p in progress] == ["2/6", "4/6", "6/6"]
+    assert all("files/s" in p and "MB/s" in p for p in progress)
+    with zipfile.ZipFile(test_file) as z:
+        assert sorted(z.namelist()) == sorted(names)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("fail", (False, True))
+async def test_authenticode_sign_zip_threads(tmpdir, mocker, context, mocked_winsign, fail):
+    context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
+    context.config["authenticode_url"] = "https://example.com"
+    context.config["authenticode_timestamp_style"] = None
+
+    async def mocked_winsign(infile, outfile, digest_algo, certs, signer, **kwargs):
+        if os.path.basename(infile) == "bad.dll":
+            return False
+        await signer("", digest_algo)
+        with open(outfile, "w") as f:
+            f.write(str(threading.get_ident()))
+        return True
+
+    async def mocked_autograph(context, from_, fmt, keyid):
+        # When bad.dll fails, the other files are still being signed
+        await asyncio.sleep(30 if fail else 0.01)
+        return b""
+
+    mocker.patch.object(sign, "sign_hash_with_autograph", mocked_autograph)
+    mocker.patch.object(winsign.sign, "sign_file", mocked_winsign)
+
+    test_file = os.path.join(tmpdir, "windows.zip")
+    names = ["lib{}.dll".format(i) for i in range(8)] + (["bad.dll"] if fail else [])
+    with zipfile.ZipFile(test_file, "w") as z:
+        for name in names:
+            z.writestr(name, name)
+
+    executors = []
+    mocker.patch.object(sign, "ThreadPoolExecutor", lambda max_workers: executors.append(ThreadPoolExecutor(max_workers)) or executors[-1])
+    if fail:
+        start = time.time()
+        with pytest.raises(IOError):
+            await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode")
+        # The other files' tasks and autograph requests were cancelled and
+        # awaited, so their threads didn't wait for them
+        assert time.time() - start < 10
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+    else:
+        assert await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode") == test_file
+        with zipfile.ZipFile(test_file) as z:
+            idents = {int(z.read(name)) for name in names}
+        assert threading.get_ident() not in idents
+    # The worker threads were shut down
+    with pytest.raises(RuntimeError):
+        executors[0].submit(noop_sync)
+
+
+def _make_pe_file(signed, magic=0x10B, nrvasizes=16, pe_offset=0x80):
+    """Return the headers of a PE file, with a certificate table if `signed`."""
+    optional_header = pe_offset + 24
+    certtable_offset = optional_header + (128 if magic == 0x10B else 144)
+    data = bytearray(certtable_offset + 8 + 0x100)
+    data[:2] = b"MZ"
+    struct.pack_into("<I", data, 0x3C, pe_offset)
+    data[pe_offset : pe_offset + 4] = b"PE\x00\x00"
+    struct.pack_into("<H", data, optional_header, magic)
+    struct.pack_into("<I", data, optional_header + (92 if magic == 0x10B else 108), nrvasizes)
+    if signed:
+        struct.pack_into("<II", data, certtable_offset, len(data), 0x100)
+    return bytes(data)
+
+
+@pytest.mark.parametrize(
+    "data, expected",
+    (
+        (_make_pe_file(True), True),
+        (_make_pe_file(False), False),
+        (_make_pe_file(True, magic=0x20B), True),
+        (_make_pe_file(False, magic=0x20B), False),
+        (_make_pe_file(True, nrvasizes=4), False),
+        (_make_pe_file(True, magic=0x107), None),
+        (_make_pe_file(True, pe_offset=8192), None),
+        (_make_pe_file(True)[:200], None),
+        (b"MZ", None),
+        (b"\xd0\xcf\x11\xe0" * 100, None),
+    ),
+)
+def test_is_signed_pe_file(tmp_path, data, expected):
+    path = tmp_path / "file.dll"
+    path.write_bytes(data)
+    assert sign._is_signed_pe_file(str(path)) is expected
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("names, signed_names", ((("signed.dll", "unsigned.dll", "setup.msi"), ("setup.msi",)), (("signed.dll",), ())))
+async def test_authenticode_sign_zip_prescan(tmp_path, mocker, context, mocked_winsign, caplog, names, signed_names):
+    context.config["authenticode_cert"] = os.path.join(TEST_DATA_DIR, "windows.crt")
+    context.config["authenticode_url"] = "https://example.com"
+    context.config["authenticode_timestamp_style"] = None
+    caplog.set_level(logging.INFO)
+
+    test_file = str(tmp_path / "windows.zip")
+    with zipfile.ZipFile(test_file, "w") as z:
+        for name in names:
+            z.writestr(name, b"msi" if name.endswith(".msi") else _make_pe_file(name == "signed.dll"))
+
+    is_signed_calls = []
+
+    def mocked_is_signed(filename):
+        is_signed_calls.append(os.path.basename(filename))
+        return os.path.basename(filename) in signed_names
+
+    async def mocked_autograph(context, from_, fmt, keyid):
+        return b""
+
+    mocker.patch.object(winsign.osslsigncode, "is_signed", mocked_is_signed)
+    mocker.patch.object(sign, "sign_hash_with_autograph", mocked_autograph)
+
+    assert await sign.sign_authenticode_zip(context, test_file, "autograph_authenticode") == test_file
+    # Only files that aren't PE files are checked with osslsigncode
+    assert is_signed_calls == [n for n in names if n.endswith(".msi")]
+    assert mocked_winsign == [n for n in names if n == "unsigned.dll"]
+    assert "Skipping 1 already signed files in {}: ['signed.dll']".format(test_file) in caplog.text
+
+
 @pytest.mark.asyncio
 async def test_authenticode_sign_gpg_temporary_error(tmpdir, mocker, context, caplog):
     context.task = {}
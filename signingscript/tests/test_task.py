@@ -136,6 +136,42 @@ async def test_sign(context, mocker, format, filename, post_files):
     await stask.sign(context, filename, [format])
 
 
+@pytest.mark.asyncio
+async def test_sign_fuses_archive_member_formats(context, mocker):
+    calls = []
+
+    async def fake_archive(_, path, fmts, **kwargs):
+        calls.append(("archive", fmts))
+        return path
+
+    async def fake_other(_, path, fmt, **kwargs):
+        calls.append(("other", fmt))
+        return path
+
+    mocker.patch.object(stask, "sign_archive_members", new=fake_archive)
+    mocker.patch.object(stask, "FORMAT_TO_SIGNING_FUNCTION", new={"autograph_widevine": fake_other, "default": fake_other})
+    assert await stask.sign(context, "foo.tar.gz", ["autograph_authenticode", "autograph_widevine", "autograph_omnija", "autograph_gpg"]) == ["foo.tar.gz"]
+    assert calls == [("other", "autograph_authenticode"), ("archive", ["autograph_widevine", "autograph_omnija"]), ("other", "autograph_gpg")]
+
+
+@pytest.mark.parametrize(
+    "formats, expected",
+    (
+        ([], []),
+        (["gpg"], [["gpg"]]),
+        (["autograph_widevine"], [["autograph_widevine"]]),
+        (["autograph_widevine", "autograph_omnija"], [["autograph_widevine", "autograph_omnija"]]),
+        (["autograph_widevine", "macapp", "autograph_omnija"], [["autograph_widevine"], ["macapp"], ["autograph_omnija"]]),
+        (
+            stask._sort_formats(["autograph_gpg", "autograph_omnija", "autograph_authenticode:202005", "autograph_widevine"]),
+            [["autograph_authenticode:202005"], ["autograph_widevine", "autograph_omnija"], ["autograph_gpg"]],
+        ),
+    ),
+)
+def test_plan_signing(formats, expected):
+    assert stask._plan_signing(formats) == expected
+
+
 @pytest.mark.parametrize(
     "format, expected",
     (
@@ -1,8 +1,17 @@
+import asyncio
+import bz2
+import gzip
+import io
 import json
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+import aiohttp
 import mock
 import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 from scriptworker.context import Context
 
 import signingscript.utils as utils
@@ -14,6 +23,122 @@ ID_RSA_PUB_HASH = "226658906e46b26ef195c468f94e2be983b6c53f370dff0d8e725832f" +
 SERVER_CONFIG_PATH = os.path.join(os.path.dirname(__file__), "example_server_config.json")
 
 
+# AutographSessions {{{1
+def test_autograph_sessions_connection_config():
+    config = {
+        "autograph_connection": {"limit_per_host": 5, "ttl_dns_cache": 10},
+        "autograph_connection_overrides": {"https://autograph.example.com": {"limit_per_host": 50}},
+    }
+    sessions = utils.AutographSessions(config)
+    assert sessions.get_connection_config("https://autograph.example.com") == dict(utils.AUTOGRAPH_CONNECTION_DEFAULTS, limit_per_host=50, ttl_dns_cache=10)
+    assert sessions.get_connection_config("https://other.example.com") == dict(utils.AUTOGRAPH_CONNECTION_DEFAULTS, limit_per_host=5, ttl_dns_cache=10)
+
+
+@pytest.mark.asyncio
+async def test_autograph_sessions_reuse_connections(mocker):
+    async def handler(request):
+        return web.json_response([{"signature": "sig"}])
+
+    app = web.Application()
+    app.router.add_post("/sign/hash", handler)
+    async with TestServer(app) as server:
+        url = str(server.make_url(""))
+        sessions = utils.AutographSessions({"autograph_connection_overrides": {url: {"limit_per_host": 1}}})
+        context = Context()
+        context.autograph_sessions = sessions
+        session = utils.get_autograph_session(context, utils.Autograph(url, "user", "key", ["autograph_hash"]))
+        assert session is sessions.get_session(url)
+        assert session.connector.limit_per_host == 1
+        for _ in range(3):
+            async with session.post(f"{url}/sign/hash") as resp:
+                assert await resp.json() == [{"signature": "sig"}]
+        # Only one connection is allowed, so these have to queue for it
+        await asyncio.gather(*[session.post(f"{url}/sign/hash") for _ in range(3)])
+        sessions.log_stats()
+        await sessions.close()
+        assert sessions.sessions == {}
+
+    stats = sessions.stats[url]
+    assert stats.requests == 6
+    assert stats.connections_opened == 1
+    assert stats.connections_reused == 5
+    assert stats.connection_wait_time >= 0
+
+
+def test_get_autograph_session_fallback():
+    context = Context()
+    context.session = mock.sentinel.session
+    assert utils.get_autograph_session(context, None) is mock.sentinel.session
+
+
+# AutographServerSelector {{{1
+@pytest.mark.parametrize(
+    "exception,expected",
+    (
+        (aiohttp.ClientConnectionError(), True),
+        (asyncio.TimeoutError(), True),
+        (aiohttp.ClientResponseError(None, (), status=503), True),
+        (aiohttp.ClientResponseError(None, (), status=401), False),
+        (ValueError(), False),
+    ),
+)
+def test_is_autograph_server_error(exception, expected):
+    assert utils.is_autograph_server_error(exception) == expected
+
+
+def test_autograph_server_selector_order():
+    selector = utils.AutographServerSelector(2, 30)
+    a, b, c = [utils.Autograph(f"https://{name}", "user", "key", ["autograph_hash"]) for name in "abc"]
+    assert selector.order([a, b, c]) == [a, b, c]
+    # Least outstanding requests first
+    with selector.track(a):
+        assert selector.order([a, b, c]) == [b, c, a]
+        with selector.track(b):
+            assert selector.order([a, b, c]) == [c, a, b]
+    # Then the lowest latency
+    selector.health[a.url].latency = 2.0
+    selector.health[b.url].latency = 1.0
+    assert selector.order([a, b, c]) == [c, b, a]
+    assert selector.health[a.url].outstanding == 0
+    assert selector.health[a.url].requests == 1
+    selector.log_stats()
+
+
+def test_autograph_server_selector_circuit_breaker(mocker):
+    now = 1000.0
+    mocker.patch.object(utils.time, "monotonic", side_effect=lambda: now)
+    selector = utils.AutographServerSelector(2, 30)
+    a, b = [utils.Autograph(f"https://{name}", "user", "key", ["autograph_hash"]) for name in "ab"]
+    # Client errors don't count against the server
+    with pytest.raises(aiohttp.ClientResponseError):
+        with selector.track(a):
+            raise aiohttp.ClientResponseError(None, (), status=400)
+    for _ in range(2):
+        with pytest.raises(aiohttp.ClientConnectionError):
+            with selector.track(a):
+                raise aiohttp.ClientConnectionError()
+    assert selector.health[a.url].failures == 2
+    assert not selector.is_available(a)
+    with selector.track(b):
+        # A busy server beats one that's failing
+        assert selector.order([a, b]) == [b, a]
+    now += 31
+    assert selector.is_available(a)
+    with selector.track(a):
+        pass
+    assert selector.health[a.url].consecutive_failures == 0
+    assert selector.health[a.url].open_until == 0.0
+
+
+def test_get_autograph_selector():
+    context = Context()
+    assert utils.get_autograph_selector(context) is None
+    context.autograph_selector = utils.AutographServerSelector.from_config(
+        {"autograph_circuit_breaker_failures": 3, "autograph_circuit_breaker_cooldown": 30}
+    )
+    assert utils.get_autograph_selector(context).failure_threshold == 3
+
+
 # mkdir {{{1
 def test_mkdir_does_make_dirs(tmpdir):
     def assertDirIsUniqueAndNamed(dirs, name):
@@ -121,6 +246,172 @@ def test_copy_to_dir_no_copy():
     assert utils.copy_to_dir(SERVER_CONFIG_PATH, os.path.dirname(SERVER_CONFIG_PATH)) is None
 
 
+@pytest.mark.parametrize("link", (True, False))
+def test_copy_to_dir_link(tmp_path, link):
+    source = tmp_path / "source"
+    source.write_bytes(b"source")
+    target_path = utils.copy_to_dir(str(source), str(tmp_path / "parent"), target="target", link=link)
+    assert os.path.samefile(source, target_path) == link
+
+
+# stage_file {{{1
+def _fail(*args, **kwargs):
+    raise OSError("nope")
+
+
+@pytest.mark.parametrize(
+    "link, patches, expected",
+    (
+        (True, {}, "link"),
+        (True, {"os.link": _fail, "fcntl.ioctl": None}, "reflink"),
+        (False, {"fcntl.ioctl": None}, "reflink"),
+        (False, {"fcntl.ioctl": _fail}, "copy_file_range" if hasattr(os, "copy_file_range") else "sendfile"),
+        (False, {"fcntl.ioctl": _fail, "os.copy_file_range": _fail, "os.sendfile": _fail}, "copy"),
+        (False, {"fcntl.ioctl": _fail, "os.copy_file_range": lambda *args: 0, "os.sendfile": _fail}, "copy"),
+    ),
+)
+def test_stage_file(tmp_path, mocker, link, patches, expected):
+    source = tmp_path / "source"
+    source.write_bytes(b"x" * 100000)
+    target = tmp_path / "target"
+    target.write_bytes(b"old contents that are longer than the source" * 10000)
+    for name, func in patches.items():
+        module, attr = name.split(".")
+        module = getattr(utils, module)
+        if hasattr(module, attr):
+            mocker.patch.object(module, attr, new=func or mock.MagicMock())
+    if expected == "reflink":
+        # Pretend to clone, since tmp_path may not support it
+        utils.fcntl.ioctl.side_effect = lambda fd, request, src_fd: os.write(fd, os.pread(src_fd, 100000, 0))
+
+    assert utils.stage_file(str(source), str(target), link=link) == expected
+    assert target.read_bytes() == source.read_bytes()
+    assert os.path.samefile(source, target) == (expected == "link")
+    if expected != "link":
+        # Writing to the copy must never change the source
+        with open(target, "r+b") as f:
+            f.write(b"y")
+        assert source.read_bytes() == b"x" * 100000
+
+
+# ParallelCompressor {{{1
+@pytest.mark.parametrize("compression,decompress", (("gz", gzip.decompress), ("bz2", bz2.decompress)))
+@pytest.mark.parametrize("size,block_size,threads", ((0, 1024, 2), (1000, 1024, 2), (1024, 1024, 2), (100000, 1024, 4), (100000, 7777, 1), (100000, None, 3)))
+def test_parallel_compressor(compression, decompress, size, block_size, threads):
+    data = os.urandom(size // 2) + b"a" * (size - size // 2)
+    fh = io.BytesIO()
+    with utils.ParallelCompressor(fh, compression, threads, block_size=block_size) as compressor:
+        # Write in uneven pieces, so they straddle the blocks
+        for i in range(0, size, 999):
+            assert compressor.write(data[i : i + 999]) == len(data[i : i + 999])
+    assert compressor.closed
+    assert decompress(fh.getvalue()) == data
+
+
+def test_parallel_compressor_gzip_module():
+    data = b"foo bar baz\n" * 1000
+    fh = io.BytesIO()
+    with utils.ParallelCompressor(fh, "gz", 2, block_size=100) as compressor:
+        compressor.write(data)
+    with gzip.GzipFile(fileobj=io.BytesIO(fh.getvalue())) as gz:
+        assert gz.read() == data
+
+
+def test_parallel_compressor_bad_compression():
+    with pytest.raises(SigningServerError):
+        utils.ParallelCompressor(io.BytesIO(), "xz", 2)
+
+
+def test_parallel_compressor_exception():
+    fh = io.BytesIO()
+    with pytest.raises(ValueError):
+        with utils.ParallelCompressor(fh, "gz", 2, block_size=10) as compressor:
+            compressor.write(b"x" * 100)
+            raise ValueError("boom")
+    assert not compressor.closed
+
+
+# SignatureCache {{{1
+def test_signature_cache(tmp_path):
+    cache = utils.SignatureCache(str(tmp_path), ["autograph_widevine"], 1024, 60)
+    key = cache.get_key("digest", "autograph_widevine", "keyid", "cert", None)
+    assert cache.get(key) is None
+    cache.put(key, b"signature")
+    assert cache.get(key) == b"signature"
+    assert os.path.exists(tmp_path / key[:2] / key)
+
+    src = tmp_path / "signed"
+    src.write_bytes(b"signed file")
+    cache.put_file("abcd", str(src))
+    assert not cache.get_file("abce", str(tmp_path / "to"))
+    assert cache.get_file("abcd", str(tmp_path / "to"))
+    assert (tmp_path / "to").read_bytes() == b"signed file"
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+@pytest.mark.parametrize(
+    "args",
+    (
+        ("other", "fmt", "keyid", "cert", None),
+        ("digest", "other", "keyid", "cert", None),
+        ("digest", "fmt", "other", "cert", None),
+        ("digest", "fmt", "keyid", "other", None),
+        ("digest", "fmt", "keyid", "cert", "other"),
+    ),
+)
+def test_signature_cache_keys(args):
+    key = utils.SignatureCache.get_key("digest", "fmt", "keyid", "cert", None)
+    assert key == utils.SignatureCache.get_key("digest", "fmt", "keyid", "cert", None)
+    assert key != utils.SignatureCache.get_key(*args)
+
+
+def test_signature_cache_ttl(tmp_path):
+    cache = utils.SignatureCache(str(tmp_path), ["fmt"], 1024, 60)
+    cache.put("abcd", b"signature")
+    path = tmp_path / "ab" / "abcd"
+    os.utime(path, (time.time(), time.time() - 61))
+    assert cache.get("abcd") is None
+    assert not os.path.exists(path)
+
+
+def test_signature_cache_eviction(tmp_path):
+    cache = utils.SignatureCache(str(tmp_path), ["fmt"], 25, 60)
+    now = time.time()
+    for i, key in enumerate(("aa01", "aa02")):
+        cache.put(key, b"x" * 10)
+        os.utime(tmp_path / "aa" / key, (now - 10 + i, now))
+    # Using an entry makes it the most recently used
+    assert cache.get("aa01") == b"x" * 10
+    cache.put("aa03", b"x" * 10)
+    assert sorted(os.listdir(tmp_path / "aa")) == ["aa01", "aa03"]
+
+
+def test_signature_cache_write_error(tmp_path):
+    (tmp_path / "ab").write_text("not a directory")
+    cache = utils.SignatureCache(str(tmp_path), ["fmt"], 1024, 60)
+    cache.put("abcd", b"signature")
+    assert cache.get("abcd") is None
+
+
+@pytest.mark.parametrize(
+    "config,fmt,expected",
+    (
+        ({}, "fmt", False),
+        ({"signature_cache_dir": "cache", "signature_cache_formats": []}, "fmt", False),
+        ({"signature_cache_dir": "cache", "signature_cache_formats": ["fmt"], "signature_cache_max_size": 10, "signature_cache_ttl": 10}, "fmt", True),
+        ({"signature_cache_dir": "cache", "signature_cache_formats": ["fmt"], "signature_cache_max_size": 10, "signature_cache_ttl": 10}, "other", False),
+    ),
+)
+def test_get_signature_cache(config, fmt, expected):
+    context = Context()
+    assert utils.get_signature_cache(context, fmt) is None
+    context.signature_cache = utils.SignatureCache.from_config(config)
+    cache = utils.get_signature_cache(context, fmt)
+    assert (cache is not None) == expected
+    if expected:
+        assert cache is context.signature_cache
+
+
 # execute_subprocess {{{1
 @pytest.mark.asyncio
 @pytest.mark.parametrize("exit_code", (1, 0))
@@ -139,3 +430,83 @@ async def test_execute_subprocess(exit_code):
 )
 def test_is_sha1_apk_autograph_signing_format(format, expected):
     assert utils.is_sha1_apk_autograph_signing_format(format) == expected
+
+
+# trace_span {{{1
+def test_trace_span_nesting(tmp_path):
+    recorder = utils.TraceRecorder()
+
+    async def traced(name, delay):
+        with utils.trace_span(name, path=name, unused=None):
+            await asyncio.sleep(delay)
+            with utils.trace_span("{}_inner".format(name)):
+                utils.trace_annotate(autograph_server="https://autograph.example.com", retries=1)
+
+    async def main():
+        utils.set_trace_recorder(recorder)
+        await asyncio.gather(traced("a", 0.02), traced("b", 0.01))
+        with pytest.raises(ValueError):
+            with utils.trace_span("fails"):
+                raise ValueError()
+
+    asyncio.run(main())
+    spans = {event["name"]: event for event in recorder.events}
+    assert set(spans) == {"a", "a_inner", "b", "b_inner", "fails"}
+    assert spans["a"]["args"]["path"] == "a"
+    assert "unused" not in spans["a"]["args"]
+    assert "rss" in spans["a"]["args"]
+    assert spans["a_inner"]["args"]["autograph_server"] == "https://autograph.example.com"
+    assert spans["a_inner"]["args"]["retries"] == 1
+    assert spans["fails"]["args"]["error"] == "ValueError"
+    # Concurrent tasks get their own tracks, on which the spans nest
+    assert spans["a"]["tid"] == spans["a_inner"]["tid"] != spans["b"]["tid"] == spans["b_inner"]["tid"]
+    assert spans["a"]["ts"] <= spans["a_inner"]["ts"]
+    assert spans["a_inner"]["ts"] + spans["a_inner"]["dur"] <= spans["a"]["ts"] + spans["a"]["dur"]
+
+    path = tmp_path / "public" / "logs" / "trace.json"
+    recorder.write(str(path))
+    trace = json.loads(path.read_text())
+    assert sorted(event["name"] for event in trace["traceEvents"]) == sorted(spans)
+    assert all(event["ph"] == "X" for event in trace["traceEvents"])
+
+
+def _traced_in_executor(name):
+    with utils.trace_span(name):
+        return os.getpid()
+
+
+@pytest.mark.parametrize("executor_cls", (None, ThreadPoolExecutor, ProcessPoolExecutor))
+def test_run_in_executor(executor_cls):
+    recorder = utils.TraceRecorder()
+
+    async def main():
+        utils.set_trace_recorder(recorder)
+        if executor_cls is None:
+            return await utils.run_in_executor(None, _traced_in_executor, "executor")
+        with executor_cls(1) as executor:
+            return await utils.run_in_executor(executor, _traced_in_executor, "executor")
+
+    pid = asyncio.run(main())
+    if executor_cls is ProcessPoolExecutor:
+        # The trace context can't be sent to other processes
+        assert pid != os.getpid()
+        assert recorder.events == []
+    else:
+        assert [event["name"] for event in recorder.events] == ["executor"]
+
+
+def test_trace_span_without_recorder():
+    # No recorder is set in this context, so this only logs
+    with utils.trace_span("untraced") as span_args:
+        utils.trace_annotate(retries=0)
+    assert span_args == {"retries": 0}
+    utils.trace_annotate(retries=1)
+
+
+@pytest.mark.parametrize("config, expected", (({}, None), ({"signing_trace_path": None}, None), ({"signing_trace_path": "trace.json"}, utils.TraceRecorder)))
+def test_trace_recorder_from_config(config, expected):
+    recorder = utils.TraceRecorder.from_config(config)
+    if expected is None:
+        assert recorder is None
+    else:
+        assert isinstance(recorder, expected)